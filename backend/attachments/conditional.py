@@ -0,0 +1,51 @@
+'''
+Conditional GET helpers: handlers compute a version stamp with one cheap
+query, answer 304 when it matches If-None-Match and otherwise send it as an
+ETag. Responses carry Cache-Control: no-cache, so browsers revalidate with
+If-None-Match on their own and fetch() callers see the cached body on 304.
+Each function ships its own copy of this module.
+'''
+import hashlib
+from typing import Any, Dict, Optional
+
+def request_header(event: Dict[str, Any], name: str) -> Optional[str]:
+    '''
+    Header lookup that ignores case; gateways differ in how they pass names.
+    '''
+    name = name.lower()
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == name:
+            return value
+    return None
+
+def make_etag(*parts: Any) -> str:
+    '''
+    Weak ETag over the version parts: the body is rebuilt from cached user
+    summaries, so it is equivalent rather than byte-identical.
+    '''
+    digest = hashlib.md5(':'.join(str(part) for part in parts).encode()).hexdigest()[:20]
+    return 'W/"%s"' % digest
+
+def etag_matches(event: Dict[str, Any], etag: str) -> bool:
+    header = request_header(event, 'If-None-Match')
+    if not header:
+        return False
+    candidates = [tag.strip() for tag in header.split(',')]
+    if '*' in candidates:
+        return True
+    opaque = etag[2:] if etag.startswith('W/') else etag
+    return any((tag[2:] if tag.startswith('W/') else tag) == opaque for tag in candidates)
+
+def cache_headers(etag: str) -> Dict[str, str]:
+    return {
+        'ETag': etag,
+        'Cache-Control': 'no-cache',
+        'Access-Control-Expose-Headers': 'ETag'
+    }
+
+def not_modified(etag: str) -> Dict[str, Any]:
+    return {
+        'statusCode': 304,
+        'headers': dict({'Access-Control-Allow-Origin': '*'}, **cache_headers(etag)),
+        'body': ''
+    }
\ No newline at end of file
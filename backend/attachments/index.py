@@ -0,0 +1,326 @@
+import base64
+import json
+import os
+import re
+import uuid
+from typing import Dict, Any, Optional, Tuple
+from urllib.parse import quote
+
+import psycopg2.extras
+
+import conditional
+import db
+import metrics
+import session
+import storage
+import thumbnails
+
+CHUNK_SIZE = int(os.environ.get('ATTACHMENT_CHUNK_SIZE', str(1024 * 1024)))
+MAX_FILE_BYTES = int(os.environ.get('ATTACHMENT_MAX_BYTES', str(100 * 1024 * 1024)))
+MAX_RESPONSE_BYTES = int(os.environ.get('ATTACHMENT_MAX_RESPONSE_BYTES', str(2 * 1024 * 1024)))
+SHA256_RE = re.compile(r'^[0-9a-f]{64}$')
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Expose-Headers': 'ETag, Content-Range, Accept-Ranges'
+}
+
+def json_response(status: int, payload: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        'statusCode': status,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': metrics.dumps(payload)
+    }
+
+def attachment_json(row: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        'id': row['id'],
+        'file_name': row['file_name'],
+        'content_type': row['content_type'],
+        'size': row['size'],
+        'chat_id': row['chat_id'],
+        'created_at': row['created_at'].isoformat() if row['created_at'] else None,
+        'thumbnail': row.get('thumbnail')
+    }
+
+def create_attachment(cur: Any, upload: Dict[str, Any], sha256: str) -> Dict[str, Any]:
+    cur.execute("""
+        INSERT INTO attachments (uploader_id, chat_id, sha256, file_name, content_type, size)
+        VALUES (%s, %s, %s, %s, %s, %s)
+        RETURNING id, chat_id, file_name, content_type, size, created_at,
+                  (SELECT status FROM thumbnail_jobs WHERE sha256 = %s) AS thumbnail
+    """, (upload['uploader_id'], upload['chat_id'], sha256, upload['file_name'], upload['content_type'],
+          upload['size'], sha256))
+    return attachment_json(cur.fetchone())
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    '''
+    (start, end) inclusive for a single "bytes=" range, None to send the
+    whole file (no header, or several ranges, which we do not combine).
+    Raises ValueError when the range cannot be satisfied.
+    '''
+    if not header or ',' in header:
+        return None
+    match = RANGE_RE.match(header.strip())
+    if not match or match.groups() == ('', ''):
+        raise ValueError(header)
+    first, last = match.groups()
+    if first == '':
+        start, end = max(0, size - int(last)), size - 1
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError(header)
+    return start, end
+
+def start_upload(cur: Any, body_data: Dict[str, Any]) -> Dict[str, Any]:
+    try:
+        uploader_id = int(body_data.get('uploader_id'))
+        size = int(body_data.get('size'))
+        chat_id = int(body_data['chat_id']) if body_data.get('chat_id') else None
+    except (TypeError, ValueError):
+        return json_response(400, {'error': 'uploader_id, size and chat_id must be integers'})
+    
+    file_name = (body_data.get('file_name') or '').strip()[:255]
+    content_type = (body_data.get('content_type') or 'application/octet-stream').strip()[:255]
+    sha256 = (body_data.get('sha256') or '').lower() or None
+    
+    if not file_name or not 0 < size <= MAX_FILE_BYTES:
+        return json_response(400, {'error': f'file_name required, size must be 1 to {MAX_FILE_BYTES} bytes'})
+    if sha256 is not None and not SHA256_RE.match(sha256):
+        return json_response(400, {'error': 'sha256 must be 64 hex characters'})
+    if chat_id is not None:
+        cur.execute("SELECT 1 FROM chat_members WHERE chat_id = %s AND user_id = %s", (chat_id, uploader_id))
+        if cur.fetchone() is None:
+            return json_response(404, {'error': 'Chat not found'})
+    
+    # A declared sha256 only checks the received bytes. Knowing a hash is
+    # no proof of having the file, so every upload sends its contents and
+    # dedup happens once the server has hashed them
+    upload_id = uuid.uuid4().hex
+    cur.execute("""
+        INSERT INTO attachment_uploads (id, uploader_id, chat_id, file_name, content_type, size, sha256)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+    """, (upload_id, uploader_id, chat_id, file_name, content_type, size, sha256))
+    return json_response(200, {'upload_id': upload_id, 'chunk_size': CHUNK_SIZE, 'received': 0, 'size': size})
+
+def finish_upload(cur: Any, store: storage.Storage, upload: Dict[str, Any]) -> Dict[str, Any]:
+    '''
+    Hash the staged file, check it against the declared size and sha256,
+    store it unless its contents are already known and turn the upload into
+    an attachment. Nothing is stored for a mismatch. The caller commits,
+    then discards the staged copy.
+    '''
+    sha256, size = store.hash_upload(upload['id'])
+    cur.execute("DELETE FROM attachment_uploads WHERE id = %s", (upload['id'],))
+    
+    if size != upload['size'] or (upload['sha256'] and upload['sha256'] != sha256):
+        return json_response(400, {'error': 'uploaded contents do not match size or sha256', 'sha256': sha256})
+    
+    stored = store.commit_upload(upload['id'], sha256)
+    cur.execute("""
+        INSERT INTO attachment_blobs (sha256, size, content_type)
+        VALUES (%s, %s, %s)
+        ON CONFLICT (sha256) DO NOTHING
+        RETURNING sha256
+    """, (sha256, size, upload['content_type']))
+    if cur.fetchone() is not None:
+        thumbnails.enqueue(cur, sha256, upload['content_type'])
+    
+    attachment = create_attachment(cur, upload, sha256)
+    return json_response(200, {'attachment': attachment, 'deduplicated': not stored})
+
+def download(event: Dict[str, Any], store: storage.Storage, row: Dict[str, Any], thumbnail: bool) -> Dict[str, Any]:
+    '''
+    The file or a byte range of it, read from storage in small chunks.
+    Contents never change for a given hash, so responses are cacheable
+    forever and revalidate by ETag.
+    '''
+    if thumbnail:
+        if row['thumbnail'] != 'done':
+            return json_response(404, {'error': 'Thumbnail not available', 'status': row['thumbnail']})
+        key, content_type = storage.thumbnail_key(row['sha256']), 'image/jpeg'
+        etag = '"%s-thumb"' % row['sha256']
+        size = store.size(key)
+    else:
+        key, content_type = storage.blob_key(row['sha256']), row['content_type']
+        etag = '"%s"' % row['sha256']
+        size = row['size']
+    
+    headers = dict(CORS_HEADERS, **{
+        'ETag': etag,
+        'Cache-Control': 'private, max-age=31536000, immutable',
+        'Accept-Ranges': 'bytes'
+    })
+    if conditional.etag_matches(event, etag):
+        return {'statusCode': 304, 'headers': headers, 'body': ''}
+    
+    try:
+        byte_range = parse_range(conditional.request_header(event, 'Range'), size)
+    except ValueError:
+        return {'statusCode': 416, 'headers': dict(headers, **{'Content-Range': 'bytes */%d' % size}), 'body': ''}
+    
+    if byte_range is None:
+        if size > MAX_RESPONSE_BYTES:
+            return json_response(400, {'error': f'files over {MAX_RESPONSE_BYTES} bytes are served in Range requests', 'size': size})
+        start, end, status = 0, size - 1, 200
+    else:
+        # Responses are capped; the client asks for the rest with another range
+        start, end, status = byte_range[0], min(byte_range[1], byte_range[0] + MAX_RESPONSE_BYTES - 1), 206
+        headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+    
+    headers['Content-Type'] = content_type
+    headers['Content-Disposition'] = "inline; filename*=UTF-8''%s" % quote(row['file_name'])
+    with metrics.phase('read'):
+        data = b''.join(store.read_range(key, start, end - start + 1))
+    return {
+        'statusCode': status,
+        'headers': headers,
+        'body': base64.b64encode(data).decode('ascii'),
+        'isBase64Encoded': True
+    }
+
+@metrics.instrumented('attachments')
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''
+    Business: Upload and download message attachments - chunked resumable uploads, SHA-256 dedup, ranged downloads, thumbnails
+    Args: event with httpMethod, body (POST: action start with uploader_id, file_name, content_type, size, optional chat_id
+          and sha256; PUT: raw chunk bytes), queryStringParameters (PUT: upload_id, offset; GET: upload_id for upload progress,
+          or id with optional thumbnail to download, meta for attachment data only), headers (Authorization, Range,
+          If-None-Match); context with request_id
+    Returns: HTTP response with upload state, attachment data or file bytes
+    '''
+    method: str = event.get('httpMethod', 'GET')
+    
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Allow-Methods': 'GET, POST, PUT, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type, Authorization, Range, If-None-Match',
+                'Access-Control-Max-Age': '86400'
+            },
+            'body': ''
+        }
+    
+    params = event.get('queryStringParameters') or {}
+    body_data = json.loads(event.get('body', '{}')) if method == 'POST' else {}
+    
+    try:
+        current = session.authorize(event, body_data.get('uploader_id') if isinstance(body_data, dict) else None)
+    except session.Denied as denied:
+        return denied.response()
+    
+    store = storage.get_storage()
+    conn = db.acquire()
+    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    
+    try:
+        if method == 'GET':
+            # Downloads act for the token's user; a bare user_id only counts
+            # when SESSION_REQUIRED=0 lets requests without a token through
+            user_id = current.user_id if current is not None else params.get('user_id')
+            if not user_id:
+                return session.Denied(401, 'Authorization required').response()
+            
+            if params.get('upload_id'):
+                cur.execute(
+                    "SELECT id, size, received FROM attachment_uploads WHERE id = %s AND uploader_id = %s",
+                    (params['upload_id'], user_id)
+                )
+                upload = cur.fetchone()
+                if upload is None:
+                    return json_response(404, {'error': 'Upload not found'})
+                return json_response(200, {
+                    'upload_id': upload['id'],
+                    'size': upload['size'],
+                    'received': upload['received'],
+                    'chunk_size': CHUNK_SIZE
+                })
+            
+            try:
+                attachment_id = int(params.get('id'))
+            except (TypeError, ValueError):
+                return json_response(400, {'error': 'id or upload_id required'})
+            
+            # Ids are sequential, so anyone else gets the same 404 as for a
+            # missing attachment
+            cur.execute("""
+                SELECT a.id, a.chat_id, a.sha256, a.file_name, a.content_type, a.size, a.created_at,
+                       j.status AS thumbnail
+                FROM attachments a
+                LEFT JOIN thumbnail_jobs j ON j.sha256 = a.sha256
+                WHERE a.id = %s
+                  AND (a.uploader_id = %s OR EXISTS (
+                      SELECT 1 FROM chat_members cm WHERE cm.chat_id = a.chat_id AND cm.user_id = %s
+                  ))
+            """, (attachment_id, user_id, user_id))
+            row = cur.fetchone()
+            conn.rollback()
+            if row is None:
+                return json_response(404, {'error': 'Attachment not found'})
+            
+            if params.get('meta'):
+                return json_response(200, {'attachment': attachment_json(row)})
+            return download(event, store, row, bool(params.get('thumbnail')))
+        
+        elif method == 'POST':
+            if body_data.get('action') != 'start':
+                return json_response(400, {'error': 'action must be start'})
+            response = start_upload(cur, body_data)
+            conn.commit()
+            return response
+        
+        elif method == 'PUT':
+            upload_id = params.get('upload_id')
+            try:
+                offset = int(params.get('offset'))
+            except (TypeError, ValueError):
+                return json_response(400, {'error': 'upload_id and offset required'})
+            
+            body = event.get('body') or ''
+            data = base64.b64decode(body) if event.get('isBase64Encoded') else body.encode('utf-8')
+            
+            # The row lock serializes chunks of one upload; retried chunks
+            # rewrite the same bytes, anything else must continue at received
+            cur.execute("""
+                SELECT id, uploader_id, chat_id, file_name, content_type, size, received, sha256
+                FROM attachment_uploads
+                WHERE id = %s
+                FOR UPDATE
+            """, (upload_id,))
+            upload = cur.fetchone()
+            if upload is None:
+                return json_response(404, {'error': 'Upload not found'})
+            if current is not None and current.user_id != upload['uploader_id']:
+                return json_response(403, {'error': 'Upload belongs to another user'})
+            if offset != upload['received']:
+                return json_response(409, {'error': 'offset must equal received', 'received': upload['received']})
+            if not data or len(data) > CHUNK_SIZE or offset + len(data) > upload['size']:
+                return json_response(400, {'error': f'chunks must be 1 to {CHUNK_SIZE} bytes within the declared size'})
+            
+            with metrics.phase('write'):
+                store.write_part(upload_id, offset, data)
+            upload['received'] = offset + len(data)
+            
+            if upload['received'] < upload['size']:
+                cur.execute(
+                    "UPDATE attachment_uploads SET received = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s",
+                    (upload['received'], upload_id)
+                )
+                conn.commit()
+                return json_response(200, {'upload_id': upload_id, 'received': upload['received'], 'size': upload['size']})
+            
+            with metrics.phase('commit'):
+                response = finish_upload(cur, store, upload)
+            conn.commit()
+            store.discard_upload(upload_id)
+            return response
+        
+        return json_response(405, {'error': 'Method not allowed'})
+    
+    finally:
+        cur.close()
+        db.release(conn)
\ No newline at end of file
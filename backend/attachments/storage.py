@@ -0,0 +1,146 @@
+'''
+Content-addressed file storage for attachments. Uploads are staged under
+their upload id, hashed once complete and moved to a key derived from the
+SHA-256 of their contents, so identical files are kept once. Readers get
+byte ranges as an iterator of small chunks and never hold a whole file.
+ATTACHMENTS_STORAGE picks the implementation; only 'local' (a directory at
+ATTACHMENTS_DIR shared by every container) exists so far.
+'''
+import hashlib
+import os
+from typing import Iterator, Optional, Tuple
+
+READ_CHUNK_BYTES = 64 * 1024
+
+def blob_key(sha256: str) -> str:
+    return 'blobs/%s/%s/%s' % (sha256[:2], sha256[2:4], sha256)
+
+def thumbnail_key(sha256: str) -> str:
+    return 'thumbnails/%s/%s.jpg' % (sha256[:2], sha256)
+
+class Storage:
+    '''
+    Interface every backend implements.
+    '''
+    def write_part(self, upload_id: str, offset: int, data: bytes) -> None:
+        '''
+        Write data at offset of the staged upload; rewriting the same range
+        on a retry is harmless.
+        '''
+        raise NotImplementedError
+
+    def discard_upload(self, upload_id: str) -> None:
+        raise NotImplementedError
+
+    def hash_upload(self, upload_id: str) -> Tuple[str, int]:
+        '''
+        (sha256, size) of the staged upload as it was received.
+        '''
+        raise NotImplementedError
+
+    def commit_upload(self, upload_id: str, sha256: str) -> bool:
+        '''
+        Store the staged upload, already hashed by hash_upload() and checked
+        by the caller, under blob_key(sha256) unless that blob exists. Returns
+        False when the contents were a duplicate. The staged copy stays until
+        discard_upload(), so a failed commit can be retried.
+        '''
+        raise NotImplementedError
+
+    def put(self, key: str, data: bytes) -> None:
+        raise NotImplementedError
+
+    def exists(self, key: str) -> bool:
+        raise NotImplementedError
+
+    def size(self, key: str) -> int:
+        raise NotImplementedError
+
+    def read_range(self, key: str, start: int = 0, length: Optional[int] = None) -> Iterator[bytes]:
+        raise NotImplementedError
+
+class LocalDiskStorage(Storage):
+    def __init__(self, root: str) -> None:
+        self.root = root
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, *key.split('/'))
+
+    def _staging_path(self, upload_id: str) -> str:
+        return self._path('staging/%s' % upload_id)
+
+    def write_part(self, upload_id: str, offset: int, data: bytes) -> None:
+        path = self._staging_path(upload_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            os.pwrite(fd, data, offset)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def discard_upload(self, upload_id: str) -> None:
+        try:
+            os.remove(self._staging_path(upload_id))
+        except FileNotFoundError:
+            pass
+
+    def hash_upload(self, upload_id: str) -> Tuple[str, int]:
+        digest = hashlib.sha256()
+        size = 0
+        with open(self._staging_path(upload_id), 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+                size += len(chunk)
+        return digest.hexdigest(), size
+
+    def commit_upload(self, upload_id: str, sha256: str) -> bool:
+        path = self._path(blob_key(sha256))
+        if os.path.exists(path):
+            return False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            # A hard link publishes the blob atomically without copying it
+            os.link(self._staging_path(upload_id), path)
+        except FileExistsError:
+            return False
+        return True
+
+    def put(self, key: str, data: bytes) -> None:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(self._path(key))
+
+    def size(self, key: str) -> int:
+        return os.path.getsize(self._path(key))
+
+    def read_range(self, key: str, start: int = 0, length: Optional[int] = None) -> Iterator[bytes]:
+        with open(self._path(key), 'rb') as f:
+            f.seek(start)
+            remaining = length
+            while remaining is None or remaining > 0:
+                chunk = f.read(READ_CHUNK_BYTES if remaining is None else min(READ_CHUNK_BYTES, remaining))
+                if not chunk:
+                    return
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+
+_storage: Optional[Storage] = None
+
+def get_storage() -> Storage:
+    global _storage
+    if _storage is None:
+        kind = os.environ.get('ATTACHMENTS_STORAGE', 'local')
+        if kind != 'local':
+            raise ValueError('unknown ATTACHMENTS_STORAGE: %s' % kind)
+        _storage = LocalDiskStorage(os.environ.get('ATTACHMENTS_DIR', '/tmp/pchat-attachments'))
+    return _storage
\ No newline at end of file
@@ -0,0 +1,89 @@
+'''
+Thumbnail jobs. Uploading a new image blob only enqueues a row in
+thumbnail_jobs; scripts/attachments_worker.py claims pending rows with
+FOR UPDATE SKIP LOCKED (so several workers never take the same job),
+renders them and marks them done, or retries with backoff up to
+THUMBNAIL_MAX_ATTEMPTS. Rendering needs Pillow, which only the worker
+installs; the function itself never imports it.
+'''
+import io
+import os
+from typing import Any, Dict, List
+
+import storage
+
+THUMBNAIL_SIZE = int(os.environ.get('THUMBNAIL_SIZE', '320'))
+THUMBNAIL_MAX_ATTEMPTS = int(os.environ.get('THUMBNAIL_MAX_ATTEMPTS', '5'))
+THUMBNAIL_SOURCE_MAX_BYTES = int(os.environ.get('THUMBNAIL_SOURCE_MAX_BYTES', str(50 * 1024 * 1024)))
+THUMBNAIL_TYPES = ('image/jpeg', 'image/png', 'image/gif', 'image/webp', 'image/bmp')
+
+def enqueue(cur: Any, sha256: str, content_type: str) -> bool:
+    '''
+    Queue a thumbnail for a newly stored blob if it is an image we render.
+    The caller commits.
+    '''
+    if content_type not in THUMBNAIL_TYPES:
+        return False
+    cur.execute("""
+        INSERT INTO thumbnail_jobs (sha256) VALUES (%s)
+        ON CONFLICT (sha256) DO NOTHING
+    """, (sha256,))
+    return True
+
+def claim(cur: Any, limit: int) -> List[Dict[str, Any]]:
+    '''
+    Lock up to limit due jobs for this worker's transaction.
+    '''
+    cur.execute("""
+        SELECT j.sha256, j.attempts, b.size
+        FROM thumbnail_jobs j
+        INNER JOIN attachment_blobs b ON b.sha256 = j.sha256
+        WHERE j.status = 'pending' AND j.run_after <= CURRENT_TIMESTAMP
+        ORDER BY j.run_after
+        LIMIT %s
+        FOR UPDATE OF j SKIP LOCKED
+    """, (limit,))
+    return [{'sha256': row[0], 'attempts': row[1], 'size': row[2]} for row in cur.fetchall()]
+
+def render(store: storage.Storage, sha256: str) -> bytes:
+    from PIL import Image
+
+    source = io.BytesIO()
+    for chunk in store.read_range(storage.blob_key(sha256)):
+        source.write(chunk)
+    source.seek(0)
+
+    with Image.open(source) as image:
+        # draft() lets JPEG decode at a reduced scale instead of full size
+        image.draft('RGB', (THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+        image = image.convert('RGB')
+        image.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+        out = io.BytesIO()
+        image.save(out, 'JPEG', quality=80, optimize=True)
+    return out.getvalue()
+
+def run_job(cur: Any, store: storage.Storage, job: Dict[str, Any]) -> str:
+    '''
+    Render one claimed job and record the outcome; returns the new status.
+    '''
+    if job['size'] > THUMBNAIL_SOURCE_MAX_BYTES:
+        new_status, error = 'skipped', 'source larger than %d bytes' % THUMBNAIL_SOURCE_MAX_BYTES
+    else:
+        try:
+            store.put(storage.thumbnail_key(job['sha256']), render(store, job['sha256']))
+            new_status, error = 'done', None
+        except Exception as exc:
+            attempts = job['attempts'] + 1
+            new_status = 'failed' if attempts >= THUMBNAIL_MAX_ATTEMPTS else 'pending'
+            error = '%s: %s' % (type(exc).__name__, exc)
+
+    cur.execute("""
+        UPDATE thumbnail_jobs
+        SET status = %s,
+            attempts = attempts + CASE WHEN %s = 'done' THEN 0 ELSE 1 END,
+            last_error = %s,
+            run_after = CURRENT_TIMESTAMP + make_interval(secs => 30 * power(2, attempts)),
+            updated_at = CURRENT_TIMESTAMP
+        WHERE sha256 = %s
+    """, (new_status, new_status, error, job['sha256']))
+    return new_status
\ No newline at end of file
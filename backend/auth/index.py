@@ -1,15 +1,38 @@
 import json
-import os
-import hashlib
 from typing import Dict, Any
 
-def hash_password(password: str) -> str:
-    return hashlib.sha256(password.encode()).hexdigest()
+import psycopg2
 
+import db
+import metrics
+import passwords
+import presence
+import session
+
+REGISTER_USER = db.statement(
+    'auth_register',
+    "INSERT INTO users (username, password_hash, nickname) VALUES (%s, %s, %s) RETURNING id, username, nickname"
+)
+
+LOGIN_USER = db.statement(
+    'auth_login',
+    "SELECT id, username, nickname, avatar_url, theme, password_hash FROM users WHERE username = %s"
+)
+
+UPDATE_PASSWORD_HASH = db.statement(
+    'auth_update_password_hash',
+    "UPDATE users SET password_hash = %s WHERE id = %s AND password_hash = %s"
+)
+
+def session_fields(user_id: int) -> Dict[str, Any]:
+    token, current = session.issue(user_id)
+    return {'token': token, 'expires_at': current.expires_at}
+
+@metrics.instrumented('auth')
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
-    Business: User authentication - register, login, password validation
-    Args: event with httpMethod, body (username, password); context with request_id
+    Business: User authentication - register, login, logout, password validation; issues session tokens
+    Args: event with httpMethod, body (action, username, password; logout takes the Authorization header and optional everywhere); context with request_id
     Returns: HTTP response with auth result
     '''
     method: str = event.get('httpMethod', 'GET')
@@ -20,17 +43,37 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id',
+                'Access-Control-Allow-Headers': 'Content-Type, Authorization',
                 'Access-Control-Max-Age': '86400'
             },
             'body': ''
         }
     
     if method == 'POST':
-        import psycopg2
-        
         body_data = json.loads(event.get('body', '{}'))
         action = body_data.get('action')
+        
+        if action == 'logout':
+            try:
+                current = session.verify(session.bearer_token(event) or '')
+            except session.Denied as denied:
+                return denied.response()
+            
+            conn = db.acquire()
+            cur = conn.cursor()
+            try:
+                session.revoke(cur, current, everywhere=bool(body_data.get('everywhere')))
+                conn.commit()
+            finally:
+                cur.close()
+                db.release(conn)
+            
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': metrics.dumps({'success': True})
+            }
+        
         username = body_data.get('username', '').strip()
         password = body_data.get('password', '')
         
@@ -38,40 +81,44 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             return {
                 'statusCode': 400,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Username and password required'})
+                'body': metrics.dumps({'error': 'Username and password required'})
             }
         
         if len(password) < 7 or not any(char.isdigit() for char in password):
             return {
                 'statusCode': 400,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Password must be at least 7 characters with 1 digit'})
+                'body': metrics.dumps({'error': 'Password must be at least 7 characters with 1 digit'})
             }
         
-        conn = psycopg2.connect(os.environ['DATABASE_URL'])
-        cur = conn.cursor()
+        # Refuse before creating or checking anything a token could not be issued for
+        try:
+            session.check_configured()
+        except session.Denied as denied:
+            return denied.response()
         
         if action == 'register':
-            password_hash = hash_password(password)
+            # Hash before taking a connection; the KDF is the slow part
+            password_hash = passwords.hash_password(password)
+            conn = db.acquire()
+            cur = conn.cursor()
             
             try:
-                cur.execute(
-                    "INSERT INTO users (username, password_hash, nickname) VALUES (%s, %s, %s) RETURNING id, username, nickname",
-                    (username, password_hash, username)
-                )
+                REGISTER_USER.execute(cur, (username, password_hash, username))
                 user = cur.fetchone()
                 conn.commit()
                 
                 return {
                     'statusCode': 200,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({
+                    'body': metrics.dumps({
                         'success': True,
                         'user': {
                             'id': user[0],
                             'username': user[1],
                             'nickname': user[2]
-                        }
+                        },
+                        **session_fields(user[0])
                     })
                 }
             except psycopg2.errors.UniqueViolation:
@@ -79,52 +126,67 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 return {
                     'statusCode': 400,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Username already exists'})
+                    'body': metrics.dumps({'error': 'Username already exists'})
                 }
             finally:
                 cur.close()
-                conn.close()
+                db.release(conn)
         
         elif action == 'login':
-            password_hash = hash_password(password)
-            
+            # The connection goes back to the pool while the password is checked
+            conn = db.acquire()
+            cur = conn.cursor()
             try:
-                cur.execute(
-                    "SELECT id, username, nickname, avatar_url, theme FROM users WHERE username = %s AND password_hash = %s",
-                    (username, password_hash)
-                )
+                LOGIN_USER.execute(cur, (username,))
                 user = cur.fetchone()
-                
-                if user:
-                    cur.execute("UPDATE users SET is_online = true WHERE id = %s", (user[0],))
-                    conn.commit()
-                    
-                    return {
-                        'statusCode': 200,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({
-                            'success': True,
-                            'user': {
-                                'id': user[0],
-                                'username': user[1],
-                                'nickname': user[2],
-                                'avatar_url': user[3],
-                                'theme': user[4]
-                            }
-                        })
-                    }
-                else:
-                    return {
-                        'statusCode': 401,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Invalid credentials'})
-                    }
             finally:
                 cur.close()
-                conn.close()
+                db.release(conn)
+            
+            if not user:
+                # Spend as long as a real check, so unknown usernames don't answer faster
+                passwords.hash_password(password)
+            if not user or not passwords.verify_password(password, user[5]):
+                return {
+                    'statusCode': 401,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': metrics.dumps({'error': 'Invalid credentials'})
+                }
+            
+            new_hash = passwords.hash_password(password) if passwords.needs_rehash(user[5]) else None
+            conn = db.acquire()
+            cur = conn.cursor()
+            try:
+                if new_hash:
+                    UPDATE_PASSWORD_HASH.execute(cur, (new_hash, user[0], user[5]))
+                presence.heartbeat(conn, user[0])
+                conn.commit()
+            finally:
+                cur.close()
+                db.release(conn)
+            
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': metrics.dumps({
+                    'success': True,
+                    'user': {
+                        'id': user[0],
+                        'username': user[1],
+                        'nickname': user[2],
+                        'avatar_url': user[3],
+                        'theme': user[4]
+                    },
+                    **session_fields(user[0])
+                })
+            }
     
     return {
         'statusCode': 405,
         'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'error': 'Method not allowed'})
+        'body': metrics.dumps({'error': 'Method not allowed'})
     }
+
+
+# Runs once per container, when the platform imports this module
+db.warm_up()
\ No newline at end of file
@@ -0,0 +1,48 @@
+'''
+Password hashing with PBKDF2-HMAC-SHA256, stored as
+pbkdf2_sha256$<iterations>$<salt>$<hash>. PASSWORD_PBKDF2_ITERATIONS sets
+the cost of new hashes; older hashes still verify and needs_rehash() says
+when to replace them at the next login. Hashes from before PBKDF2 (plain
+SHA-256 hex) are accepted the same way.
+
+The KDF runs on a pool of PASSWORD_HASH_WORKERS threads. hashlib releases
+the GIL while it works, so logins hash in parallel up to that many and
+queue beyond it instead of starving the rest of the container.
+'''
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+from concurrent.futures import ThreadPoolExecutor
+
+ALGORITHM = 'pbkdf2_sha256'
+ITERATIONS = int(os.environ.get('PASSWORD_PBKDF2_ITERATIONS', '600000'))
+WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', str(os.cpu_count() or 2)))
+SALT_BYTES = 16
+
+_executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix='password-hash')
+
+def _b64(data: bytes) -> str:
+    return base64.b64encode(data).decode().rstrip('=')
+
+def _pbkdf2(password: str, salt: bytes, iterations: int) -> bytes:
+    return _executor.submit(hashlib.pbkdf2_hmac, 'sha256', password.encode(), salt, iterations).result()
+
+def hash_password(password: str, iterations: int = ITERATIONS) -> str:
+    salt = secrets.token_bytes(SALT_BYTES)
+    return '%s$%d$%s$%s' % (ALGORITHM, iterations, _b64(salt), _b64(_pbkdf2(password, salt, iterations)))
+
+def verify_password(password: str, stored: str) -> bool:
+    if not stored.startswith(ALGORITHM + '$'):
+        legacy = hashlib.sha256(password.encode()).hexdigest()
+        return hmac.compare_digest(legacy, stored)
+    try:
+        _, iterations, salt, expected = stored.split('$')
+        salt_bytes = base64.b64decode(salt + '=' * (-len(salt) % 4))
+        return hmac.compare_digest(_b64(_pbkdf2(password, salt_bytes, int(iterations))), expected)
+    except ValueError:
+        return False
+
+def needs_rehash(stored: str) -> bool:
+    return not stored.startswith('%s$%d$' % (ALGORITHM, ITERATIONS))
\ No newline at end of file
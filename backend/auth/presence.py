@@ -0,0 +1,81 @@
+'''
+Heartbeat-based presence kept in the UNLOGGED user_presence table instead of
+users.is_online. A user is online while their last heartbeat is younger than
+PRESENCE_TTL; stale rows are removed in periodic batch sweeps rather than
+one by one. Unlogged tables are not replicated, so always use the primary.
+Each function ships its own copy of this module.
+'''
+import os
+import time
+from typing import Any, Dict, Iterable, Optional
+
+PRESENCE_TTL = int(os.environ.get('PRESENCE_TTL', '90'))
+HEARTBEAT_MIN_INTERVAL = int(os.environ.get('PRESENCE_HEARTBEAT_MIN_INTERVAL', '20'))
+SWEEP_INTERVAL = float(os.environ.get('PRESENCE_SWEEP_INTERVAL', '60'))
+SWEEP_LOCK_ID = 0x70726573
+
+_next_sweep_at = 0.0
+
+def heartbeat(conn: Any, user_id: int) -> None:
+    '''
+    Mark the user as seen now. Rows fresher than HEARTBEAT_MIN_INTERVAL are
+    left untouched, so extra tabs and retries cost a lookup, not a write.
+    The caller commits.
+    '''
+    with conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO user_presence (user_id, last_seen_at)
+            VALUES (%s, CURRENT_TIMESTAMP)
+            ON CONFLICT (user_id) DO UPDATE SET last_seen_at = EXCLUDED.last_seen_at
+            WHERE user_presence.last_seen_at < EXCLUDED.last_seen_at - make_interval(secs => %s)
+        """, (user_id, HEARTBEAT_MIN_INTERVAL))
+    maybe_sweep(conn)
+
+def go_offline(conn: Any, user_id: int) -> None:
+    with conn.cursor() as cur:
+        cur.execute("DELETE FROM user_presence WHERE user_id = %s", (user_id,))
+
+def maybe_sweep(conn: Any) -> Optional[int]:
+    '''
+    Delete expired rows at most once per SWEEP_INTERVAL per container; a
+    transaction-level advisory lock keeps concurrent containers from
+    sweeping at the same time. Returns the number of rows removed.
+    '''
+    global _next_sweep_at
+    now = time.monotonic()
+    if now < _next_sweep_at:
+        return None
+    _next_sweep_at = now + SWEEP_INTERVAL
+
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_try_advisory_xact_lock(%s)", (SWEEP_LOCK_ID,))
+        if not cur.fetchone()[0]:
+            return None
+        cur.execute(
+            "DELETE FROM user_presence WHERE last_seen_at < CURRENT_TIMESTAMP - make_interval(secs => %s)",
+            (PRESENCE_TTL,)
+        )
+        return cur.rowcount
+
+def get_many(conn: Any, user_ids: Iterable[int]) -> Dict[int, Dict[str, Any]]:
+    '''
+    Presence for the given ids in one query. Users with hide_online_status
+    always appear offline with no last_seen_at; unknown ids are absent.
+    '''
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT u.id,
+                   NOT COALESCE(u.hide_online_status, false)
+                       AND p.last_seen_at >= CURRENT_TIMESTAMP - make_interval(secs => %s) AS online,
+                   CASE WHEN COALESCE(u.hide_online_status, false) THEN NULL ELSE p.last_seen_at END AS last_seen_at
+            FROM users u
+            LEFT JOIN user_presence p ON p.user_id = u.id
+            WHERE u.id = ANY(%s)
+        """, (PRESENCE_TTL, list(set(user_ids))))
+        return {
+            row[0]: {
+                'online': bool(row[1]),
+                'last_seen_at': row[2].isoformat() if row[2] else None
+            }
+            for row in cur.fetchall()
+        }
\ No newline at end of file
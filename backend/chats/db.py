@@ -0,0 +1,356 @@
+'''
+Warm PostgreSQL connections reused across invocations in the same container,
+routed between the primary (DATABASE_URL) and streaming replicas
+(DATABASE_REPLICA_URLS, comma-separated). acquire(readonly=True) picks a
+replica round-robin; given the WAL position token of an earlier write it
+waits up to DB_REPLICA_WAIT_TIMEOUT for the replica to replay that far and
+otherwise falls back to the primary, so a client always reads its own
+writes. Writes report the token with write_token(); clients send it back
+in the X-Min-Lsn header. Replicas that refuse connections are skipped for
+DB_REPLICA_RETRY_AFTER seconds. LISTEN and unlogged tables (presence, rate
+limits) only work on the primary, so those paths never pass readonly.
+
+Hot queries are registered with statement() and run through it: each
+connection PREPAREs a statement the first time it runs it and afterwards
+only sends EXECUTE with the parameters, so the SQL is not parsed again and
+Postgres can switch to a cached generic plan. DB_PREPARE_STATEMENTS=0 sends
+plain SQL instead (needed behind a transaction-pooling proxy, where
+session state does not stick to a connection). warm_up(), called when
+index.py is imported, connects and prepares every registered statement
+once per container.
+Each function ships its own copy of this module.
+'''
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from typing import Any, Dict, List, Optional, Set
+
+import psycopg2
+import psycopg2.extensions
+
+import metrics
+
+POOL_MAX_IDLE = int(os.environ.get('DB_POOL_MAX_IDLE', '4'))
+MAX_LIFETIME = float(os.environ.get('DB_MAX_LIFETIME', '1800'))
+HEALTH_CHECK_AFTER = float(os.environ.get('DB_HEALTH_CHECK_AFTER', '30'))
+CONNECT_TIMEOUT = int(os.environ.get('DB_CONNECT_TIMEOUT', '5'))
+REPLICA_URLS = [url.strip() for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+REPLICA_WAIT_TIMEOUT = float(os.environ.get('DB_REPLICA_WAIT_TIMEOUT', '0.1'))
+REPLICA_RETRY_AFTER = float(os.environ.get('DB_REPLICA_RETRY_AFTER', '30'))
+LSN_HEADER = 'X-Min-Lsn'
+LSN_RE = re.compile(r'^[0-9A-Fa-f]{1,8}/[0-9A-Fa-f]{1,8}$')
+PREPARE_STATEMENTS = os.environ.get('DB_PREPARE_STATEMENTS', '1') != '0'
+WARM_UP = os.environ.get('DB_WARM_UP', '1') != '0'
+PLACEHOLDER_RE = re.compile(r'%\((\w+)\)s|%s|%%')
+
+class PooledConnection(psycopg2.extensions.connection):
+    '''
+    psycopg2 connection that remembers when it was opened and last returned
+    and hands out instrumented cursors.
+    '''
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.created_at = time.monotonic()
+        self.released_at = self.created_at
+        self.prepared: Set[str] = set()
+    
+    def cursor(self, *args: Any, **kwargs: Any) -> Any:
+        # Every cursor, whatever its factory, gets statement timing
+        base = kwargs.get('cursor_factory') or self.cursor_factory or psycopg2.extensions.cursor
+        kwargs['cursor_factory'] = metrics.instrument_cursor_class(base)
+        return super().cursor(*args, **kwargs)
+
+class ConnectionPool:
+    '''
+    Non-blocking pool: acquire() reuses an idle connection or opens a new one,
+    release() keeps at most max_idle connections around. Connections older than
+    max_lifetime are recycled, ones idle longer than health_check_after are
+    pinged before reuse, and broken ones are dropped instead of returned.
+    '''
+    def __init__(self, dsn: str, max_idle: int = POOL_MAX_IDLE, max_lifetime: float = MAX_LIFETIME,
+                 health_check_after: float = HEALTH_CHECK_AFTER, replica: bool = False) -> None:
+        self.dsn = dsn
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.health_check_after = health_check_after
+        self.replica = replica
+        self.down_until = 0.0
+        self._idle: List[PooledConnection] = []
+        self._lock = threading.Lock()
+    
+    def _connect(self) -> PooledConnection:
+        conn = psycopg2.connect(
+            self.dsn,
+            connection_factory=PooledConnection,
+            connect_timeout=CONNECT_TIMEOUT,
+            keepalives=1,
+            keepalives_idle=30,
+            keepalives_interval=10,
+            keepalives_count=3
+        )
+        conn.pool = self
+        conn.replica = self.replica
+        return conn
+    
+    def _discard(self, conn: PooledConnection) -> None:
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+    
+    def _is_healthy(self, conn: PooledConnection) -> bool:
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+    
+    def acquire(self) -> PooledConnection:
+        while True:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            
+            if conn is None:
+                return self._connect()
+            
+            now = time.monotonic()
+            if conn.closed or now - conn.created_at > self.max_lifetime:
+                self._discard(conn)
+                continue
+            
+            if now - conn.released_at > self.health_check_after and not self._is_healthy(conn):
+                self._discard(conn)
+                continue
+            
+            return conn
+    
+    def release(self, conn: PooledConnection) -> None:
+        if conn.closed:
+            return
+        
+        try:
+            if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+            if conn.autocommit:
+                conn.autocommit = False
+        except psycopg2.Error:
+            self._discard(conn)
+            return
+        
+        conn.released_at = time.monotonic()
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+        self._discard(conn)
+
+_pool: Optional[ConnectionPool] = None
+_replica_pools: Optional[List[ConnectionPool]] = None
+_next_replica = 0
+_pool_lock = threading.Lock()
+
+def get_pool() -> ConnectionPool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(os.environ['DATABASE_URL'])
+    return _pool
+
+def get_replica_pools() -> List[ConnectionPool]:
+    global _replica_pools
+    if _replica_pools is None:
+        with _pool_lock:
+            if _replica_pools is None:
+                _replica_pools = [ConnectionPool(url, replica=True) for url in REPLICA_URLS]
+    return _replica_pools
+
+def parse_lsn(value: Any) -> Optional[str]:
+    return value.strip().upper() if isinstance(value, str) and LSN_RE.match(value.strip()) else None
+
+def requested_lsn(event: Dict[str, Any]) -> Optional[str]:
+    '''
+    The write token a client sent along with a read, if any.
+    '''
+    name = LSN_HEADER.lower()
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == name:
+            return parse_lsn(value)
+    return None
+
+def _replayed(conn: PooledConnection, min_lsn: str, timeout: float) -> bool:
+    '''
+    Poll the replica until it has replayed min_lsn or timeout passes.
+    '''
+    deadline = time.monotonic() + timeout
+    delay = 0.005
+    with metrics.phase('replica_wait'):
+        while True:
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_last_wal_replay_lsn() >= %s::pg_lsn", (min_lsn,))
+                replayed = cur.fetchone()[0]
+            conn.rollback()
+            remaining = deadline - time.monotonic()
+            if replayed or remaining <= 0:
+                return bool(replayed)
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 0.05)
+
+def _acquire_replica(min_lsn: Optional[str]) -> Optional[PooledConnection]:
+    global _next_replica
+    pools = get_replica_pools()
+    for _ in range(len(pools)):
+        with _pool_lock:
+            pool = pools[_next_replica % len(pools)]
+            _next_replica += 1
+        if pool.down_until > time.monotonic():
+            continue
+        
+        conn = None
+        try:
+            conn = pool.acquire()
+            if min_lsn is None or _replayed(conn, min_lsn, REPLICA_WAIT_TIMEOUT):
+                return conn
+        except psycopg2.OperationalError:
+            pool.down_until = time.monotonic() + REPLICA_RETRY_AFTER
+            if conn is not None:
+                pool.release(conn)
+            continue
+        
+        # Too far behind: the primary answers instead of trying the others,
+        # which are unlikely to be much further along
+        pool.release(conn)
+        return None
+    return None
+
+def acquire(readonly: bool = False, min_lsn: Optional[str] = None) -> PooledConnection:
+    '''
+    A primary connection, or with readonly=True one to a replica that has
+    replayed min_lsn when replicas are configured.
+    '''
+    with metrics.phase('acquire'):
+        if readonly and REPLICA_URLS:
+            conn = _acquire_replica(min_lsn)
+            if conn is not None:
+                return conn
+        return get_pool().acquire()
+
+def release(conn: PooledConnection) -> None:
+    conn.pool.release(conn)
+
+class Statement:
+    '''
+    A query prepared once per connection. The SQL uses psycopg2
+    placeholders, either all %s or all %(name)s, which are numbered $1, $2,
+    ... for PREPARE and filled in by EXECUTE.
+    '''
+    def __init__(self, name: str, sql: str) -> None:
+        self.name = name
+        self.sql = sql
+        names: List[str] = []
+        positional = 0
+        
+        def number(match: Any) -> str:
+            nonlocal positional
+            if match.group(0) == '%%':
+                return '%'
+            if match.group(1) is None:
+                positional += 1
+                return '$%d' % positional
+            if match.group(1) not in names:
+                names.append(match.group(1))
+            return '$%d' % (names.index(match.group(1)) + 1)
+        
+        body = PLACEHOLDER_RE.sub(number, sql)
+        if names and positional:
+            raise ValueError('statement %s mixes %%s and %%(name)s placeholders' % name)
+        self.prepare_sql = 'PREPARE %s AS %s' % (name, body)
+        if names:
+            self.execute_sql = 'EXECUTE %s (%s)' % (name, ', '.join('%%(%s)s' % n for n in names))
+        elif positional:
+            self.execute_sql = 'EXECUTE %s (%s)' % (name, ', '.join(['%s'] * positional))
+        else:
+            self.execute_sql = 'EXECUTE %s' % name
+    
+    def prepare(self, cur: Any) -> None:
+        conn = cur.connection
+        if self.name not in conn.prepared:
+            with metrics.phase('prepare'):
+                cur.execute(self.prepare_sql)
+            # Prepared statements belong to the session and survive rollback
+            conn.prepared.add(self.name)
+    
+    def execute(self, cur: Any, params: Any = None) -> None:
+        if not PREPARE_STATEMENTS:
+            cur.execute(self.sql, params)
+            return
+        self.prepare(cur)
+        cur.execute(self.execute_sql, params)
+
+_statements: Dict[str, Statement] = {}
+
+def statement(name: str, sql: str) -> Statement:
+    '''
+    The registered statement for sql, named after name and a hash of the
+    text so that variants of one query built at runtime get distinct names.
+    '''
+    full_name = '%s_%s' % (name, hashlib.md5(sql.encode()).hexdigest()[:8])
+    registered = _statements.get(full_name)
+    if registered is None:
+        with _pool_lock:
+            registered = _statements.setdefault(full_name, Statement(full_name, sql))
+    return registered
+
+def warm_up() -> None:
+    '''
+    Open a primary connection (and a replica one when replicas are set) and
+    prepare every registered statement on it, so the first request of a
+    container neither connects nor parses SQL. Failing to connect is only
+    logged: requests connect on their own as before.
+    '''
+    if not WARM_UP or 'DATABASE_URL' not in os.environ:
+        return
+    start = time.perf_counter()
+    conns: List[PooledConnection] = []
+    prepared = 0
+    try:
+        conns.append(get_pool().acquire())
+        if REPLICA_URLS:
+            replica = _acquire_replica(None)
+            if replica is not None:
+                conns.append(replica)
+        for conn in conns:
+            with conn.cursor() as cur:
+                for registered in list(_statements.values()) if PREPARE_STATEMENTS else []:
+                    registered.prepare(cur)
+                    prepared += 1
+    except psycopg2.Error as exc:
+        print(json.dumps({'metric': 'warm_up', 'error': str(exc).strip()}))
+        return
+    finally:
+        for conn in conns:
+            release(conn)
+    print(json.dumps({'metric': 'warm_up', 'ms': round((time.perf_counter() - start) * 1000, 2), 'prepared': prepared}))
+
+def write_token(conn: PooledConnection) -> Optional[str]:
+    '''
+    WAL position covering the transaction the caller just committed on the
+    primary; None when there are no replicas to wait for.
+    '''
+    if not REPLICA_URLS or getattr(conn, 'replica', False):
+        return None
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_current_wal_lsn()::text")
+        token = cur.fetchone()[0]
+    conn.rollback()
+    return token
+
+def token_headers(token: Optional[str]) -> Dict[str, str]:
+    if token is None:
+        return {}
+    return {'X-Lsn': token, 'Access-Control-Expose-Headers': 'X-Lsn'}
\ No newline at end of file
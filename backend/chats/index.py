@@ -1,11 +1,105 @@
 import json
-import os
 from typing import Dict, Any
 
+import psycopg2
+import psycopg2.extras
+
+import conditional
+import db
+import metrics
+import ratelimit
+import session
+import user_cache
+
+UNREAD_COUNT_LIMIT = 100
+
+# One round trip: last message fields are denormalized onto chats, the other
+# member of a private chat comes from a lateral join and unread counts walk
+# (chat_id, id) past the member's read watermark, pruned to the partitions
+# after its timestamp (allowing for ids and created_at being a little out of
+# step across transactions).
+CHATS_QUERY = """
+    SELECT c.id, c.type, c.name, c.avatar_url, c.owner_id, c.updated_at,
+           c.last_message_preview AS last_message, c.last_message_at AS last_message_time,
+           ou.user_id AS other_user_id,
+           (
+               SELECT COUNT(*) FROM (
+                   SELECT 1 FROM messages m
+                   WHERE m.chat_id = c.id AND m.id > cm.last_read_message_id AND m.sender_id != cm.user_id
+                     AND m.created_at >= COALESCE(cm.last_read_at - interval '1 minute', '-infinity')
+                   LIMIT %(unread_limit)s
+               ) unread
+           ) AS unread_count
+    FROM chat_members cm
+    INNER JOIN chats c ON c.id = cm.chat_id
+    LEFT JOIN LATERAL (
+        SELECT om.user_id
+        FROM chat_members om
+        WHERE om.chat_id = c.id AND om.user_id != cm.user_id
+        LIMIT 1
+    ) ou ON c.type = 'private'
+    WHERE cm.user_id = %(user_id)s
+"""
+
+# Version stamp of the chat list: membership, the sends each chat has seen
+# (applied by the outbox drain plus those still queued in message_outbox,
+# so a message committed after a newer id counts too), the user's read
+# watermarks, which drive unread counts, and the profiles of the other
+# members shown on private chats.
+CHATS_VERSION = db.statement('chats_version', """
+    SELECT COUNT(*) AS chats, COALESCE(SUM(c.id), 0) AS chat_ids, MAX(c.updated_at) AS updated_at,
+           COALESCE(SUM(c.message_version), 0) AS message_versions,
+           COALESCE(SUM((SELECT COUNT(*) FROM message_outbox o WHERE o.chat_id = c.id)), 0) AS pending_messages,
+           COALESCE(SUM(cm.last_read_message_id), 0) AS read_sum,
+           (
+               SELECT MAX(u.updated_at)
+               FROM chat_members mine
+               INNER JOIN chats pc ON pc.id = mine.chat_id AND pc.type = 'private'
+               INNER JOIN chat_members om ON om.chat_id = pc.id AND om.user_id != mine.user_id
+               INNER JOIN users u ON u.id = om.user_id
+               WHERE mine.user_id = %(user_id)s
+           ) AS profiles_updated_at
+    FROM chat_members cm
+    INNER JOIN chats c ON c.id = cm.chat_id
+    WHERE cm.user_id = %(user_id)s
+""")
+
+CHATS_LIST = db.statement('chats_list', CHATS_QUERY + " ORDER BY c.updated_at DESC")
+
+CHATS_RENDER = db.statement('chats_render', """
+    SELECT json_build_object('chats', COALESCE(json_agg(
+        jsonb_build_object(
+            'id', chat.id,
+            'type', chat.type,
+            'name', chat.name,
+            'avatar_url', chat.avatar_url,
+            'owner_id', chat.owner_id,
+            'last_message', chat.last_message,
+            'last_message_time', chat.last_message_time,
+            'unread_count', chat.unread_count
+        ) || CASE WHEN u.id IS NULL THEN '{}'::jsonb ELSE jsonb_build_object('other_user', jsonb_build_object(
+            'id', u.id, 'username', u.username, 'nickname', u.nickname, 'avatar_url', u.avatar_url
+        )) END
+        ORDER BY chat.updated_at DESC
+    ), '[]'))::text AS body
+    FROM (""" + CHATS_QUERY + """) chat
+    LEFT JOIN users u ON u.id = chat.other_user_id
+""")
+
+def render_chats(cur: Any, user_id: int) -> str:
+    '''
+    The chat list response assembled by Postgres and returned as text, with
+    no per-row Python objects. other_user is joined from users instead of
+    the in-process cache.
+    '''
+    CHATS_RENDER.execute(cur, {'unread_limit': UNREAD_COUNT_LIMIT, 'user_id': user_id})
+    return cur.fetchone()['body']
+
+@metrics.instrumented('chats')
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Manage chats - create, list, get members
-    Args: event with httpMethod, body, queryStringParameters; context with request_id
+    Args: event with httpMethod, body, queryStringParameters (user_id, render); context with request_id
     Returns: HTTP response with chats data
     '''
     method: str = event.get('httpMethod', 'GET')
@@ -16,42 +110,84 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id',
+                'Access-Control-Allow-Headers': 'Content-Type, Authorization, If-None-Match, X-Min-Lsn',
                 'Access-Control-Max-Age': '86400'
             },
             'body': ''
         }
     
-    import psycopg2
-    import psycopg2.extras
+    params = event.get('queryStringParameters') or {}
+    body_data = json.loads(event.get('body', '{}')) if method == 'POST' else {}
+    
+    try:
+        if method == 'GET':
+            current = session.authorize(event, params.get('user_id'))
+        else:
+            current = session.authorize(event, body_data.get('creator_id') if isinstance(body_data, dict) else None)
+    except session.Denied as denied:
+        return denied.response()
+    
+    # Buckets are keyed on the token's user, so a request without user_id in
+    # the query still lands in its own bucket
+    if current is not None:
+        acting_user_id = current.user_id
+    elif method == 'GET':
+        acting_user_id = params.get('user_id')
+    else:
+        acting_user_id = body_data.get('creator_id') if isinstance(body_data, dict) else None
     
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        admission = ratelimit.admit(event, 'chats', 'poll' if method == 'GET' else 'write', acting_user_id)
+    except ratelimit.Rejected as rejected:
+        return rejected.response()
+    
+    try:
+        conn = db.acquire(readonly=method == 'GET', min_lsn=db.requested_lsn(event))
+    except psycopg2.Error:
+        admission.leave()
+        raise
     cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
     
     try:
         if method == 'GET':
-            params = event.get('queryStringParameters', {})
-            user_id = params.get('user_id')
+            user_cache.cache.listen(conn)
+            user_id = current.user_id if current is not None else params.get('user_id')
             
             if not user_id:
                 return {
                     'statusCode': 400,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'user_id required'})
+                    'body': metrics.dumps({'error': 'user_id required'})
                 }
             
-            cur.execute("""
-                SELECT DISTINCT c.id, c.type, c.name, c.avatar_url, c.owner_id, c.updated_at,
-                       (SELECT content FROM messages WHERE chat_id = c.id ORDER BY created_at DESC LIMIT 1) as last_message,
-                       (SELECT created_at FROM messages WHERE chat_id = c.id ORDER BY created_at DESC LIMIT 1) as last_message_time
-                FROM chats c
-                INNER JOIN chat_members cm ON c.id = cm.chat_id
-                WHERE cm.user_id = %s
-                ORDER BY c.updated_at DESC
-            """, (user_id,))
+            CHATS_VERSION.execute(cur, {'user_id': user_id})
+            version = cur.fetchone()
+            etag = conditional.make_etag(
+                user_id, version['chats'], version['chat_ids'], version['updated_at'], version['message_versions'],
+                version['pending_messages'], version['read_sum'], version['profiles_updated_at']
+            )
+            
+            if conditional.etag_matches(event, etag):
+                return conditional.not_modified(etag)
+            
+            if params.get('render') == 'db':
+                return {
+                    'statusCode': 200,
+                    'headers': dict(
+                        {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        **conditional.cache_headers(etag)
+                    ),
+                    'body': render_chats(cur, user_id)
+                }
+            
+            # User summaries are served from the in-process cache
+            CHATS_LIST.execute(cur, {'unread_limit': UNREAD_COUNT_LIMIT, 'user_id': user_id})
             
             chats = cur.fetchall()
             chats_list = []
+            other_users = user_cache.cache.get_many(
+                conn, [chat['other_user_id'] for chat in chats if chat['other_user_id'] is not None]
+            )
             
             for chat in chats:
                 chat_data = {
@@ -61,36 +197,25 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'avatar_url': chat['avatar_url'],
                     'owner_id': chat['owner_id'],
                     'last_message': chat['last_message'],
-                    'last_message_time': chat['last_message_time'].isoformat() if chat['last_message_time'] else None
+                    'last_message_time': chat['last_message_time'].isoformat() if chat['last_message_time'] else None,
+                    'unread_count': chat['unread_count']
                 }
                 
-                if chat['type'] == 'private':
-                    cur.execute("""
-                        SELECT u.id, u.username, u.nickname, u.avatar_url
-                        FROM users u
-                        INNER JOIN chat_members cm ON u.id = cm.user_id
-                        WHERE cm.chat_id = %s AND u.id != %s
-                        LIMIT 1
-                    """, (chat['id'], user_id))
-                    other_user = cur.fetchone()
-                    if other_user:
-                        chat_data['other_user'] = {
-                            'id': other_user['id'],
-                            'username': other_user['username'],
-                            'nickname': other_user['nickname'],
-                            'avatar_url': other_user['avatar_url']
-                        }
+                if chat['other_user_id'] in other_users:
+                    chat_data['other_user'] = other_users[chat['other_user_id']]
                 
                 chats_list.append(chat_data)
             
             return {
                 'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'chats': chats_list})
+                'headers': dict(
+                    {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    **conditional.cache_headers(etag)
+                ),
+                'body': metrics.dumps({'chats': chats_list})
             }
         
         elif method == 'POST':
-            body_data = json.loads(event.get('body', '{}'))
             chat_type = body_data.get('type')
             creator_id = body_data.get('creator_id')
             name = body_data.get('name')
@@ -101,44 +226,99 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 return {
                     'statusCode': 400,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'type and creator_id required'})
+                    'body': metrics.dumps({'error': 'type and creator_id required'})
+                }
+            
+            try:
+                creator_id = int(creator_id)
+                # A list of ints only: the string "12" would iterate as
+                # members 1 and 2, and int() would take true for 1
+                if not isinstance(member_ids, list) or not all(
+                    isinstance(mid, int) and not isinstance(mid, bool) for mid in member_ids
+                ):
+                    raise TypeError(member_ids)
+                all_member_ids = list(dict.fromkeys([creator_id] + member_ids))
+            except (TypeError, ValueError):
+                return {
+                    'statusCode': 400,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': metrics.dumps({'error': 'creator_id must be an integer and member_ids a list of integers'})
                 }
             
             owner_id = creator_id if chat_type == 'group' else None
+            private_key = None
+            
+            if chat_type == 'private':
+                if len(all_member_ids) != 2:
+                    return {
+                        'statusCode': 400,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': metrics.dumps({'error': 'private chat requires exactly one other member'})
+                    }
+                # Canonical pair key: one private chat per pair of users
+                private_key = '%d:%d' % (min(all_member_ids), max(all_member_ids))
             
             cur.execute("""
-                INSERT INTO chats (type, name, avatar_url, owner_id)
-                VALUES (%s, %s, %s, %s)
+                INSERT INTO chats (type, name, avatar_url, owner_id, private_key)
+                VALUES (%s, %s, %s, %s, %s)
+                ON CONFLICT (private_key) WHERE private_key IS NOT NULL DO NOTHING
                 RETURNING id
-            """, (chat_type, name, avatar_url, owner_id))
+            """, (chat_type, name, avatar_url, owner_id, private_key))
             
-            chat_id = cur.fetchone()['id']
+            created = cur.fetchone()
             
-            all_member_ids = [creator_id] + [mid for mid in member_ids if mid != creator_id]
+            if created is None:
+                cur.execute("SELECT id FROM chats WHERE private_key = %s", (private_key,))
+                chat_id = cur.fetchone()['id']
+                conn.commit()
+                token = db.write_token(conn)
+                
+                return {
+                    'statusCode': 200,
+                    'headers': dict({'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}, **db.token_headers(token)),
+                    'body': metrics.dumps({
+                        'success': True,
+                        'chat_id': chat_id,
+                        'created': False
+                    })
+                }
             
-            for member_id in all_member_ids:
-                cur.execute("""
-                    INSERT INTO chat_members (chat_id, user_id)
-                    VALUES (%s, %s)
-                """, (chat_id, member_id))
+            chat_id = created['id']
+            
+            cur.execute("""
+                INSERT INTO chat_members (chat_id, user_id)
+                SELECT %s, unnest(%s::int[])
+                ON CONFLICT (chat_id, user_id) DO NOTHING
+            """, (chat_id, all_member_ids))
+            
+            cur.execute(
+                "SELECT pg_notify('user_' || member_id, %s) FROM unnest(%s::int[]) AS member_id",
+                (str(chat_id), all_member_ids)
+            )
             
             conn.commit()
+            token = db.write_token(conn)
             
             return {
                 'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({
+                'headers': dict({'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}, **db.token_headers(token)),
+                'body': metrics.dumps({
                     'success': True,
-                    'chat_id': chat_id
+                    'chat_id': chat_id,
+                    'created': True
                 })
             }
         
         return {
             'statusCode': 405,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Method not allowed'})
+            'body': metrics.dumps({'error': 'Method not allowed'})
         }
     
     finally:
         cur.close()
-        conn.close()
+        db.release(conn)
+        admission.leave()
+
+# Runs once per container, when the platform imports this module
+db.warm_up()
\ No newline at end of file
@@ -0,0 +1,338 @@
+'''
+Admission control in front of the database. Every request first takes a
+token from a per-user, per-endpoint, per-class bucket (429 when empty),
+then a slot from the container's concurrency gate. Reads only get slots
+while ADMISSION_WRITE_RESERVE of them stay free for writes and no write is
+queued; they wait up to ADMISSION_READ_WAIT seconds and are shed with 503
+after that, so a polling storm cannot use up the connection budget that
+sends and mark-read need. Long-poll waits spend most of their time idle and
+are counted apart, up to ADMISSION_MAX_WAITS, so they never take the slots
+ordinary polls need. Both rejections carry Retry-After.
+
+ADMISSION_GLOBAL_MAX_CONCURRENCY caps slots across all containers: each
+one registers in admission_containers every ADMISSION_GLOBAL_REFRESH
+seconds and sizes its gate to an even share of the cap. Containers that
+stop refreshing drop out after three intervals, so the cap can be exceeded
+only briefly while one comes up. Without it ADMISSION_MAX_CONCURRENCY
+applies to each container.
+
+Buckets live in memory (RATE_LIMIT_BACKEND=memory, per container) or in
+the UNLOGGED rate_limit_buckets table (RATE_LIMIT_BACKEND=postgres, shared
+by all containers, primary only). The Postgres backend fails open.
+Limits are RATE_LIMIT_<CLASS>=<tokens per second>/<burst>.
+Each function ships its own copy of this module.
+'''
+import math
+import os
+import threading
+import time
+import uuid
+from typing import Any, Dict, Optional, Tuple
+
+import psycopg2
+
+import metrics
+
+ENABLED = os.environ.get('RATE_LIMIT_ENABLED', '1') != '0'
+BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'memory')
+MAX_CONCURRENCY = int(os.environ.get('ADMISSION_MAX_CONCURRENCY', '32'))
+WRITE_RESERVE = int(os.environ.get('ADMISSION_WRITE_RESERVE', '8'))
+READ_WAIT = float(os.environ.get('ADMISSION_READ_WAIT', '0.5'))
+WRITE_WAIT = float(os.environ.get('ADMISSION_WRITE_WAIT', '5'))
+MAX_WAITS = int(os.environ.get('ADMISSION_MAX_WAITS', '64'))
+GLOBAL_MAX_CONCURRENCY = int(os.environ.get('ADMISSION_GLOBAL_MAX_CONCURRENCY', '0'))
+GLOBAL_REFRESH = float(os.environ.get('ADMISSION_GLOBAL_REFRESH', '10'))
+BUCKET_IDLE_TTL = float(os.environ.get('RATE_LIMIT_IDLE_TTL', '600'))
+SWEEP_INTERVAL = float(os.environ.get('RATE_LIMIT_SWEEP_INTERVAL', '60'))
+SWEEP_LOCK_ID = 0x726c696d
+
+DEFAULT_LIMITS = {
+    'poll': '2/20',
+    'wait': '1/10',
+    'search': '1/10',
+    'export': '2/20',
+    'write': '10/100'
+}
+WRITE_CLASSES = ('write',)
+WAIT_CLASSES = ('wait',)
+
+def parse_limit(request_class: str, value: str) -> Tuple[float, float]:
+    '''
+    (rate, burst) from "<tokens per second>/<burst>". A bucket that never
+    refills or never holds a whole token would turn away every request, so
+    those are refused when the module loads.
+    '''
+    rate, burst = value.split('/')
+    rate_value, burst_value = float(rate), float(burst)
+    if not rate_value > 0 or not burst_value >= 1:
+        raise ValueError('RATE_LIMIT_%s=%s: rate must be above 0 and burst at least 1' % (request_class.upper(), value))
+    return rate_value, burst_value
+
+LIMITS = {
+    request_class: parse_limit(request_class, os.environ.get('RATE_LIMIT_%s' % request_class.upper(), default))
+    for request_class, default in DEFAULT_LIMITS.items()
+}
+
+class Rejected(Exception):
+    def __init__(self, status: int, retry_after: float, error: str) -> None:
+        super().__init__(error)
+        self.status = status
+        self.retry_after = retry_after
+        self.error = error
+
+    def response(self) -> Dict[str, Any]:
+        return {
+            'statusCode': self.status,
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Expose-Headers': 'Retry-After',
+                'Retry-After': str(max(1, math.ceil(self.retry_after)))
+            },
+            'body': metrics.dumps({'error': self.error, 'retry_after': round(self.retry_after, 2)})
+        }
+
+class MemoryBackend:
+    '''
+    Buckets in a dict; full buckets idle past BUCKET_IDLE_TTL are pruned.
+    '''
+    def __init__(self) -> None:
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+        self._lock = threading.Lock()
+        self._next_sweep_at = 0.0
+
+    def take(self, key: str, rate: float, burst: float, cost: float = 1.0) -> float:
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated_at) * rate)
+            retry_after = 0.0
+            if tokens >= cost:
+                tokens -= cost
+            else:
+                retry_after = (cost - tokens) / rate
+            self._buckets[key] = (tokens, now)
+
+            if now >= self._next_sweep_at:
+                self._next_sweep_at = now + SWEEP_INTERVAL
+                for stale in [k for k, (_, at) in self._buckets.items() if now - at > BUCKET_IDLE_TTL]:
+                    del self._buckets[stale]
+        return retry_after
+
+class PostgresBackend:
+    '''
+    Buckets in rate_limit_buckets through rate_limit_take(), on a dedicated
+    autocommit connection so checks never join a handler's transaction.
+    '''
+    def __init__(self, dsn: str) -> None:
+        self.dsn = dsn
+        self._conn: Optional[Any] = None
+        self._lock = threading.Lock()
+        self._next_sweep_at = 0.0
+
+    def _connection(self) -> Any:
+        if self._conn is None or self._conn.closed:
+            self._conn = psycopg2.connect(self.dsn, connect_timeout=2)
+            self._conn.autocommit = True
+        return self._conn
+
+    def take(self, key: str, rate: float, burst: float, cost: float = 1.0) -> float:
+        with self._lock:
+            try:
+                with self._connection().cursor() as cur:
+                    cur.execute("SELECT rate_limit_take(%s, %s, %s, %s)", (key, rate, burst, cost))
+                    retry_after = cur.fetchone()[0]
+                    self._maybe_sweep(cur)
+                return retry_after
+            except psycopg2.Error as error:
+                print('rate limit backend unavailable: %s' % error)
+                if self._conn is not None:
+                    self._conn.close()
+                return 0.0
+
+    def _maybe_sweep(self, cur: Any) -> None:
+        now = time.monotonic()
+        if now < self._next_sweep_at:
+            return
+        self._next_sweep_at = now + SWEEP_INTERVAL
+        cur.execute("BEGIN")
+        cur.execute("SELECT pg_try_advisory_xact_lock(%s)", (SWEEP_LOCK_ID,))
+        if cur.fetchone()[0]:
+            cur.execute(
+                "DELETE FROM rate_limit_buckets WHERE updated_at < LOCALTIMESTAMP - make_interval(secs => %s)",
+                (BUCKET_IDLE_TTL,)
+            )
+        cur.execute("COMMIT")
+
+class AdmissionGate:
+    '''
+    Counting semaphore with two priorities: writes may use every slot,
+    reads leave write_reserve free and yield to queued writes. Long-poll
+    waits have their own count and never queue.
+    '''
+    def __init__(self, max_concurrency: int = MAX_CONCURRENCY, write_reserve: int = WRITE_RESERVE,
+                 max_waits: int = MAX_WAITS) -> None:
+        self.write_reserve = write_reserve
+        self.max_waits = max_waits
+        self.waits = 0
+        self.in_flight = 0
+        self.waiting_writes = 0
+        self.shed = 0
+        self._cond = threading.Condition()
+        self.resize(max_concurrency)
+
+    def resize(self, max_concurrency: int) -> None:
+        '''
+        Change the number of slots. Requests already in keep theirs; the
+        reserve shrinks with a small gate so reads still get half of it.
+        '''
+        with self._cond:
+            self.max_concurrency = max_concurrency
+            self.read_limit = max(1, max_concurrency - min(self.write_reserve, max_concurrency // 2))
+            self._cond.notify_all()
+
+    def _can_enter(self, write: bool) -> bool:
+        if write:
+            return self.in_flight < self.max_concurrency
+        return self.in_flight < self.read_limit and not self.waiting_writes
+
+    def enter(self, write: bool) -> None:
+        deadline = time.monotonic() + (WRITE_WAIT if write else READ_WAIT)
+        with self._cond:
+            if write:
+                self.waiting_writes += 1
+            try:
+                while not self._can_enter(write):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.shed += 1
+                        raise Rejected(503, WRITE_WAIT if write else READ_WAIT, 'Server busy, retry later')
+                    self._cond.wait(remaining)
+                self.in_flight += 1
+            finally:
+                if write:
+                    self.waiting_writes -= 1
+
+    def leave(self) -> None:
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def enter_wait(self) -> None:
+        with self._cond:
+            if self.waits >= self.max_waits:
+                self.shed += 1
+                raise Rejected(503, READ_WAIT, 'Server busy, retry later')
+            self.waits += 1
+
+    def leave_wait(self) -> None:
+        with self._cond:
+            self.waits -= 1
+
+class Admission:
+    '''
+    A granted gate slot; leave() is safe to call more than once.
+    '''
+    def __init__(self, gate: Optional[AdmissionGate], wait: bool = False) -> None:
+        self._gate = gate
+        self._wait = wait
+
+    def leave(self) -> None:
+        gate, self._gate = self._gate, None
+        if gate is not None:
+            if self._wait:
+                gate.leave_wait()
+            else:
+                gate.leave()
+
+class GlobalBudget:
+    '''
+    This container's share of GLOBAL_MAX_CONCURRENCY. Refreshing registers
+    the container and counts the live ones on a dedicated autocommit
+    connection, at most every refresh_interval seconds and by one thread at
+    a time; the others go on with the current size. Fails open: on errors
+    the gate keeps its size.
+    '''
+    def __init__(self, dsn: str, total: int, refresh_interval: float) -> None:
+        self.dsn = dsn
+        self.total = total
+        self.refresh_interval = refresh_interval
+        self.container_id = uuid.uuid4().hex
+        self.live = 1
+        self._conn: Optional[Any] = None
+        self._lock = threading.Lock()
+        self._next_refresh_at = 0.0
+
+    def _connection(self) -> Any:
+        if self._conn is None or self._conn.closed:
+            self._conn = psycopg2.connect(self.dsn, connect_timeout=2)
+            self._conn.autocommit = True
+        return self._conn
+
+    def refresh(self, gate: AdmissionGate) -> None:
+        if time.monotonic() < self._next_refresh_at or not self._lock.acquire(blocking=False):
+            return
+        try:
+            self._next_refresh_at = time.monotonic() + self.refresh_interval
+            with self._connection().cursor() as cur:
+                cur.execute("""
+                    INSERT INTO admission_containers (id, seen_at) VALUES (%s, LOCALTIMESTAMP)
+                    ON CONFLICT (id) DO UPDATE SET seen_at = EXCLUDED.seen_at
+                """, (self.container_id,))
+                cur.execute(
+                    "DELETE FROM admission_containers WHERE seen_at < LOCALTIMESTAMP - make_interval(secs => %s)",
+                    (self.refresh_interval * 3,)
+                )
+                cur.execute("SELECT COUNT(*) FROM admission_containers")
+                self.live = max(1, cur.fetchone()[0])
+            gate.resize(max(1, min(MAX_CONCURRENCY, self.total // self.live)))
+        except psycopg2.Error as error:
+            print('admission budget unavailable: %s' % error)
+            if self._conn is not None:
+                self._conn.close()
+        finally:
+            self._lock.release()
+
+_backend: Optional[Any] = None
+_backend_lock = threading.Lock()
+gate = AdmissionGate(min(MAX_CONCURRENCY, GLOBAL_MAX_CONCURRENCY) if GLOBAL_MAX_CONCURRENCY > 0 else MAX_CONCURRENCY)
+budget = GlobalBudget(os.environ.get('DATABASE_URL', ''), GLOBAL_MAX_CONCURRENCY, GLOBAL_REFRESH) if GLOBAL_MAX_CONCURRENCY > 0 else None
+
+def get_backend() -> Any:
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = PostgresBackend(os.environ['DATABASE_URL']) if BACKEND == 'postgres' else MemoryBackend()
+    return _backend
+
+def client_identity(event: Dict[str, Any], user_id: Any) -> str:
+    '''
+    The user id the request acts for, else the caller's address.
+    '''
+    if user_id:
+        return 'u%s' % user_id
+    source_ip = ((event.get('requestContext') or {}).get('identity') or {}).get('sourceIp')
+    return 'ip%s' % source_ip if source_ip else 'anonymous'
+
+def admit(event: Dict[str, Any], endpoint: str, request_class: str, user_id: Any = None) -> Admission:
+    '''
+    Take a token and a gate slot or raise Rejected. Call leave() on the
+    result once the database connection has been released.
+    '''
+    if not ENABLED:
+        return Admission(None)
+
+    rate, burst = LIMITS[request_class]
+    key = '%s:%s:%s' % (endpoint, request_class, client_identity(event, user_id))
+    retry_after = get_backend().take(key, rate, burst)
+    if retry_after > 0:
+        raise Rejected(429, retry_after, 'Too many requests')
+
+    if request_class in WAIT_CLASSES:
+        gate.enter_wait()
+        return Admission(gate, wait=True)
+    if budget is not None:
+        budget.refresh(gate)
+    gate.enter(request_class in WRITE_CLASSES)
+    return Admission(gate)
\ No newline at end of file
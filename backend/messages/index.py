@@ -1,12 +1,528 @@
+import io
 import json
 import os
-from typing import Dict, Any
-from datetime import datetime
+import time
+from typing import Dict, Any, List, Optional, Tuple
+from datetime import datetime, timedelta
 
+import psycopg2
+import psycopg2.extras
+
+import conditional
+import db
+import listener
+import metrics
+import outbox
+import ratelimit
+import session
+import user_cache
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+LONG_POLL_TIMEOUT = 25
+MAX_BATCH_SIZE = 500
+MAX_SEARCH_OFFSET = 1000
+RECENT_WINDOW_DAYS = 31
+ID_ORDER_SLACK = timedelta(minutes=1)
+EXPORT_ITERSIZE = int(os.environ.get('EXPORT_ITERSIZE', '2000'))
+EXPORT_CHUNK_BYTES = int(os.environ.get('EXPORT_CHUNK_BYTES', str(4 * 1024 * 1024)))
+
+# Version stamp of a chat page: how many sends the chat has seen (applied
+# plus still queued, so a message committed after a newer id changes it
+# too) and, for read receipts, the highest message any other member has
+# read. last_message_id lets polls skip the page query; is_member decides
+# whether the reader may see the chat at all.
+MESSAGES_VERSION = db.statement('messages_version', """
+    SELECT """ + outbox.PENDING_LAST_MESSAGE + """ AS last_message_id,
+           c.message_version, """ + outbox.PENDING_MESSAGES + """ AS pending_messages,
+           (
+               SELECT COALESCE(MAX(cm.last_read_message_id), 0)
+               FROM chat_members cm
+               WHERE cm.chat_id = c.id AND cm.user_id != %(user_id)s
+           ) AS read_up_to,
+           EXISTS (
+               SELECT 1 FROM chat_members cm
+               WHERE cm.chat_id = c.id AND cm.user_id = %(user_id)s
+           ) AS is_member,
+           LOCALTIMESTAMP - make_interval(days => %(window_days)s) AS window_start,
+           c.created_at AS chat_created_at
+    FROM chats c
+    WHERE c.id = %(chat_id)s
+""")
+
+# The watermark never passes the chat's newest message and never moves
+# back, whatever up_to_id the client sends
+MARK_READ_UP_TO = db.statement('messages_mark_read_up_to', """
+    UPDATE chat_members cm
+    SET last_read_message_id = t.up_to_id,
+        last_read_at = COALESCE(
+            (SELECT m.created_at FROM messages m WHERE m.chat_id = cm.chat_id AND m.id = t.up_to_id),
+            cm.last_read_at
+        )
+    FROM (
+        SELECT LEAST(%(up_to_id)s, COALESCE(""" + outbox.PENDING_LAST_MESSAGE + """, 0)) AS up_to_id
+        FROM chats c
+        WHERE c.id = %(chat_id)s
+    ) t
+    WHERE cm.chat_id = %(chat_id)s AND cm.user_id = %(user_id)s AND cm.last_read_message_id < t.up_to_id
+""")
+
+MARK_READ_MESSAGE = db.statement('messages_mark_read', """
+    UPDATE chat_members cm
+    SET last_read_message_id = m.id,
+        last_read_at = m.created_at
+    FROM messages m
+    WHERE m.id = %s AND cm.chat_id = m.chat_id AND cm.user_id = %s
+      AND cm.last_read_message_id < m.id
+""")
+
+# First message of a send whose sender is not a member of its chat (which
+# also covers chats that do not exist)
+FIRST_NON_MEMBER_SEND = db.statement('messages_first_non_member_send', """
+    SELECT s.i - 1 AS index
+    FROM unnest(%s::int[], %s::int[]) WITH ORDINALITY AS s(chat_id, sender_id, i)
+    WHERE NOT EXISTS (
+        SELECT 1 FROM chat_members cm WHERE cm.chat_id = s.chat_id AND cm.user_id = s.sender_id
+    )
+    ORDER BY s.i
+    LIMIT 1
+""")
+
+def wait_for_updates(user_id: int, cursor: Optional[int], timeout: float) -> Dict[str, Any]:
+    '''
+    Block until a message newer than cursor lands in one of the user's chats,
+    the user is added to a chat, or timeout expires. Driven by LISTEN/NOTIFY:
+    messages POST notifies chat_<id>, chats POST notifies user_<id>. The
+    pooled connection is only held to read the latest ids; the wait itself
+    is on the container's shared listener.
+    '''
+    waiter = None
+    conn = db.acquire()
+    try:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        cur.execute("SELECT chat_id FROM chat_members WHERE user_id = %s", (user_id,))
+        channels = ['user_%d' % user_id] + ['chat_%d' % row['chat_id'] for row in cur.fetchall()]
+        
+        # Subscribe before reading the latest ids so nothing slips in between
+        if cursor is not None:
+            waiter = listener.get_listener().subscribe(channels)
+        cur.execute("""
+            SELECT cm.chat_id, """ + outbox.PENDING_LAST_MESSAGE + """ AS message_id
+            FROM chat_members cm
+            INNER JOIN chats c ON c.id = cm.chat_id
+            WHERE cm.user_id = %s
+        """, (user_id,))
+        latest = [row for row in cur.fetchall() if row['message_id'] is not None]
+        cur.close()
+    except BaseException:
+        if waiter is not None:
+            listener.get_listener().unsubscribe(waiter)
+        raise
+    finally:
+        db.release(conn)
+    
+    latest_id = max([row['message_id'] for row in latest], default=0)
+    if waiter is None:
+        return {'updates': [], 'chats_changed': False, 'cursor': latest_id}
+    
+    try:
+        updates: List[Dict[str, int]] = [
+            {'chat_id': row['chat_id'], 'message_id': row['message_id']}
+            for row in latest if row['message_id'] > cursor
+        ]
+        chats_changed = False
+        deadline = time.monotonic() + timeout
+        
+        while not updates and not chats_changed and not waiter.lost:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            with metrics.phase('wait'):
+                notifies = waiter.get(remaining)
+            for channel, payload in notifies:
+                if channel.startswith('user_'):
+                    chats_changed = True
+                else:
+                    updates.append({'chat_id': int(channel[len('chat_'):]), 'message_id': int(payload)})
+        
+        return {
+            'updates': updates,
+            'chats_changed': chats_changed,
+            'cursor': max([cursor, latest_id] + [update['message_id'] for update in updates])
+        }
+    finally:
+        listener.get_listener().unsubscribe(waiter)
+
+def parse_message(data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    '''
+    Normalize one outgoing message from a request body, None if it is invalid.
+    '''
+    content = (data.get('content') or '').strip()
+    client_message_id = data.get('client_message_id')
+    
+    if not data.get('chat_id') or not data.get('sender_id') or not content:
+        return None
+    if client_message_id is not None and (not isinstance(client_message_id, str) or len(client_message_id) > 64):
+        return None
+    
+    try:
+        chat_id, sender_id = int(data['chat_id']), int(data['sender_id'])
+    except (TypeError, ValueError):
+        return None
+    
+    return {
+        'chat_id': chat_id,
+        'sender_id': sender_id,
+        'content': content,
+        'message_type': data.get('message_type', 'text'),
+        'file_url': data.get('file_url'),
+        'is_system': data.get('is_system', False),
+        'client_message_id': client_message_id
+    }
+
+def insert_messages(cur: Any, items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    '''
+    Insert messages (possibly for several chats) with one multi-row INSERT,
+    queue the chat bumps in the outbox and notify listeners. Messages whose
+    (sender_id, client_message_id) was already sent are not inserted again;
+    the stored row is returned with duplicate=True. Results keep input order.
+    '''
+    # Ids are allocated up front so results can be matched back to items
+    # without relying on the order of RETURNING rows
+    cur.execute(
+        "SELECT nextval(pg_get_serial_sequence('messages', 'id')) AS id, LOCALTIMESTAMP AS now "
+        "FROM generate_series(1, %s)",
+        (len(items),)
+    )
+    rows = cur.fetchall()
+    ids = sorted(row['id'] for row in rows)
+    now = rows[0]['now']
+    
+    # Idempotency keys live in message_client_ids (messages is partitioned
+    # by created_at, so it cannot enforce them); claiming a key decides
+    # whether its message is inserted
+    keyed = [(message_id, item) for message_id, item in zip(ids, items) if item['client_message_id']]
+    claimed = set()
+    if keyed:
+        claimed_rows = psycopg2.extras.execute_values(cur, """
+            INSERT INTO message_client_ids (sender_id, client_message_id, message_id, created_at)
+            VALUES %s
+            ON CONFLICT (sender_id, client_message_id) DO NOTHING
+            RETURNING message_id
+        """, [
+            (item['sender_id'], item['client_message_id'], message_id, now)
+            for message_id, item in keyed
+        ], page_size=len(keyed), fetch=True)
+        claimed = {row['message_id'] for row in claimed_rows}
+    
+    fresh = [
+        (message_id, item) for message_id, item in zip(ids, items)
+        if not item['client_message_id'] or message_id in claimed
+    ]
+    if fresh:
+        psycopg2.extras.execute_values(cur, """
+            INSERT INTO messages (id, chat_id, sender_id, content, message_type, file_url, is_system,
+                                  client_message_id, created_at)
+            VALUES %s
+        """, [
+            (message_id, item['chat_id'], item['sender_id'], item['content'], item['message_type'],
+             item['file_url'], item['is_system'], item['client_message_id'], now)
+            for message_id, item in fresh
+        ], page_size=len(fresh))
+    inserted = {message_id for message_id, item in fresh}
+    
+    existing = {}
+    retried = [item for message_id, item in keyed if message_id not in claimed]
+    if retried:
+        # (id, created_at) is the primary key, so each lookup hits one partition
+        cur.execute("""
+            SELECT m.id, m.created_at, k.sender_id, k.client_message_id
+            FROM message_client_ids k
+            INNER JOIN unnest(%s::int[], %s::varchar[]) AS r(sender_id, client_message_id)
+                ON k.sender_id = r.sender_id AND k.client_message_id = r.client_message_id
+            INNER JOIN messages m ON m.id = k.message_id AND m.created_at = k.created_at
+        """, ([item['sender_id'] for item in retried], [item['client_message_id'] for item in retried]))
+        existing = {(row['sender_id'], row['client_message_id']): row for row in cur.fetchall()}
+    
+    results = []
+    last_in_chat: Dict[int, Any] = {}
+    for message_id, item in zip(ids, items):
+        if message_id in inserted:
+            result = {'id': message_id, 'created_at': now, 'duplicate': False}
+            last_in_chat[item['chat_id']] = message_id
+        else:
+            row = existing[(item['sender_id'], item['client_message_id'])]
+            result = {'id': row['id'], 'created_at': row['created_at'], 'duplicate': True}
+        result['chat_id'] = item['chat_id']
+        result['client_message_id'] = item['client_message_id']
+        results.append(result)
+    
+    if last_in_chat:
+        # The chat rows are bumped by the outbox drain, after commit; the
+        # long-poll notifications go out with the commit as before
+        outbox.enqueue(cur, [(item['chat_id'], message_id, now) for message_id, item in fresh])
+        cur.execute(
+            "SELECT pg_notify('chat_' || chat_id, message_id::text) FROM unnest(%s::int[], %s::int[]) AS n(chat_id, message_id)",
+            (list(last_in_chat), list(last_in_chat.values()))
+        )
+    
+    return results
+
+# Conditions fetch_page appends to a page query, and the (created_at bound,
+# condition) pairs it uses
+PAGE_FROM_SINCE = " AND m.id >= %s ORDER BY m.id ASC LIMIT %s"
+PAGE_AFTER = " AND m.id > %s ORDER BY m.id ASC LIMIT %s"
+PAGE_BEFORE = " AND m.id < %s ORDER BY m.id DESC LIMIT %s"
+PAGE_NEWEST = " ORDER BY m.id DESC LIMIT %s"
+PAGE_VARIANTS = (
+    (True, PAGE_FROM_SINCE), (False, PAGE_AFTER),
+    (True, PAGE_BEFORE), (False, PAGE_BEFORE),
+    (True, PAGE_NEWEST), (False, PAGE_NEWEST)
+)
+
+def page_statement(bounded: bool, condition: str) -> db.Statement:
+    bound = " AND m.created_at >= %s" if bounded else ""
+    return db.statement('messages_page', """
+        SELECT m.id, m.chat_id, m.sender_id, m.content, m.message_type,
+               m.file_url, m.is_system, m.created_at
+        FROM messages m
+        WHERE m.chat_id = %s
+    """ + bound + condition)
+
+def select_messages(cur: Any, chat_id: int, window_start: Optional[datetime], condition: str,
+                    args: List[Any]) -> List[Dict[str, Any]]:
+    page_statement(window_start is not None, condition).execute(
+        cur, [chat_id] + ([window_start] if window_start is not None else []) + args
+    )
+    return cur.fetchall()
+
+def fetch_page(cur: Any, chat_id: int, since_id: Optional[int], before_id: Optional[int], limit: int,
+               window_start: datetime, chat_in_window: bool) -> List[Dict[str, Any]]:
+    '''
+    One keyset page over (chat_id, id): up to limit + 1 rows, ascending after
+    since_id, otherwise descending. The page is first read with a created_at
+    lower bound so partition pruning skips older months. Ids are allocated in
+    created_at order, so the bounded page is kept when it provably equals the
+    unbounded one; otherwise the query is repeated without the bound.
+    '''
+    if since_id is not None:
+        # The since_id row itself is read too: finding it well inside the
+        # window shows that every newer message is inside it as well
+        rows = select_messages(cur, chat_id, window_start, PAGE_FROM_SINCE, [since_id, limit + 2])
+        anchored = bool(rows) and rows[0]['id'] == since_id and rows[0]['created_at'] >= window_start + ID_ORDER_SLACK
+        if anchored or chat_in_window:
+            return [row for row in rows if row['id'] > since_id][:limit + 1]
+        return select_messages(cur, chat_id, None, PAGE_AFTER, [since_id, limit + 1])
+    
+    condition, args = (PAGE_BEFORE, [before_id]) if before_id is not None else (PAGE_NEWEST, [])
+    rows = select_messages(cur, chat_id, window_start, condition, args + [limit + 1])
+    if chat_in_window or (len(rows) > limit and rows[-1]['created_at'] >= window_start + ID_ORDER_SLACK):
+        return rows
+    return select_messages(cur, chat_id, None, condition, args + [limit + 1])
+
+def export_chunk(conn: Any, chat_id: int, after_id: int) -> Tuple[str, Optional[int]]:
+    '''
+    Next chunk of a chat's full history as NDJSON, oldest first. Rows come
+    from a named (server-side) cursor, so only EXPORT_ITERSIZE of them are
+    held at a time, and the chunk stops at about EXPORT_CHUNK_BYTES.
+    Returns the body and the after_id to continue from, None once done.
+    '''
+    out = io.StringIO()
+    
+    with conn.cursor(name='export_chat_%d' % chat_id) as cur:
+        cur.itersize = EXPORT_ITERSIZE
+        cur.execute("""
+            SELECT m.id, m.chat_id, m.sender_id, m.content, m.message_type,
+                   m.file_url, m.is_system, m.created_at
+            FROM messages m
+            WHERE m.chat_id = %s AND m.id > %s
+            ORDER BY m.id ASC
+        """, (chat_id, after_id))
+        
+        for row in cur:
+            out.write(json.dumps({
+                'id': row[0],
+                'chat_id': row[1],
+                'sender_id': row[2],
+                'content': row[3],
+                'message_type': row[4],
+                'file_url': row[5],
+                'is_system': row[6],
+                'created_at': row[7].isoformat() if row[7] else None
+            }))
+            out.write('\n')
+            if out.tell() >= EXPORT_CHUNK_BYTES:
+                return out.getvalue(), row[0]
+    
+    return out.getvalue(), None
+
+# Keyset condition and order of a rendered page: after since_id, before
+# before_id, or the newest
+RENDER_KEYSETS = (
+    (" AND m.id > %(since_id)s", "ASC"),
+    (" AND m.id < %(before_id)s", "DESC"),
+    ("", "DESC")
+)
+
+def render_statement(bounded: bool, keyset: str, direction: str) -> db.Statement:
+    bound = " AND m.created_at >= %(window_start)s" if bounded else ""
+    return db.statement('messages_render', """
+        SELECT json_build_object(
+            'messages', COALESCE(json_agg(json_build_object(
+                'id', p.id,
+                'chat_id', p.chat_id,
+                'sender_id', p.sender_id,
+                'content', p.content,
+                'message_type', p.message_type,
+                'file_url', p.file_url,
+                'is_system', p.is_system,
+                'created_at', p.created_at,
+                'sender', json_build_object('username', u.username, 'nickname', u.nickname, 'avatar_url', u.avatar_url)
+            ) ORDER BY p.id) FILTER (WHERE p.rn <= %(limit)s), '[]'),
+            'has_more', COUNT(*) > %(limit)s,
+            'read_up_to', %(read_up_to)s::int
+        )::text AS body
+        FROM (
+            SELECT page.*, ROW_NUMBER() OVER (ORDER BY page.id """ + direction + """) AS rn
+            FROM (
+                SELECT m.id, m.chat_id, m.sender_id, m.content, m.message_type,
+                       m.file_url, m.is_system, m.created_at
+                FROM messages m
+                WHERE m.chat_id = %(chat_id)s""" + bound + keyset + """
+                ORDER BY m.id """ + direction + """
+                LIMIT %(limit)s + 1
+            ) page
+        ) p
+        LEFT JOIN users u ON u.id = p.sender_id
+    """)
+
+def render_page(cur: Any, chat_id: int, since_id: Optional[int], before_id: Optional[int], limit: int,
+                window_start: Optional[datetime], read_up_to: Optional[int]) -> str:
+    '''
+    Same response as the regular page, assembled by Postgres with json_agg
+    and returned as text, so no per-row Python objects are created. The
+    created_at bound is only applied when it cannot drop rows (window_start
+    is None otherwise); senders are joined from users instead of the cache.
+    '''
+    if since_id is not None:
+        keyset, direction = RENDER_KEYSETS[0]
+    elif before_id is not None:
+        keyset, direction = RENDER_KEYSETS[1]
+    else:
+        keyset, direction = RENDER_KEYSETS[2]
+    
+    render_statement(window_start is not None, keyset, direction).execute(cur, {
+        'chat_id': chat_id, 'since_id': since_id, 'before_id': before_id, 'limit': limit,
+        'window_start': window_start, 'read_up_to': read_up_to
+    })
+    return cur.fetchone()['body']
+
+def search_statement(in_chat: bool) -> db.Statement:
+    chat_filter = "AND m.chat_id = %(chat_id)s" if in_chat else ""
+    return db.statement('messages_search', """
+        SELECT page.id, page.chat_id, page.sender_id, page.created_at, page.rank,
+               ts_headline('russian', page.content, page.query,
+                           'StartSel=**, StopSel=**, MaxWords=20, MinWords=8, MaxFragments=1') AS snippet
+        FROM (
+            SELECT m.id, m.chat_id, m.sender_id, m.created_at, m.content, q.query,
+                   ts_rank(m.content_tsv, q.query) AS rank
+            FROM messages m
+            CROSS JOIN websearch_to_tsquery('russian', %(query)s) AS q(query)
+            WHERE m.content_tsv @@ q.query
+              AND m.chat_id IN (SELECT chat_id FROM chat_members WHERE user_id = %(user_id)s)
+              """ + chat_filter + """
+            ORDER BY rank DESC, m.id DESC
+            LIMIT %(limit)s OFFSET %(offset)s
+        ) page
+        ORDER BY page.rank DESC, page.id DESC
+    """)
+
+def search_messages(cur: Any, user_id: int, query: str, chat_id: Optional[int], limit: int, offset: int) -> List[Dict[str, Any]]:
+    '''
+    Ranked full-text search over messages in the user's chats (or one of them)
+    using the content_tsv GIN index. Snippets are only built for the page.
+    '''
+    search_statement(chat_id is not None).execute(cur, {
+        'query': query, 'user_id': user_id, 'chat_id': chat_id, 'limit': limit, 'offset': offset
+    })
+    return cur.fetchall()
+
+# Register every variant of the runtime-built queries now, so warm_up()
+# prepares them along with the fixed ones
+for bounded, condition in PAGE_VARIANTS:
+    page_statement(bounded, condition)
+for bounded in (True, False):
+    for keyset, direction in RENDER_KEYSETS:
+        render_statement(bounded, keyset, direction)
+for in_chat in (True, False):
+    search_statement(in_chat)
+
+def request_class(method: str, params: Dict[str, Any]) -> str:
+    '''
+    Rate limit class of a request: sends and mark-read are writes, GETs are
+    told apart by mode.
+    '''
+    if method != 'GET':
+        return 'write'
+    if params.get('wait'):
+        return 'wait'
+    if params.get('q'):
+        return 'search'
+    if params.get('export'):
+        return 'export'
+    return 'poll'
+
+def acting_user_id(method: str, params: Dict[str, Any], body_data: Any) -> Any:
+    if method == 'GET':
+        return params.get('user_id')
+    if not isinstance(body_data, dict):
+        return None
+    if method == 'PUT':
+        return body_data.get('user_id')
+    batch = body_data.get('messages')
+    if isinstance(batch, list) and batch and isinstance(batch[0], dict):
+        return batch[0].get('sender_id')
+    return body_data.get('sender_id')
+
+def claimed_user_ids(method: str, params: Dict[str, Any], body_data: Any) -> List[Any]:
+    '''
+    Every user id the request acts for; each message of a batch names its sender.
+    '''
+    batch = body_data.get('messages') if method == 'POST' and isinstance(body_data, dict) else None
+    if isinstance(batch, list):
+        return [item.get('sender_id') for item in batch if isinstance(item, dict)]
+    return [acting_user_id(method, params, body_data)]
+
+def long_poll(current: Optional[session.Session], params: Dict[str, Any]) -> Dict[str, Any]:
+    user_id = current.user_id if current is not None else params.get('user_id')
+    if not user_id:
+        return session.Denied(401, 'Authorization required').response()
+    
+    try:
+        cursor = int(params['cursor']) if params.get('cursor') else None
+        timeout = min(float(params.get('timeout') or LONG_POLL_TIMEOUT), LONG_POLL_TIMEOUT)
+        updates = wait_for_updates(int(user_id), cursor, timeout)
+    except ValueError:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': metrics.dumps({'error': 'user_id, cursor and timeout must be numbers'})
+        }
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': metrics.dumps(updates)
+    }
+
+@metrics.instrumented('messages')
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Handle chat messages - send, receive, mark as read
-    Args: event with httpMethod, body, queryStringParameters; context with request_id
+    Args: event with httpMethod, body (one message or a messages batch), queryStringParameters (chat_id, user_id, since_id, before_id, limit, render,
+          or user_id, wait, cursor, timeout to long-poll for new messages,
+          or user_id, q, optional chat_id, limit, offset to search,
+          or chat_id, export, after_id to export history as NDJSON chunks); context with request_id
     Returns: HTTP response with messages data
     '''
     method: str = event.get('httpMethod', 'GET')
@@ -17,45 +533,207 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id',
+                'Access-Control-Allow-Headers': 'Content-Type, Authorization, If-None-Match, X-Min-Lsn',
                 'Access-Control-Max-Age': '86400'
             },
             'body': ''
         }
     
-    import psycopg2
-    import psycopg2.extras
+    params = event.get('queryStringParameters') or {}
+    body_data = json.loads(event.get('body', '{}')) if method in ('POST', 'PUT') else {}
+    
+    try:
+        current = session.authorize(event, *claimed_user_ids(method, params, body_data))
+    except session.Denied as denied:
+        return denied.response()
+    
+    # Buckets are keyed on the token's user, as the handler below acts for it
+    user_key = current.user_id if current is not None else acting_user_id(method, params, body_data)
+    try:
+        admission = ratelimit.admit(event, 'messages', request_class(method, params), user_key)
+    except ratelimit.Rejected as rejected:
+        return rejected.response()
+    
+    # The long-poll takes a pooled connection only to read the latest ids
+    if method == 'GET' and params.get('wait'):
+        try:
+            return long_poll(current, params)
+        finally:
+            admission.leave()
     
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    # Reads go to a replica that has caught up with the client's last write
+    try:
+        conn = db.acquire(readonly=method == 'GET', min_lsn=db.requested_lsn(event))
+    except psycopg2.Error:
+        admission.leave()
+        raise
     cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
     
     try:
         if method == 'GET':
-            params = event.get('queryStringParameters', {})
+            user_cache.cache.listen(conn)
             chat_id = params.get('chat_id')
-            user_id = params.get('user_id')
+            # Reads act for the token's user; a bare user_id only counts when
+            # SESSION_REQUIRED=0 lets requests without a token through
+            user_id = current.user_id if current is not None else params.get('user_id')
+            
+            if not user_id:
+                return session.Denied(401, 'Authorization required').response()
+            
+            if params.get('q'):
+                try:
+                    search_user_id = int(user_id)
+                    search_chat_id = int(chat_id) if chat_id else None
+                    limit = max(1, min(int(params.get('limit') or DEFAULT_PAGE_SIZE), MAX_PAGE_SIZE))
+                    offset = max(0, min(int(params.get('offset') or 0), MAX_SEARCH_OFFSET))
+                except (TypeError, ValueError):
+                    return {
+                        'statusCode': 400,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': metrics.dumps({'error': 'user_id, chat_id, limit and offset must be integers'})
+                    }
+                
+                results = search_messages(cur, search_user_id, params['q'][:256], search_chat_id, limit + 1, offset)
+                has_more = len(results) > limit
+                results = results[:limit]
+                senders = user_cache.cache.get_many(conn, [row['sender_id'] for row in results if row['sender_id'] is not None])
+                
+                return {
+                    'statusCode': 200,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': metrics.dumps({
+                        'results': [
+                            {
+                                'id': row['id'],
+                                'chat_id': row['chat_id'],
+                                'sender_id': row['sender_id'],
+                                'created_at': row['created_at'].isoformat() if row['created_at'] else None,
+                                'snippet': row['snippet'],
+                                'rank': row['rank'],
+                                'sender': senders.get(row['sender_id'])
+                            }
+                            for row in results
+                        ],
+                        'has_more': has_more
+                    })
+                }
             
             if not chat_id:
                 return {
                     'statusCode': 400,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'chat_id required'})
+                    'body': metrics.dumps({'error': 'chat_id required'})
                 }
             
-            cur.execute("""
-                SELECT m.id, m.chat_id, m.sender_id, m.content, m.message_type, 
-                       m.file_url, m.is_system, m.read_by, m.created_at,
-                       u.username, u.nickname, u.avatar_url
-                FROM messages m
-                LEFT JOIN users u ON m.sender_id = u.id
-                WHERE m.chat_id = %s
-                ORDER BY m.created_at ASC
-            """, (chat_id,))
+            if params.get('export'):
+                try:
+                    export_chat_id = int(chat_id)
+                    export_user_id = int(user_id)
+                    after_id = int(params.get('after_id') or 0)
+                except (TypeError, ValueError):
+                    return {
+                        'statusCode': 400,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': metrics.dumps({'error': 'user_id, chat_id and after_id must be integers'})
+                    }
+                
+                cur.execute(
+                    "SELECT 1 FROM chat_members WHERE chat_id = %s AND user_id = %s",
+                    (export_chat_id, export_user_id)
+                )
+                if cur.fetchone() is None:
+                    return {
+                        'statusCode': 404,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': metrics.dumps({'error': 'Chat not found'})
+                    }
+                
+                body, next_after_id = export_chunk(conn, export_chat_id, after_id)
+                headers = {
+                    'Content-Type': 'application/x-ndjson',
+                    'Access-Control-Allow-Origin': '*',
+                    'Access-Control-Expose-Headers': 'X-Next-After-Id'
+                }
+                if next_after_id is not None:
+                    headers['X-Next-After-Id'] = str(next_after_id)
+                
+                return {
+                    'statusCode': 200,
+                    'headers': headers,
+                    'body': body
+                }
+            
+            try:
+                chat_id = int(chat_id)
+                user_id = int(user_id)
+                since_id = int(params['since_id']) if params.get('since_id') else None
+                before_id = int(params['before_id']) if params.get('before_id') else None
+                limit = min(int(params.get('limit') or DEFAULT_PAGE_SIZE), MAX_PAGE_SIZE)
+            except (TypeError, ValueError):
+                return {
+                    'statusCode': 400,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': metrics.dumps({'error': 'user_id, chat_id, since_id, before_id and limit must be integers'})
+                }
+            
+            if limit < 1:
+                limit = DEFAULT_PAGE_SIZE
+            
+            # An unchanged version stamp is answered with 304 before the page
+            # query runs
+            MESSAGES_VERSION.execute(cur, {'user_id': user_id, 'window_days': RECENT_WINDOW_DAYS, 'chat_id': chat_id})
+            version = cur.fetchone()
+            if version is None or not version['is_member']:
+                return {
+                    'statusCode': 404,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': metrics.dumps({'error': 'Chat not found'})
+                }
+            
+            read_up_to = version['read_up_to']
+            etag = conditional.make_etag(
+                chat_id, version['message_version'], version['pending_messages'], version['last_message_id'],
+                read_up_to, since_id, before_id, limit
+            )
+            
+            if conditional.etag_matches(event, etag):
+                return conditional.not_modified(etag)
+            
+            headers = dict(
+                {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                **conditional.cache_headers(etag)
+            )
+            
+            if params.get('render') == 'db':
+                chat_in_window = (
+                    version['chat_created_at'] is not None and version['chat_created_at'] >= version['window_start']
+                )
+                return {
+                    'statusCode': 200,
+                    'headers': headers,
+                    'body': render_page(
+                        cur, chat_id, since_id, before_id, limit,
+                        version['window_start'] if chat_in_window else None, read_up_to
+                    )
+                }
+            
+            # Keyset pagination over (chat_id, id): a poll with since_id only reads
+            # rows newer than the client's last message, older pages walk backwards.
+            if since_id is not None and since_id >= (version['last_message_id'] or 0):
+                messages = []
+            else:
+                messages = fetch_page(
+                    cur, chat_id, since_id, before_id, limit, version['window_start'],
+                    version['chat_created_at'] is not None and version['chat_created_at'] >= version['window_start']
+                )
+            has_more = len(messages) > limit
+            messages = messages[:limit] if since_id is not None else messages[:limit][::-1]
             
-            messages = cur.fetchall()
             messages_list = []
+            senders = user_cache.cache.get_many(conn, [msg['sender_id'] for msg in messages if msg['sender_id'] is not None])
             
             for msg in messages:
+                sender = senders.get(msg['sender_id'], {})
                 messages_list.append({
                     'id': msg['id'],
                     'chat_id': msg['chat_id'],
@@ -64,93 +742,139 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'message_type': msg['message_type'],
                     'file_url': msg['file_url'],
                     'is_system': msg['is_system'],
-                    'read_by': msg['read_by'] or [],
                     'created_at': msg['created_at'].isoformat() if msg['created_at'] else None,
                     'sender': {
-                        'username': msg['username'],
-                        'nickname': msg['nickname'],
-                        'avatar_url': msg['avatar_url']
+                        'username': sender.get('username'),
+                        'nickname': sender.get('nickname'),
+                        'avatar_url': sender.get('avatar_url')
                     }
                 })
             
             return {
                 'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'messages': messages_list})
+                'headers': headers,
+                'body': metrics.dumps({'messages': messages_list, 'has_more': has_more, 'read_up_to': read_up_to})
             }
         
         elif method == 'POST':
-            body_data = json.loads(event.get('body', '{}'))
-            chat_id = body_data.get('chat_id')
-            sender_id = body_data.get('sender_id')
-            content = body_data.get('content', '').strip()
-            message_type = body_data.get('message_type', 'text')
-            file_url = body_data.get('file_url')
-            is_system = body_data.get('is_system', False)
+            batch = body_data.get('messages')
             
-            if not chat_id or not sender_id or not content:
+            if batch is not None:
+                if not isinstance(batch, list) or not batch or len(batch) > MAX_BATCH_SIZE:
+                    return {
+                        'statusCode': 400,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': metrics.dumps({'error': f'messages must be a list of 1 to {MAX_BATCH_SIZE} items'})
+                    }
+                items = [parse_message(data) if isinstance(data, dict) else None for data in batch]
+            else:
+                items = [parse_message(body_data)]
+            
+            if None in items:
                 return {
                     'statusCode': 400,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'chat_id, sender_id and content required'})
+                    'body': metrics.dumps({
+                        'error': 'chat_id, sender_id and content required, client_message_id up to 64 characters',
+                        'index': items.index(None)
+                    })
                 }
             
-            cur.execute("""
-                INSERT INTO messages (chat_id, sender_id, content, message_type, file_url, is_system)
-                VALUES (%s, %s, %s, %s, %s, %s)
-                RETURNING id, created_at
-            """, (chat_id, sender_id, content, message_type, file_url, is_system))
-            
-            result = cur.fetchone()
+            # Nothing is written unless every sender is a member of its chat
+            FIRST_NON_MEMBER_SEND.execute(
+                cur, ([item['chat_id'] for item in items], [item['sender_id'] for item in items])
+            )
+            outsider = cur.fetchone()
+            if outsider is not None:
+                return {
+                    'statusCode': 404,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': metrics.dumps({'error': 'Chat not found', 'index': outsider['index']})
+                }
             
-            cur.execute("UPDATE chats SET updated_at = CURRENT_TIMESTAMP WHERE id = %s", (chat_id,))
+            results = insert_messages(cur, items)
             
             conn.commit()
+            token = db.write_token(conn)
+            outbox.drain_after_send(conn)
+            
+            for result in results:
+                result['created_at'] = result['created_at'].isoformat()
+            
+            if batch is not None:
+                return {
+                    'statusCode': 200,
+                    'headers': dict({'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}, **db.token_headers(token)),
+                    'body': metrics.dumps({'success': True, 'messages': results})
+                }
             
             return {
                 'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({
+                'headers': dict({'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}, **db.token_headers(token)),
+                'body': metrics.dumps({
                     'success': True,
                     'message': {
-                        'id': result['id'],
-                        'created_at': result['created_at'].isoformat()
+                        'id': results[0]['id'],
+                        'created_at': results[0]['created_at'],
+                        'duplicate': results[0]['duplicate']
                     }
                 })
             }
         
         elif method == 'PUT':
-            body_data = json.loads(event.get('body', '{}'))
-            message_id = body_data.get('message_id')
+            chat_id = body_data.get('chat_id')
             user_id = body_data.get('user_id')
+            up_to_id = body_data.get('up_to_id')
+            message_id = body_data.get('message_id')
+            
+            if not user_id or not ((chat_id and up_to_id) or message_id):
+                return {
+                    'statusCode': 400,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': metrics.dumps({'error': 'user_id and either chat_id with up_to_id or message_id required'})
+                }
             
-            if not message_id or not user_id:
+            try:
+                user_id = int(user_id)
+                chat_id = int(chat_id) if chat_id else None
+                up_to_id = int(up_to_id) if up_to_id else None
+                message_id = int(message_id) if message_id else None
+            except (TypeError, ValueError):
                 return {
                     'statusCode': 400,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'message_id and user_id required'})
+                    'body': metrics.dumps({'error': 'user_id, chat_id, up_to_id and message_id must be integers'})
                 }
             
-            cur.execute("""
-                UPDATE messages 
-                SET read_by = array_append(read_by, %s)
-                WHERE id = %s AND NOT (%s = ANY(read_by))
-            """, (user_id, message_id, user_id))
+            # Read state is a per-member watermark: everything up to
+            # last_read_message_id counts as read, and it only moves forward.
+            # last_read_at keeps the watermark message's time so unread counts
+            # can skip partitions older than it.
+            if chat_id and up_to_id:
+                MARK_READ_UP_TO.execute(cur, {'up_to_id': up_to_id, 'chat_id': chat_id, 'user_id': user_id})
+            else:
+                MARK_READ_MESSAGE.execute(cur, (message_id, user_id))
             
             conn.commit()
+            token = db.write_token(conn)
             
             return {
                 'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'success': True})
+                'headers': dict({'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}, **db.token_headers(token)),
+                'body': metrics.dumps({'success': True})
             }
         
         return {
             'statusCode': 405,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Method not allowed'})
+            'body': metrics.dumps({'error': 'Method not allowed'})
         }
     
     finally:
         cur.close()
-        conn.close()
+        db.release(conn)
+        admission.leave()
+
+
+# Runs once per container, when the platform imports this module
+db.warm_up()
\ No newline at end of file
@@ -0,0 +1,152 @@
+'''
+One LISTEN connection per container, shared by every long-poll waiting in
+it. A waiter subscribes to its channels and blocks on its own queue; a
+background thread reads notifications off the connection and hands each
+one to the waiters of its channel. A channel is LISTENed while at least
+one waiter wants it, so a thousand idle clients cost one connection
+instead of a thousand pooled ones.
+
+If the connection breaks, every waiter is woken with lost set and the next
+subscribe() reconnects. The waiters answer with what they have, so their
+clients come straight back and read the latest ids again.
+'''
+import json
+import os
+import queue
+import select
+import threading
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import psycopg2
+
+POLL_INTERVAL = 1.0
+
+class Waiter:
+    def __init__(self, channels: List[str]) -> None:
+        self.channels = channels
+        self.lost = False
+        self._queue: 'queue.Queue[Optional[Tuple[str, str]]]' = queue.Queue()
+
+    def deliver(self, channel: str, payload: str) -> None:
+        self._queue.put((channel, payload))
+
+    def wake_lost(self) -> None:
+        self.lost = True
+        self._queue.put(None)
+
+    def get(self, timeout: float) -> List[Tuple[str, str]]:
+        '''
+        Notifications received so far, waiting up to timeout for the first.
+        '''
+        try:
+            items = [self._queue.get(timeout=max(timeout, 0))]
+        except queue.Empty:
+            return []
+        while True:
+            try:
+                items.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return [item for item in items if item is not None]
+
+class Listener:
+    def __init__(self, dsn: str) -> None:
+        self.dsn = dsn
+        self._conn: Optional[Any] = None
+        self._channels: Dict[str, Set[Waiter]] = {}
+        self._lock = threading.Lock()
+
+    def _connect(self) -> None:
+        self._conn = psycopg2.connect(self.dsn, connect_timeout=5, keepalives=1, keepalives_idle=30)
+        self._conn.autocommit = True
+        thread = threading.Thread(target=self._run, args=(self._conn,), name='notify-listener', daemon=True)
+        thread.start()
+
+    def _dispatch(self) -> None:
+        # Runs under _lock; executing LISTEN from a request thread can pull
+        # notifications off the socket too, so this is called after that as well
+        conn = self._conn
+        while conn.notifies:
+            notify = conn.notifies.pop(0)
+            for waiter in self._channels.get(notify.channel, ()):
+                waiter.deliver(notify.channel, notify.payload)
+
+    def subscribe(self, channels: List[str]) -> Waiter:
+        '''
+        A waiter that gets every notification on channels from now on.
+        '''
+        waiter = Waiter(channels)
+        with self._lock:
+            if self._conn is None or self._conn.closed:
+                self._connect()
+            new = [channel for channel in channels if channel not in self._channels]
+            if new:
+                try:
+                    with self._conn.cursor() as cur:
+                        cur.execute(' '.join('LISTEN %s;' % channel for channel in new))
+                except psycopg2.Error:
+                    self._lose(self._conn)
+                    raise
+            for channel in channels:
+                self._channels.setdefault(channel, set()).add(waiter)
+            self._dispatch()
+        return waiter
+
+    def unsubscribe(self, waiter: Waiter) -> None:
+        with self._lock:
+            unused = []
+            for channel in waiter.channels:
+                waiters = self._channels.get(channel)
+                if waiters is None:
+                    continue
+                waiters.discard(waiter)
+                if not waiters:
+                    del self._channels[channel]
+                    unused.append(channel)
+            if unused and self._conn is not None and not self._conn.closed:
+                try:
+                    with self._conn.cursor() as cur:
+                        cur.execute(' '.join('UNLISTEN %s;' % channel for channel in unused))
+                    self._dispatch()
+                except psycopg2.Error:
+                    self._lose(self._conn)
+
+    def _lose(self, conn: Any) -> None:
+        # Runs under _lock
+        lost = {waiter for waiters in self._channels.values() for waiter in waiters}
+        print(json.dumps({'metric': 'notify_listener', 'error': 'connection lost', 'waiters': len(lost)}))
+        for waiter in lost:
+            waiter.wake_lost()
+        self._channels = {}
+        if self._conn is conn:
+            self._conn = None
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _run(self, conn: Any) -> None:
+        while True:
+            try:
+                select.select([conn], [], [], POLL_INTERVAL)
+                with self._lock:
+                    if self._conn is not conn:
+                        return
+                    conn.poll()
+                    self._dispatch()
+            except (psycopg2.Error, OSError, ValueError):
+                with self._lock:
+                    if self._conn is conn:
+                        self._lose(conn)
+                return
+
+_listener: Optional[Listener] = None
+_listener_lock = threading.Lock()
+
+def get_listener() -> Listener:
+    global _listener
+    if _listener is None:
+        with _listener_lock:
+            if _listener is None:
+                _listener = Listener(os.environ['DATABASE_URL'])
+    return _listener
\ No newline at end of file
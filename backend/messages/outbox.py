@@ -0,0 +1,142 @@
+'''
+Transactional outbox for what happens after a message is sent. The send
+transaction inserts the messages plus one message_outbox row each and
+commits; bumping the chat row (last message, preview, updated_at) is left
+to drain(), so senders in a busy chat no longer queue on that row's lock.
+drain() claims a batch with FOR UPDATE SKIP LOCKED, hands each event type
+to its handler in HANDLERS, which coalesces the batch (one UPDATE per chat
+however many messages it got), and deletes the rows in the same
+transaction: an effect is applied exactly once, and a failed batch is
+simply retried. Until then PENDING_LAST_MESSAGE lets readers see pending
+messages in a chat's last message id, and chats.message_version plus
+PENDING_MESSAGES changes with every committed send, so version stamps
+built on them also catch a message committed after a newer id. The messages function drains right
+after a send unless another drain is running (OUTBOX_INLINE_DRAIN);
+scripts/outbox_worker.py picks up whatever is left.
+'''
+import os
+from typing import Any, Callable, Dict, List, Tuple
+
+import psycopg2.extras
+
+import metrics
+
+BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE', '500'))
+INLINE_DRAIN = os.environ.get('OUTBOX_INLINE_DRAIN', '1') != '0'
+INLINE_MAX_BATCHES = int(os.environ.get('OUTBOX_INLINE_MAX_BATCHES', '2'))
+DRAIN_LOCK_ID = 0x6f757462
+MESSAGE_CREATED = 'message_created'
+
+# SQL for the newest message of chat c, counting messages whose bump is
+# still queued
+PENDING_LAST_MESSAGE = (
+    "GREATEST(c.last_message_id, (SELECT MAX(o.message_id) FROM message_outbox o WHERE o.chat_id = c.id))"
+)
+
+# SQL for the number of messages of chat c whose bump is still queued
+PENDING_MESSAGES = "(SELECT COUNT(*) FROM message_outbox o WHERE o.chat_id = c.id)"
+
+def enqueue(cur: Any, messages: List[Tuple[int, int, Any]]) -> None:
+    '''
+    Queue message_created for (chat_id, message_id, created_at) rows. The
+    caller commits.
+    '''
+    psycopg2.extras.execute_values(cur, """
+        INSERT INTO message_outbox (event, chat_id, message_id, message_created_at)
+        VALUES %s
+    """, [(MESSAGE_CREATED, chat_id, message_id, created_at) for chat_id, message_id, created_at in messages],
+        page_size=len(messages))
+
+def bump_chats(cur: Any, events: List[Dict[str, Any]]) -> None:
+    '''
+    Point each chat at its newest message. Only the latest event per chat
+    is applied, and never over a newer one, so replays are harmless; the
+    chat's message_version is bumped either way.
+    '''
+    latest: Dict[int, Dict[str, Any]] = {}
+    for event in events:
+        current = latest.get(event['chat_id'])
+        if current is None or current['message_id'] < event['message_id']:
+            latest[event['chat_id']] = event
+    
+    psycopg2.extras.execute_values(cur, """
+        UPDATE chats c
+        SET message_version = c.message_version + 1,
+            updated_at = CASE WHEN c.last_message_id >= v.id THEN c.updated_at ELSE CURRENT_TIMESTAMP END,
+            last_message_id = GREATEST(c.last_message_id, v.id),
+            last_message_at = CASE WHEN c.last_message_id >= v.id THEN c.last_message_at ELSE v.created_at END,
+            last_message_preview = CASE
+                WHEN c.last_message_id >= v.id THEN c.last_message_preview ELSE LEFT(m.content, 200)
+            END
+        FROM (VALUES %s) AS v(chat_id, id, created_at)
+        INNER JOIN messages m ON m.id = v.id AND m.created_at = v.created_at
+        WHERE c.id = v.chat_id
+    """, [
+        (event['chat_id'], event['message_id'], event['message_created_at'])
+        for _, event in sorted(latest.items())
+    ], page_size=len(latest))
+
+HANDLERS: Dict[str, Callable[[Any, List[Dict[str, Any]]], None]] = {
+    MESSAGE_CREATED: bump_chats
+}
+
+def drain(conn: Any, batch_size: int = BATCH_SIZE, max_batches: int = 0, exclusive: bool = False) -> int:
+    '''
+    Apply queued events batch by batch until the outbox is empty or
+    max_batches (0 for no limit) have run; returns the number applied.
+    With exclusive, give up at once if another exclusive drain holds the
+    lock: it will pick up these rows on its next batch, and the worker
+    catches anything it misses. Events without a handler are left for a
+    worker that knows them.
+    '''
+    applied = 0
+    batches = 0
+    while not max_batches or batches < max_batches:
+        batches += 1
+        with conn.cursor() as cur:
+            if exclusive:
+                cur.execute("SELECT pg_try_advisory_xact_lock(%s)", (DRAIN_LOCK_ID,))
+                if not cur.fetchone()[0]:
+                    conn.rollback()
+                    break
+            
+            cur.execute("""
+                DELETE FROM message_outbox
+                WHERE id IN (
+                    SELECT id FROM message_outbox
+                    WHERE event = ANY(%s)
+                    ORDER BY id
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING event, chat_id, message_id, message_created_at
+            """, (list(HANDLERS), batch_size))
+            rows = cur.fetchall()
+            
+            by_event: Dict[str, List[Dict[str, Any]]] = {}
+            for event, chat_id, message_id, message_created_at in rows:
+                by_event.setdefault(event, []).append(
+                    {'chat_id': chat_id, 'message_id': message_id, 'message_created_at': message_created_at}
+                )
+            for event, events in by_event.items():
+                HANDLERS[event](cur, events)
+        conn.commit()
+        
+        applied += len(rows)
+        if len(rows) < batch_size:
+            break
+    return applied
+
+def drain_after_send(conn: Any) -> None:
+    '''
+    Best-effort drain once a send has committed; errors are left to the
+    worker rather than failing the request.
+    '''
+    if not INLINE_DRAIN:
+        return
+    with metrics.phase('outbox'):
+        try:
+            drain(conn, max_batches=INLINE_MAX_BATCHES, exclusive=True)
+        except psycopg2.Error as exc:
+            conn.rollback()
+            print('outbox drain failed: %s' % str(exc).strip())
\ No newline at end of file
@@ -0,0 +1,232 @@
+'''
+Signed session tokens. Login issues
+<user_id>.<issued_at>.<expires_at>.<session_id>.<signature>, signed with
+HMAC-SHA256 under the first key in SESSION_SECRETS (comma-separated).
+Every listed key verifies, so a new key can be added first and become the
+signing key later. Verifying a token is one HMAC and a few dict lookups;
+it never goes to the database.
+
+Logout writes a row to session_revocations. Each container keeps those
+rows in a deny-list and reads only the rows added since its last refresh,
+at most every SESSION_DENY_REFRESH seconds, so other containers may accept
+a revoked token for up to that long. Entries are dropped once the tokens
+they cover have expired.
+
+There is no built-in key: without SESSION_SECRETS no token is issued or
+accepted. Requests need a token unless SESSION_REQUIRED=0, which trusts
+tokenless requests on the user ids they carry while old clients move over.
+Each function ships its own copy of this module.
+'''
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+import psycopg2
+
+import db
+import metrics
+
+SECRETS = [key.strip().encode() for key in os.environ.get('SESSION_SECRETS', '').split(',') if key.strip()]
+TTL = int(os.environ.get('SESSION_TTL', str(7 * 24 * 3600)))
+REQUIRED = os.environ.get('SESSION_REQUIRED', '1') != '0'
+DENY_REFRESH = float(os.environ.get('SESSION_DENY_REFRESH', '30'))
+HEADER = 'Authorization'
+
+if not SECRETS:
+    print(json.dumps({'metric': 'session', 'error': 'SESSION_SECRETS is not set, every session token is rejected'}))
+
+class Denied(Exception):
+    def __init__(self, status: int, error: str) -> None:
+        super().__init__(error)
+        self.status = status
+        self.error = error
+
+    def response(self) -> Dict[str, Any]:
+        headers = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+        if self.status == 401:
+            headers['WWW-Authenticate'] = 'Bearer'
+        return {
+            'statusCode': self.status,
+            'headers': headers,
+            'body': metrics.dumps({'error': self.error})
+        }
+
+class Session:
+    def __init__(self, user_id: int, issued_at: int, expires_at: int, session_id: str) -> None:
+        self.user_id = user_id
+        self.issued_at = issued_at
+        self.expires_at = expires_at
+        self.session_id = session_id
+
+def _sign(key: bytes, payload: str) -> str:
+    digest = hmac.new(key, payload.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b'=').decode()
+
+def check_configured() -> None:
+    if not SECRETS:
+        raise Denied(503, 'Sessions are not configured')
+
+def issue(user_id: int) -> Tuple[str, Session]:
+    check_configured()
+    issued_at = int(time.time())
+    current = Session(int(user_id), issued_at, issued_at + TTL, secrets.token_urlsafe(12))
+    payload = '%d.%d.%d.%s' % (current.user_id, current.issued_at, current.expires_at, current.session_id)
+    return '%s.%s' % (payload, _sign(SECRETS[0], payload)), current
+
+def verify(token: str) -> Session:
+    '''
+    The session a token stands for, or Denied(401) if it is malformed,
+    not signed by one of our keys, expired or revoked.
+    '''
+    check_configured()
+    payload, _, signature = token.rpartition('.')
+    if not any(hmac.compare_digest(_sign(key, payload), signature) for key in SECRETS):
+        raise Denied(401, 'Invalid session token')
+    try:
+        user_id, issued_at, expires_at, session_id = payload.split('.')
+        current = Session(int(user_id), int(issued_at), int(expires_at), session_id)
+    except ValueError:
+        raise Denied(401, 'Invalid session token')
+
+    if current.expires_at <= time.time():
+        raise Denied(401, 'Session expired')
+    deny_list.refresh()
+    if deny_list.revoked(current):
+        raise Denied(401, 'Session revoked')
+    return current
+
+def bearer_token(event: Dict[str, Any]) -> Optional[str]:
+    name = HEADER.lower()
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == name and value:
+            scheme, _, token = value.partition(' ')
+            return token.strip() if scheme.lower() == 'bearer' and token.strip() else None
+    return None
+
+def authorize(event: Dict[str, Any], *claimed_ids: Any) -> Optional[Session]:
+    '''
+    Check the request's bearer token against the user ids it claims to act
+    for; empty claims are skipped. Returns the session, or None when there
+    is no token and SESSION_REQUIRED is off. Raises Denied.
+    '''
+    token = bearer_token(event)
+    if token is None:
+        if REQUIRED:
+            raise Denied(401, 'Authorization required')
+        return None
+
+    current = verify(token)
+    for claimed_id in claimed_ids:
+        if claimed_id is not None and claimed_id != '' and str(claimed_id) != str(current.user_id):
+            raise Denied(403, 'Token does not belong to this user')
+    return current
+
+class DenyList:
+    '''
+    Revoked sessions by id and per-user cut-offs ("every session issued up
+    to this second"), each kept until the tokens it covers expire.
+    '''
+    def __init__(self, refresh_interval: float) -> None:
+        self.refresh_interval = refresh_interval
+        self._sessions: Dict[str, int] = {}
+        self._users: Dict[int, Tuple[int, int]] = {}
+        self._last_id = 0
+        self._loaded = False
+        self._next_refresh_at = 0.0
+        self._lock = threading.Lock()
+
+    def revoked(self, current: Session) -> bool:
+        if current.session_id in self._sessions:
+            return True
+        cutoff = self._users.get(current.user_id)
+        return cutoff is not None and current.issued_at <= cutoff[0]
+
+    def add(self, user_id: int, session_id: Optional[str], issued_before: Optional[int], expires_at: int) -> None:
+        if session_id is not None:
+            self._sessions[session_id] = expires_at
+        if issued_before is not None:
+            previous = self._users.get(user_id, (issued_before, expires_at))
+            self._users[user_id] = (max(previous[0], issued_before), max(previous[1], expires_at))
+
+    def refresh(self, force: bool = False) -> None:
+        '''
+        Read revocations added since the last refresh if it is due. Until
+        the first load has finished every caller waits for it; after that
+        one thread refreshes and the rest use the current list. A failed
+        load keeps the old list and is retried after the next interval.
+        '''
+        if not force and time.monotonic() < self._next_refresh_at:
+            return
+        if not self._lock.acquire(blocking=not self._loaded):
+            return
+        try:
+            if not force and time.monotonic() < self._next_refresh_at:
+                return
+            started = time.perf_counter()
+            try:
+                loaded = self._load()
+            except psycopg2.Error as exc:
+                print(json.dumps({'metric': 'session_deny_list', 'error': str(exc).strip()}))
+            else:
+                if loaded or not self._loaded:
+                    print(json.dumps({
+                        'metric': 'session_deny_list',
+                        'loaded': loaded,
+                        'sessions': len(self._sessions),
+                        'users': len(self._users),
+                        'ms': round((time.perf_counter() - started) * 1000, 2)
+                    }))
+            self._loaded = True
+            self._next_refresh_at = time.monotonic() + self.refresh_interval
+        finally:
+            self._lock.release()
+
+    def _load(self) -> int:
+        now = int(time.time())
+        conn = db.acquire(readonly=True)
+        try:
+            with conn.cursor() as cur:
+                # Ids are taken before commit, so a row can appear below the
+                # last id seen; re-reading the last minute catches those
+                cur.execute("""
+                    SELECT id, user_id, session_id, issued_before, expires_at
+                    FROM session_revocations
+                    WHERE (id > %s OR created_at > CURRENT_TIMESTAMP - INTERVAL '1 minute')
+                      AND expires_at > %s
+                    ORDER BY id
+                """, (self._last_id, now))
+                rows = cur.fetchall()
+        finally:
+            db.release(conn)
+
+        for row_id, user_id, session_id, issued_before, expires_at in rows:
+            self.add(user_id, session_id, issued_before, expires_at)
+            self._last_id = max(self._last_id, row_id)
+
+        self._sessions = {key: expires_at for key, expires_at in self._sessions.items() if expires_at > now}
+        self._users = {key: cutoff for key, cutoff in self._users.items() if cutoff[1] > now}
+        return len(rows)
+
+deny_list = DenyList(DENY_REFRESH)
+
+def revoke(cur: Any, current: Session, everywhere: bool = False) -> None:
+    '''
+    Revoke one session, or with everywhere every session of its user issued
+    so far. Takes effect in this container at once; the caller commits.
+    '''
+    if everywhere:
+        session_id, issued_before, expires_at = None, int(time.time()), int(time.time()) + TTL
+    else:
+        session_id, issued_before, expires_at = current.session_id, None, current.expires_at
+    cur.execute("""
+        INSERT INTO session_revocations (user_id, session_id, issued_before, expires_at)
+        VALUES (%s, %s, %s, %s)
+    """, (current.user_id, session_id, issued_before, expires_at))
+    cur.execute("DELETE FROM session_revocations WHERE expires_at <= %s", (int(time.time()),))
+    deny_list.add(current.user_id, session_id, issued_before, expires_at)
\ No newline at end of file
@@ -0,0 +1,193 @@
+'''
+In-process LRU cache of user summaries (id, username, nickname, avatar_url)
+shared by invocations in the same container. Entries expire after
+USER_CACHE_TTL seconds; profile updates also publish NOTIFY profile_updates
+so containers listening on their pooled connections drop entries early.
+Each function ships its own copy of this module.
+'''
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+import psycopg2.extensions
+
+USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', '60'))
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', '10000'))
+STATS_LOG_INTERVAL = int(os.environ.get('USER_CACHE_STATS_INTERVAL', '1000'))
+INVALIDATION_CHANNEL = 'profile_updates'
+
+_MISSING = object()
+
+class LRUCache:
+    '''
+    Size- and TTL-bounded LRU map with hit, miss, eviction and expiry counters.
+    '''
+    def __init__(self, max_size: int, ttl: float) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self._entries: 'OrderedDict[Any, Tuple[float, Any]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            if entry[0] < time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: Any, value: Any) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key: Any) -> None:
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'invalidations': self.invalidations
+        }
+
+class UserCache:
+    '''
+    Read-through cache of user summaries keyed by id, with a username -> id
+    index for lookups by username (usernames never change).
+    '''
+    def __init__(self, max_size: int = USER_CACHE_SIZE, ttl: float = USER_CACHE_TTL) -> None:
+        self.users = LRUCache(max_size, ttl)
+        self.usernames = LRUCache(max_size, ttl)
+        self._lookups = 0
+
+    def listen(self, conn: Any) -> None:
+        '''
+        Subscribe a pooled connection to invalidations once. LISTEN only
+        takes effect on commit, so this is skipped inside a transaction,
+        and replicas reject it; entries read there rely on the TTL and on
+        invalidations arriving over the container's primary connections.
+        '''
+        if getattr(conn, 'listens_profile_updates', False) or getattr(conn, 'replica', False):
+            return
+        if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            return
+        with conn.cursor() as cur:
+            cur.execute('LISTEN %s' % INVALIDATION_CHANNEL)
+        if not conn.autocommit:
+            conn.commit()
+        conn.listens_profile_updates = True
+
+    def sync(self, conn: Any) -> None:
+        '''
+        Apply invalidations that arrived on this connection since last use.
+        '''
+        if not getattr(conn, 'listens_profile_updates', False):
+            return
+        conn.poll()
+        for notify in list(conn.notifies):
+            if notify.channel == INVALIDATION_CHANNEL:
+                conn.notifies.remove(notify)
+                self.users.invalidate(int(notify.payload))
+
+    def _count_lookups(self, count: int) -> None:
+        previous = self._lookups
+        self._lookups += count
+        if STATS_LOG_INTERVAL and previous // STATS_LOG_INTERVAL != self._lookups // STATS_LOG_INTERVAL:
+            print(json.dumps({'user_cache': self.stats()}))
+
+    def _remember(self, row: Tuple[Any, ...]) -> Dict[str, Any]:
+        user = {'id': row[0], 'username': row[1], 'nickname': row[2], 'avatar_url': row[3]}
+        self.users.set(user['id'], user)
+        self.usernames.set(user['username'], user['id'])
+        return user
+
+    def get_many(self, conn: Any, user_ids: Iterable[int]) -> Dict[int, Dict[str, Any]]:
+        '''
+        Summaries for the given ids; misses are loaded with one query.
+        Unknown ids are absent from the result.
+        '''
+        self.sync(conn)
+        found: Dict[int, Dict[str, Any]] = {}
+        missing = []
+
+        for user_id in set(user_ids):
+            user = self.users.get(user_id, _MISSING)
+            if user is _MISSING:
+                missing.append(user_id)
+            else:
+                found[user_id] = user
+
+        self._count_lookups(len(found) + len(missing))
+
+        if missing:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT id, username, nickname, avatar_url FROM users WHERE id = ANY(%s)",
+                    (missing,)
+                )
+                for row in cur.fetchall():
+                    found[row[0]] = self._remember(row)
+
+        return found
+
+    def get_by_username(self, conn: Any, username: str) -> Optional[Dict[str, Any]]:
+        self.sync(conn)
+        self._count_lookups(1)
+        user_id = self.usernames.get(username)
+        if user_id is not None:
+            user = self.users.get(user_id, _MISSING)
+            if user is not _MISSING:
+                return user
+
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT id, username, nickname, avatar_url FROM users WHERE username = %s",
+                (username,)
+            )
+            row = cur.fetchone()
+        return self._remember(row) if row else None
+
+    def invalidate(self, conn: Any, user_id: int) -> None:
+        '''
+        Drop the local entry and publish the invalidation; the NOTIFY is
+        delivered when the caller commits its transaction.
+        '''
+        self.users.invalidate(int(user_id))
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_notify(%s, %s)", (INVALIDATION_CHANNEL, str(user_id)))
+
+    def stats(self) -> Dict[str, Any]:
+        return {'users': self.users.stats(), 'usernames': self.usernames.stats()}
+
+cache = UserCache()
\ No newline at end of file
@@ -1,7 +1,12 @@
 import json
-import os
 from typing import Dict, Any
 
+import db
+import metrics
+import session
+import user_cache
+
+@metrics.instrumented('profile')
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Update user profile - nickname, avatar, settings
@@ -16,15 +21,13 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'PUT, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id',
+                'Access-Control-Allow-Headers': 'Content-Type, Authorization',
                 'Access-Control-Max-Age': '86400'
             },
             'body': ''
         }
     
     if method == 'PUT':
-        import psycopg2
-        
         body_data = json.loads(event.get('body', '{}'))
         user_id = body_data.get('user_id')
         nickname = body_data.get('nickname')
@@ -32,15 +35,21 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         hide_online_status = body_data.get('hide_online_status')
         theme = body_data.get('theme')
         
+        try:
+            session.authorize(event, user_id)
+        except session.Denied as denied:
+            return denied.response()
+        
         if not user_id:
             return {
                 'statusCode': 400,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'user_id required'})
+                'body': metrics.dumps({'error': 'user_id required'})
             }
         
-        conn = psycopg2.connect(os.environ['DATABASE_URL'])
+        conn = db.acquire()
         cur = conn.cursor()
+        token = None
         
         try:
             updates = []
@@ -66,19 +75,21 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 params.append(user_id)
                 query = f"UPDATE users SET {', '.join(updates)}, updated_at = CURRENT_TIMESTAMP WHERE id = %s"
                 cur.execute(query, tuple(params))
+                user_cache.cache.invalidate(conn, user_id)
                 conn.commit()
+                token = db.write_token(conn)
             
             return {
                 'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'success': True})
+                'headers': dict({'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}, **db.token_headers(token)),
+                'body': metrics.dumps({'success': True})
             }
         finally:
             cur.close()
-            conn.close()
+            db.release(conn)
     
     return {
         'statusCode': 405,
         'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'error': 'Method not allowed'})
+        'body': metrics.dumps({'error': 'Method not allowed'})
     }
@@ -1,12 +1,67 @@
 import json
 import os
-from typing import Dict, Any
+from typing import Dict, Any, List
 
+import db
+import metrics
+import presence
+import session
+import user_cache
+
+DEFAULT_SEARCH_LIMIT = 10
+MAX_SEARCH_LIMIT = 50
+MAX_SEARCH_OFFSET = 500
+MAX_PRESENCE_IDS = 500
+
+# Short-lived cache so a user typing and backspacing reuses recent results
+search_cache = user_cache.LRUCache(
+    int(os.environ.get('USER_SEARCH_CACHE_SIZE', '1000')),
+    float(os.environ.get('USER_SEARCH_CACHE_TTL', '10'))
+)
+
+SEARCH_USERS = db.statement('users_search', """
+    SELECT id, username, nickname, avatar_url
+    FROM (
+        SELECT id, username, nickname, avatar_url,
+               (username ILIKE %(prefix)s OR nickname ILIKE %(prefix)s) AS is_prefix,
+               GREATEST(similarity(username, %(query)s), similarity(COALESCE(nickname, ''), %(query)s)) AS score
+        FROM users
+        WHERE username ILIKE %(prefix)s OR nickname ILIKE %(prefix)s
+           OR username %% %(query)s OR nickname %% %(query)s
+    ) matches
+    ORDER BY is_prefix DESC, score DESC, username
+    LIMIT %(limit)s OFFSET %(offset)s
+""")
+
+def search_users(conn: Any, query: str, limit: int, offset: int) -> List[Dict[str, Any]]:
+    '''
+    Users whose username or nickname starts with the query, then fuzzy
+    trigram matches, best first. Served by the pg_trgm GIN indexes.
+    '''
+    key = (query.lower(), limit, offset)
+    cached = search_cache.get(key)
+    if cached is not None:
+        return cached
+    
+    prefix = query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+    
+    with conn.cursor() as cur:
+        SEARCH_USERS.execute(cur, {'prefix': prefix, 'query': query, 'limit': limit, 'offset': offset})
+        users = [
+            {'id': row[0], 'username': row[1], 'nickname': row[2], 'avatar_url': row[3]}
+            for row in cur.fetchall()
+        ]
+    
+    search_cache.set(key, users)
+    return users
+
+@metrics.instrumented('users')
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
-    Business: Find users by username
-    Args: event with httpMethod, queryStringParameters; context with request_id
-    Returns: HTTP response with user data
+    Business: Find users by username, search by username/nickname prefix and similarity, track presence
+    Args: event with httpMethod, queryStringParameters (username, q with limit and offset, or presence_ids),
+          body (action heartbeat/offline, user_id); context with request_id
+    Returns: HTTP response with user or presence data
     '''
     method: str = event.get('httpMethod', 'GET')
     
@@ -15,42 +70,96 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'statusCode': 200,
             'headers': {
                 'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type',
+                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type, Authorization, X-Min-Lsn',
                 'Access-Control-Max-Age': '86400'
             },
             'body': ''
         }
     
     if method == 'GET':
-        import psycopg2
-        import psycopg2.extras
-        
         params = event.get('queryStringParameters', {})
+        
+        try:
+            session.authorize(event)
+        except session.Denied as denied:
+            return denied.response()
+        
         username = params.get('username', '').strip()
+        query = params.get('q', '').strip()
+        
+        if params.get('presence_ids'):
+            try:
+                user_ids = [int(uid) for uid in params['presence_ids'].split(',') if uid.strip()]
+            except ValueError:
+                return {
+                    'statusCode': 400,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': metrics.dumps({'error': 'presence_ids must be comma-separated integers'})
+                }
+            
+            if len(user_ids) > MAX_PRESENCE_IDS:
+                return {
+                    'statusCode': 400,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': metrics.dumps({'error': 'at most %d presence_ids per request' % MAX_PRESENCE_IDS})
+                }
+            
+            conn = db.acquire()
+            
+            try:
+                statuses = presence.get_many(conn, user_ids)
+            finally:
+                db.release(conn)
+            
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': metrics.dumps({'presence': {str(uid): status for uid, status in statuses.items()}})
+            }
+        
+        if query:
+            try:
+                limit = max(1, min(int(params.get('limit') or DEFAULT_SEARCH_LIMIT), MAX_SEARCH_LIMIT))
+                offset = max(0, min(int(params.get('offset') or 0), MAX_SEARCH_OFFSET))
+            except ValueError:
+                return {
+                    'statusCode': 400,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': metrics.dumps({'error': 'limit and offset must be integers'})
+                }
+            
+            conn = db.acquire(readonly=True, min_lsn=db.requested_lsn(event))
+            
+            try:
+                users = search_users(conn, query[:64], limit, offset)
+            finally:
+                db.release(conn)
+            
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': metrics.dumps({'users': users})
+            }
         
         if not username:
             return {
                 'statusCode': 400,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'username required'})
+                'body': metrics.dumps({'error': 'username or q required'})
             }
         
-        conn = psycopg2.connect(os.environ['DATABASE_URL'])
-        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        conn = db.acquire(readonly=True, min_lsn=db.requested_lsn(event))
         
         try:
-            cur.execute(
-                "SELECT id, username, nickname, avatar_url FROM users WHERE username = %s",
-                (username,)
-            )
-            user = cur.fetchone()
+            user_cache.cache.listen(conn)
+            user = user_cache.cache.get_by_username(conn, username)
             
             if user:
                 return {
                     'statusCode': 200,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({
+                    'body': metrics.dumps({
                         'user': {
                             'id': user['id'],
                             'username': user['username'],
@@ -63,14 +172,59 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 return {
                     'statusCode': 404,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'User not found'})
+                    'body': metrics.dumps({'error': 'User not found'})
                 }
         finally:
-            cur.close()
-            conn.close()
+            db.release(conn)
+    
+    if method == 'POST':
+        body_data = json.loads(event.get('body', '{}'))
+        action = body_data.get('action')
+        
+        try:
+            session.authorize(event, body_data.get('user_id'))
+        except session.Denied as denied:
+            return denied.response()
+        
+        try:
+            user_id = int(body_data.get('user_id'))
+        except (TypeError, ValueError):
+            return {
+                'statusCode': 400,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': metrics.dumps({'error': 'user_id required'})
+            }
+        
+        if action not in ('heartbeat', 'offline'):
+            return {
+                'statusCode': 400,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': metrics.dumps({'error': 'action must be heartbeat or offline'})
+            }
+        
+        conn = db.acquire()
+        
+        try:
+            if action == 'heartbeat':
+                presence.heartbeat(conn, user_id)
+            else:
+                presence.go_offline(conn, user_id)
+            conn.commit()
+        finally:
+            db.release(conn)
+        
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': metrics.dumps({'success': True, 'ttl': presence.PRESENCE_TTL})
+        }
     
     return {
         'statusCode': 405,
         'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'error': 'Method not allowed'})
+        'body': metrics.dumps({'error': 'Method not allowed'})
     }
+
+
+# Runs once per container, when the platform imports this module
+db.warm_up()
\ No newline at end of file
@@ -0,0 +1,248 @@
+'''
+Per-invocation instrumentation. @instrumented wraps a handler and records
+total latency, time spent acquiring a connection, serializing the body and
+in the database, plus the number of round trips and rows. Statements are
+timed by a cursor mixin that db.PooledConnection applies to every cursor.
+Each request emits one JSON log line; latency histograms per function,
+method and status class are logged every METRICS_FLUSH_INTERVAL seconds,
+and statements slower than SLOW_QUERY_MS are logged with a fingerprint
+(literals and parameters stripped). METRICS_ENABLED=0 turns it all off.
+Each function ships its own copy of this module.
+'''
+import bisect
+import functools
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+ENABLED = os.environ.get('METRICS_ENABLED', '1') != '0'
+LOG_REQUESTS = os.environ.get('METRICS_LOG_REQUESTS', '1') != '0'
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '100'))
+FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', '60'))
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+_FINGERPRINT_RULES = [
+    (re.compile(r'--[^\n]*'), ''),
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r'%\(\w+\)s|%s'), '?'),
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),
+    (re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)(?:\s*,\s*\(\s*\?(?:\s*,\s*\?)*\s*\))*'), '(...)'),
+    (re.compile(r'\s+'), ' '),
+]
+
+_local = threading.local()
+
+class RequestStats:
+    '''
+    Counters for the invocation running on the current thread.
+    '''
+    def __init__(self) -> None:
+        self.queries = 0
+        self.rows = 0
+        self.db_ms = 0.0
+        self.phases: Dict[str, float] = {}
+
+    def add_phase(self, name: str, ms: float) -> None:
+        self.phases[name] = self.phases.get(name, 0.0) + ms
+
+def current() -> Optional[RequestStats]:
+    return getattr(_local, 'stats', None)
+
+class phase:
+    '''
+    Attribute the time spent in the block to a named phase of the request.
+    A class rather than @contextmanager, which costs a generator per block.
+    '''
+    __slots__ = ('name', 'stats', 'start')
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    def __enter__(self) -> None:
+        self.stats = current()
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info: Any) -> None:
+        if self.stats is not None:
+            self.stats.add_phase(self.name, (time.perf_counter() - self.start) * 1000)
+
+def fingerprint(sql: Any) -> str:
+    if isinstance(sql, bytes):
+        sql = sql.decode('utf-8', 'replace')
+    sql = str(sql)
+    for pattern, replacement in _FINGERPRINT_RULES:
+        sql = pattern.sub(replacement, sql)
+    return sql.strip()
+
+def _record_statement(sql: Any, start: float, rowcount: int) -> None:
+    ms = (time.perf_counter() - start) * 1000
+    stats = getattr(_local, 'stats', None)
+    if stats is not None:
+        stats.queries += 1
+        stats.db_ms += ms
+        stats.rows += max(rowcount, 0)
+    if ms >= SLOW_QUERY_MS:
+        text = fingerprint(sql)
+        print(json.dumps({
+            'metric': 'slow_query',
+            'ms': round(ms, 2),
+            'rows': rowcount,
+            'fingerprint_id': hashlib.md5(text.encode()).hexdigest()[:12],
+            'fingerprint': text[:2000]
+        }))
+
+class InstrumentedCursorMixin:
+    '''
+    Times execute/executemany and counts them as round trips.
+    '''
+    def execute(self, query: Any, vars: Any = None) -> Any:
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            _record_statement(query, start, self.rowcount)
+
+    def executemany(self, query: Any, vars_list: Any) -> Any:
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            _record_statement(query, start, self.rowcount)
+
+_cursor_classes: Dict[type, type] = {}
+
+def instrument_cursor_class(base: type) -> type:
+    '''
+    Subclass of the given cursor factory with statement timing mixed in.
+    '''
+    if not ENABLED:
+        return base
+    cls = _cursor_classes.get(base)
+    if cls is None:
+        cls = type('Instrumented' + base.__name__, (InstrumentedCursorMixin, base), {})
+        _cursor_classes[base] = cls
+    return cls
+
+def dumps(obj: Any) -> str:
+    '''
+    json.dumps that counts towards the serialize phase.
+    '''
+    with phase('serialize'):
+        return json.dumps(obj)
+
+class Histogram:
+    def __init__(self) -> None:
+        self.counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, ms: float) -> None:
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS_MS, ms)] += 1
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def percentile(self, q: float) -> Optional[float]:
+        '''
+        Upper bound of the bucket holding the q-th observation.
+        '''
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return LATENCY_BUCKETS_MS[index] if index < len(LATENCY_BUCKETS_MS) else self.max_ms
+        return self.max_ms
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'count': self.count,
+            'mean_ms': round(self.total_ms / self.count, 2) if self.count else None,
+            'max_ms': round(self.max_ms, 2),
+            'p50_ms': self.percentile(0.5),
+            'p95_ms': self.percentile(0.95),
+            'p99_ms': self.percentile(0.99),
+            'buckets': dict(zip([str(b) for b in LATENCY_BUCKETS_MS] + ['+Inf'], self.counts))
+        }
+
+class Registry:
+    def __init__(self) -> None:
+        self.histograms: Dict[Tuple[str, str, str], Histogram] = {}
+        self.flushed_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def observe(self, function: str, method: str, status: int, ms: float) -> None:
+        key = (function, method, '%dxx' % (status // 100))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(ms)
+
+    def maybe_flush(self, force: bool = False) -> None:
+        now = time.monotonic()
+        # Unlocked early exit for the common case; checked again below
+        if not force and now - self.flushed_at < FLUSH_INTERVAL:
+            return
+        with self._lock:
+            if not self.histograms or (not force and now - self.flushed_at < FLUSH_INTERVAL):
+                return
+            histograms, self.histograms = self.histograms, {}
+            self.flushed_at = now
+        lines: List[Dict[str, Any]] = [
+            dict(function=key[0], method=key[1], status=key[2], **histogram.to_dict())
+            for key, histogram in sorted(histograms.items())
+        ]
+        print(json.dumps({'metric': 'latency_histograms', 'histograms': lines}))
+
+registry = Registry()
+
+def instrumented(function: str) -> Callable[[Callable[..., Dict[str, Any]]], Callable[..., Dict[str, Any]]]:
+    '''
+    Decorator for a cloud function handler.
+    '''
+    def decorate(handler: Callable[..., Dict[str, Any]]) -> Callable[..., Dict[str, Any]]:
+        if not ENABLED:
+            return handler
+        function_json = json.dumps(function)
+
+        @functools.wraps(handler)
+        def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+            stats = RequestStats()
+            _local.stats = stats
+            start = time.perf_counter()
+            status = 500
+            body_bytes = 0
+            try:
+                response = handler(event, context)
+                status = response.get('statusCode', 200)
+                body_bytes = len(response.get('body') or '')
+                return response
+            finally:
+                _local.stats = None
+                total_ms = (time.perf_counter() - start) * 1000
+                method = event.get('httpMethod', 'GET')
+                registry.observe(function, method, status, total_ms)
+                if LOG_REQUESTS:
+                    # Formatted by hand: json.dumps of the whole record was
+                    # most of what the wrapper cost
+                    print(
+                        '{"metric": "request", "function": %s, "method": %s, "status": %d, "request_id": %s, '
+                        '"ms": %.2f, "db_ms": %.2f, "queries": %d, "rows": %d, "phases_ms": {%s}, "body_bytes": %d}' % (
+                            function_json, json.dumps(method), status, json.dumps(getattr(context, 'request_id', None)),
+                            total_ms, stats.db_ms, stats.queries, stats.rows,
+                            ', '.join('"%s": %.2f' % item for item in stats.phases.items()), body_bytes
+                        )
+                    )
+                registry.maybe_flush()
+
+        return wrapper
+
+    return decorate
\ No newline at end of file
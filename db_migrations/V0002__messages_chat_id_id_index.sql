@@ -0,0 +1,3 @@
+CREATE INDEX IF NOT EXISTS idx_messages_chat_id_id ON messages(chat_id, id);
+
+DROP INDEX IF EXISTS idx_messages_chat_id;
\ No newline at end of file
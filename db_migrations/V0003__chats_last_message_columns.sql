@@ -0,0 +1,14 @@
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS last_message_id INTEGER;
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS last_message_at TIMESTAMP;
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS last_message_preview TEXT;
+
+UPDATE chats c
+SET last_message_id = m.id,
+    last_message_at = m.created_at,
+    last_message_preview = LEFT(m.content, 200)
+FROM (
+    SELECT DISTINCT ON (chat_id) id, chat_id, content, created_at
+    FROM messages
+    ORDER BY chat_id, id DESC
+) m
+WHERE m.chat_id = c.id;
\ No newline at end of file
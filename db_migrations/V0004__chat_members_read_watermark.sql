@@ -0,0 +1,13 @@
+ALTER TABLE chat_members ADD COLUMN IF NOT EXISTS last_read_message_id INTEGER NOT NULL DEFAULT 0;
+
+UPDATE chat_members cm
+SET last_read_message_id = r.message_id
+FROM (
+    SELECT m.chat_id, reader.user_id, MAX(m.id) AS message_id
+    FROM messages m
+    CROSS JOIN LATERAL unnest(m.read_by) AS reader(user_id)
+    GROUP BY m.chat_id, reader.user_id
+) r
+WHERE r.chat_id = cm.chat_id
+  AND r.user_id = cm.user_id
+  AND r.message_id > cm.last_read_message_id;
\ No newline at end of file
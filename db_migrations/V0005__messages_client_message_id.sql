@@ -0,0 +1,5 @@
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS client_message_id VARCHAR(64);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_sender_client_message_id
+    ON messages(sender_id, client_message_id)
+    WHERE client_message_id IS NOT NULL;
\ No newline at end of file
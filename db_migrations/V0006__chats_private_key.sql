@@ -0,0 +1,19 @@
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS private_key VARCHAR(64);
+
+UPDATE chats c
+SET private_key = p.private_key
+FROM (
+    SELECT chat_id, private_key,
+           ROW_NUMBER() OVER (PARTITION BY private_key ORDER BY chat_id) AS rn
+    FROM (
+        SELECT cm.chat_id, MIN(cm.user_id) || ':' || MAX(cm.user_id) AS private_key
+        FROM chat_members cm
+        INNER JOIN chats ch ON ch.id = cm.chat_id
+        WHERE ch.type = 'private'
+        GROUP BY cm.chat_id
+        HAVING COUNT(*) = 2
+    ) pairs
+) p
+WHERE c.id = p.chat_id AND p.rn = 1;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_chats_private_key ON chats(private_key) WHERE private_key IS NOT NULL;
\ No newline at end of file
@@ -0,0 +1 @@
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_messages_content_tsv ON messages USING gin (content_tsv);
\ No newline at end of file
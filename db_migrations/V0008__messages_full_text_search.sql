@@ -0,0 +1,19 @@
+-- A plain nullable column is a catalog-only change, where a generated one
+-- would rewrite messages under an exclusive lock. The trigger fills it for
+-- new and edited rows; scripts/backfill_content_tsv.py fills existing ones
+-- in batches, and V0008.1 builds the index without blocking writes.
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS content_tsv tsvector;
+
+CREATE OR REPLACE FUNCTION messages_content_tsv()
+RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    NEW.content_tsv := to_tsvector('russian', NEW.content);
+    RETURN NEW;
+END $$;
+
+DROP TRIGGER IF EXISTS messages_content_tsv ON messages;
+CREATE TRIGGER messages_content_tsv
+    BEFORE INSERT OR UPDATE OF content ON messages
+    FOR EACH ROW EXECUTE FUNCTION messages_content_tsv();
\ No newline at end of file
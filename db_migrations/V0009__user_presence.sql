@@ -0,0 +1,6 @@
+CREATE UNLOGGED TABLE IF NOT EXISTS user_presence (
+    user_id INTEGER PRIMARY KEY,
+    last_seen_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+) WITH (fillfactor = 70);
+
+UPDATE users SET is_online = false WHERE is_online;
\ No newline at end of file
@@ -0,0 +1,14 @@
+-- Step 1 of moving messages to monthly partitions without downtime: the
+-- existing table becomes the first partition, covering everything before
+-- the start of the month after next. The bound is added NOT VALID here and
+-- validated in the next migration so no long scan runs under a strong lock.
+UPDATE messages SET created_at = CURRENT_TIMESTAMP WHERE created_at IS NULL;
+
+DO $$
+BEGIN
+    EXECUTE format(
+        'ALTER TABLE messages ADD CONSTRAINT messages_legacy_partition_bound '
+        'CHECK (created_at IS NOT NULL AND created_at < %L) NOT VALID',
+        date_trunc('month', LOCALTIMESTAMP) + interval '2 months'
+    );
+END $$;
\ No newline at end of file
@@ -0,0 +1,20 @@
+ALTER TABLE messages VALIDATE CONSTRAINT messages_legacy_partition_bound;
+
+-- Idempotency keys cannot stay unique on a table partitioned by created_at,
+-- so they move to their own table
+CREATE TABLE IF NOT EXISTS message_client_ids (
+    sender_id INTEGER NOT NULL,
+    client_message_id VARCHAR(64) NOT NULL,
+    message_id INTEGER NOT NULL,
+    created_at TIMESTAMP NOT NULL,
+    PRIMARY KEY (sender_id, client_message_id)
+);
+
+INSERT INTO message_client_ids (sender_id, client_message_id, message_id, created_at)
+SELECT sender_id, client_message_id, id, created_at
+FROM messages
+WHERE client_message_id IS NOT NULL
+ON CONFLICT DO NOTHING;
+
+-- Time of the read watermark message, so unread counts can prune partitions
+ALTER TABLE chat_members ADD COLUMN IF NOT EXISTS last_read_at TIMESTAMP;
\ No newline at end of file
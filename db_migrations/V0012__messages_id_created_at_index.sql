@@ -0,0 +1 @@
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS messages_legacy_id_created_at_key ON messages (id, created_at);
\ No newline at end of file
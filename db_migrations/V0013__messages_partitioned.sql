@@ -0,0 +1,95 @@
+CREATE OR REPLACE FUNCTION messages_ensure_partitions(months_ahead INTEGER DEFAULT 3)
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    month_start TIMESTAMP := date_trunc('month', LOCALTIMESTAMP);
+    partition_name TEXT;
+    created INTEGER := 0;
+BEGIN
+    FOR i IN 0..months_ahead LOOP
+        partition_name := 'messages_p' || to_char(month_start, 'YYYY_MM');
+        IF to_regclass(partition_name) IS NULL THEN
+            BEGIN
+                EXECUTE format(
+                    'CREATE TABLE %I PARTITION OF messages FOR VALUES FROM (%L) TO (%L)',
+                    partition_name, month_start, month_start + interval '1 month'
+                );
+                created := created + 1;
+            EXCEPTION WHEN invalid_object_definition THEN
+                -- Month is still covered by messages_legacy
+                NULL;
+            END;
+        END IF;
+        month_start := month_start + interval '1 month';
+    END LOOP;
+    RETURN created;
+END $$;
+
+-- Swap in the partitioned table. Everything below is catalog-only: the
+-- partition bound and the (id, created_at) index were prepared by the
+-- previous migrations, so ATTACH skips its validation scan and reuses the
+-- existing indexes. The old single-column primary key gives way to
+-- (id, created_at), which a partitioned table requires.
+ALTER TABLE messages RENAME TO messages_legacy;
+ALTER TABLE messages_legacy DROP CONSTRAINT messages_pkey;
+ALTER INDEX idx_messages_chat_id_id RENAME TO messages_legacy_chat_id_id_idx;
+ALTER INDEX idx_messages_content_tsv RENAME TO messages_legacy_content_tsv_idx;
+-- The partitioned table's own trigger is cloned onto it when it is attached
+DROP TRIGGER messages_content_tsv ON messages_legacy;
+ALTER TABLE messages_legacy ALTER COLUMN created_at SET NOT NULL;
+ALTER TABLE messages_legacy ADD CONSTRAINT messages_legacy_pkey PRIMARY KEY USING INDEX messages_legacy_id_created_at_key;
+
+-- Keys written by the old code since the backfill in V0011
+INSERT INTO message_client_ids (sender_id, client_message_id, message_id, created_at)
+SELECT sender_id, client_message_id, id, created_at
+FROM messages_legacy
+WHERE client_message_id IS NOT NULL
+  AND id > (SELECT COALESCE(MAX(message_id), 0) FROM message_client_ids)
+ON CONFLICT DO NOTHING;
+
+DROP INDEX IF EXISTS idx_messages_sender_client_message_id;
+
+CREATE TABLE messages (
+    id INTEGER NOT NULL DEFAULT nextval('messages_id_seq'),
+    chat_id INTEGER,
+    sender_id INTEGER,
+    content TEXT NOT NULL,
+    message_type VARCHAR(50) DEFAULT 'text',
+    file_url TEXT,
+    is_system BOOLEAN DEFAULT false,
+    read_by INTEGER[] DEFAULT '{}',
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    client_message_id VARCHAR(64),
+    content_tsv tsvector,
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+CREATE INDEX idx_messages_chat_id_id ON messages (chat_id, id);
+CREATE INDEX idx_messages_content_tsv ON messages USING gin (content_tsv);
+CREATE TRIGGER messages_content_tsv
+    BEFORE INSERT OR UPDATE OF content ON messages
+    FOR EACH ROW EXECUTE FUNCTION messages_content_tsv();
+
+ALTER SEQUENCE messages_id_seq OWNED BY messages.id;
+
+DO $$
+DECLARE
+    legacy_upper TEXT;
+BEGIN
+    SELECT (regexp_match(pg_get_constraintdef(oid), '''([^'']+)'''))[1]
+    INTO legacy_upper
+    FROM pg_constraint
+    WHERE conname = 'messages_legacy_partition_bound';
+
+    EXECUTE format(
+        'ALTER TABLE messages ATTACH PARTITION messages_legacy FOR VALUES FROM (MINVALUE) TO (%L)',
+        legacy_upper
+    );
+END $$;
+
+ALTER TABLE messages_legacy DROP CONSTRAINT messages_legacy_partition_bound;
+
+CREATE TABLE messages_default PARTITION OF messages DEFAULT;
+
+SELECT messages_ensure_partitions(12);
\ No newline at end of file
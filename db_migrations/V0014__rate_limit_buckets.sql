@@ -0,0 +1,32 @@
+CREATE UNLOGGED TABLE IF NOT EXISTS rate_limit_buckets (
+    key VARCHAR(200) PRIMARY KEY,
+    tokens DOUBLE PRECISION NOT NULL,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+) WITH (fillfactor = 70);
+
+CREATE INDEX IF NOT EXISTS idx_rate_limit_buckets_updated_at ON rate_limit_buckets (updated_at);
+
+-- Token bucket shared by every container: refills at p_rate tokens per
+-- second up to p_burst and takes p_cost if that many are available.
+-- Returns 0 when the request may proceed, otherwise the seconds until it
+-- could. The upsert's row lock serializes concurrent callers for one key.
+CREATE OR REPLACE FUNCTION rate_limit_take(p_key VARCHAR, p_rate DOUBLE PRECISION, p_burst DOUBLE PRECISION, p_cost DOUBLE PRECISION)
+RETURNS DOUBLE PRECISION AS $$
+DECLARE
+    now_ts TIMESTAMP := clock_timestamp();
+    available DOUBLE PRECISION;
+BEGIN
+    INSERT INTO rate_limit_buckets AS b (key, tokens, updated_at)
+    VALUES (p_key, p_burst, now_ts)
+    ON CONFLICT (key) DO UPDATE
+    SET tokens = LEAST(p_burst, b.tokens + GREATEST(EXTRACT(EPOCH FROM now_ts - b.updated_at), 0) * p_rate),
+        updated_at = now_ts
+    RETURNING tokens INTO available;
+
+    IF available >= p_cost THEN
+        UPDATE rate_limit_buckets SET tokens = available - p_cost WHERE key = p_key;
+        RETURN 0;
+    END IF;
+    RETURN (p_cost - available) / p_rate;
+END;
+$$ LANGUAGE plpgsql;
\ No newline at end of file
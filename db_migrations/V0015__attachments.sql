@@ -0,0 +1,48 @@
+-- File contents, stored once per SHA-256 however many attachments use them
+CREATE TABLE IF NOT EXISTS attachment_blobs (
+    sha256 CHAR(64) PRIMARY KEY,
+    size BIGINT NOT NULL,
+    content_type VARCHAR(255) NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS attachments (
+    id SERIAL PRIMARY KEY,
+    uploader_id INTEGER NOT NULL,
+    sha256 CHAR(64) NOT NULL,
+    file_name VARCHAR(255) NOT NULL,
+    content_type VARCHAR(255) NOT NULL,
+    size BIGINT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_attachments_sha256 ON attachments(sha256);
+
+-- Uploads in progress; received is the length of the contiguous prefix
+-- already staged, which is where a resumed upload continues
+CREATE TABLE IF NOT EXISTS attachment_uploads (
+    id VARCHAR(32) PRIMARY KEY,
+    uploader_id INTEGER NOT NULL,
+    file_name VARCHAR(255) NOT NULL,
+    content_type VARCHAR(255) NOT NULL,
+    size BIGINT NOT NULL,
+    received BIGINT NOT NULL DEFAULT 0,
+    sha256 CHAR(64),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_attachment_uploads_updated_at ON attachment_uploads(updated_at);
+
+-- One job per image blob, drained by scripts/attachments_worker.py
+CREATE TABLE IF NOT EXISTS thumbnail_jobs (
+    sha256 CHAR(64) PRIMARY KEY,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    run_after TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_thumbnail_jobs_pending ON thumbnail_jobs(run_after) WHERE status = 'pending';
\ No newline at end of file
@@ -0,0 +1,14 @@
+-- Side effects of a send are queued here in the send transaction and
+-- applied in batches by the messages outbox drain, so concurrent senders
+-- in one chat no longer wait on its row lock
+CREATE TABLE IF NOT EXISTS message_outbox (
+    id BIGSERIAL PRIMARY KEY,
+    event VARCHAR(32) NOT NULL,
+    chat_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    message_created_at TIMESTAMP NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Readers add pending messages to chats.last_message_id
+CREATE INDEX IF NOT EXISTS idx_message_outbox_chat_id ON message_outbox (chat_id, message_id);
\ No newline at end of file
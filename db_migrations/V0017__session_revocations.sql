@@ -0,0 +1,15 @@
+-- Revoked session tokens. A row revokes one session (session_id) or every
+-- session of user_id issued up to issued_before (epoch seconds, as in the
+-- token). Functions cache the rows in memory and read only ids newer than
+-- the last one they saw; rows are useless once expires_at (epoch seconds)
+-- has passed, because the tokens they cover have expired too.
+CREATE TABLE IF NOT EXISTS session_revocations (
+    id BIGSERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    session_id VARCHAR(32),
+    issued_before BIGINT,
+    expires_at BIGINT NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_session_revocations_expires_at ON session_revocations (expires_at);
\ No newline at end of file
@@ -0,0 +1,5 @@
+-- The chat an attachment was uploaded for; its members may download it
+-- along with the uploader. Attachments without one stay private to the
+-- uploader.
+ALTER TABLE attachments ADD COLUMN IF NOT EXISTS chat_id INTEGER;
+ALTER TABLE attachment_uploads ADD COLUMN IF NOT EXISTS chat_id INTEGER;
\ No newline at end of file
@@ -0,0 +1,6 @@
+-- Containers sharing ADMISSION_GLOBAL_MAX_CONCURRENCY; each refreshes its
+-- row and sizes its admission gate to total / live rows
+CREATE UNLOGGED TABLE IF NOT EXISTS admission_containers (
+    id VARCHAR(32) PRIMARY KEY,
+    seen_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
\ No newline at end of file
@@ -0,0 +1,57 @@
+-- A row dated past the last month partition lands in messages_default, and
+-- from then on creating that month's partition fails the default
+-- partition's check and aborted the whole messages_ensure_partitions() call.
+-- Now such a month is built as a plain table, its rows are moved over from
+-- messages_default and the table is attached as the month's partition.
+CREATE OR REPLACE FUNCTION messages_ensure_partitions(months_ahead INTEGER DEFAULT 3)
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    month_start TIMESTAMP := date_trunc('month', LOCALTIMESTAMP);
+    partition_name TEXT;
+    columns TEXT;
+    moved BIGINT;
+    created INTEGER := 0;
+BEGIN
+    SELECT string_agg(quote_ident(attname), ', ' ORDER BY attnum) INTO columns
+    FROM pg_attribute
+    WHERE attrelid = 'messages'::regclass AND attnum > 0 AND NOT attisdropped AND attgenerated = '';
+
+    FOR i IN 0..months_ahead LOOP
+        partition_name := 'messages_p' || to_char(month_start, 'YYYY_MM');
+        IF to_regclass(partition_name) IS NULL THEN
+            BEGIN
+                EXECUTE format(
+                    'CREATE TABLE %I PARTITION OF messages FOR VALUES FROM (%L) TO (%L)',
+                    partition_name, month_start, month_start + interval '1 month'
+                );
+                created := created + 1;
+            EXCEPTION
+                WHEN invalid_object_definition THEN
+                    -- Month is still covered by messages_legacy
+                    NULL;
+                WHEN check_violation THEN
+                    -- messages_default already holds rows for this month
+                    EXECUTE format(
+                        'CREATE TABLE %I (LIKE messages INCLUDING DEFAULTS INCLUDING GENERATED INCLUDING CONSTRAINTS)',
+                        partition_name
+                    );
+                    EXECUTE format(
+                        'WITH moved AS (DELETE FROM messages_default WHERE created_at >= %L AND created_at < %L RETURNING %s) '
+                        'INSERT INTO %I (%s) SELECT %s FROM moved',
+                        month_start, month_start + interval '1 month', columns, partition_name, columns, columns
+                    );
+                    GET DIAGNOSTICS moved = ROW_COUNT;
+                    EXECUTE format(
+                        'ALTER TABLE messages ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                        partition_name, month_start, month_start + interval '1 month'
+                    );
+                    RAISE NOTICE 'moved % rows from messages_default to %', moved, partition_name;
+                    created := created + 1;
+            END;
+        END IF;
+        month_start := month_start + interval '1 month';
+    END LOOP;
+    RETURN created;
+END $$;
\ No newline at end of file
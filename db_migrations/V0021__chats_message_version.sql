@@ -0,0 +1,4 @@
+-- Bumped by the outbox drain every time it applies messages to a chat,
+-- including ones committed after a newer id, so version stamps change on
+-- every send even when last_message_id does not
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS message_version INTEGER NOT NULL DEFAULT 0;
\ No newline at end of file
@@ -0,0 +1,211 @@
+'''
+Measure attachment upload throughput and deduplication savings.
+
+    python scripts/attachments_benchmark.py --start-server --unique 20 --uploads 200 [--size-kb 256] [--json out.json]
+
+Builds a corpus of --unique random files and uploads --uploads files drawn
+from it with repetition (a few popular files make up most uploads, like
+forwarded photos), in chunks over HTTP from --clients threads. Runs twice:
+once declaring the SHA-256 up front, which the server checks the received
+bytes against, and once without it. Every byte goes over the wire either
+way; dedup happens after the server has hashed them. Reports files/s, MB/s
+of logical data, bytes actually transferred and the bytes stored versus
+uploaded.
+--start-server runs local_server in-process against DATABASE_URL.
+'''
+import argparse
+import hashlib
+import http.client
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlencode, urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+def make_corpus(unique: int, size_kb: int, rng: random.Random) -> List[bytes]:
+    '''
+    Files of roughly size_kb (half to double), random so they do not compress.
+    '''
+    corpus = []
+    for _ in range(unique):
+        size = int(size_kb * 1024 * rng.uniform(0.5, 2.0))
+        corpus.append(rng.randbytes(size))
+    return corpus
+
+def draw(corpus: List[bytes], uploads: int, rng: random.Random) -> List[bytes]:
+    # Zipf-like popularity: file i is picked with weight 1 / (i + 1)
+    weights = [1.0 / (i + 1) for i in range(len(corpus))]
+    return rng.choices(corpus, weights=weights, k=uploads)
+
+def register(base_url: str) -> Tuple[int, str]:
+    '''
+    A fresh account to upload as; returns its id and session token.
+    '''
+    parts = urlsplit(base_url)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=60)
+    body = {'action': 'register', 'username': 'bench_%s' % uuid.uuid4().hex[:8], 'password': 'benchmark1'}
+    conn.request('POST', parts.path.rstrip('/') + '/auth', body=json.dumps(body), headers={'Content-Type': 'application/json'})
+    response = conn.getresponse()
+    payload = json.loads(response.read() or b'{}')
+    conn.close()
+    if response.status != 200:
+        raise RuntimeError('register failed: %s %s' % (response.status, payload))
+    return payload['user']['id'], payload['token']
+
+class Uploader:
+    def __init__(self, base_url: str, user_id: int, token: str) -> None:
+        parts = urlsplit(base_url)
+        self.conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=60)
+        self.prefix = parts.path.rstrip('/') + '/attachments'
+        self.user_id = user_id
+        self.token = token
+        self.sent_bytes = 0
+
+    def _call(self, method: str, query: Dict[str, Any], body: bytes, content_type: str) -> Tuple[int, Dict[str, Any]]:
+        path = self.prefix + ('?' + urlencode(query) if query else '')
+        self.conn.request(method, path, body=body, headers={'Content-Type': content_type, 'Authorization': 'Bearer ' + self.token})
+        response = self.conn.getresponse()
+        return response.status, json.loads(response.read() or b'{}')
+
+    def upload(self, data: bytes, name: str, send_hash: bool) -> Dict[str, Any]:
+        start = {
+            'action': 'start',
+            'uploader_id': self.user_id,
+            'file_name': name,
+            'content_type': 'application/octet-stream',
+            'size': len(data)
+        }
+        if send_hash:
+            start['sha256'] = hashlib.sha256(data).hexdigest()
+        status, body = self._call('POST', {}, json.dumps(start).encode(), 'application/json')
+        if status != 200:
+            raise RuntimeError('start failed: %s %s' % (status, body))
+
+        upload_id, chunk_size, offset = body['upload_id'], body['chunk_size'], 0
+        while offset < len(data):
+            chunk = data[offset:offset + chunk_size]
+            status, body = self._call('PUT', {'upload_id': upload_id, 'offset': offset}, chunk, 'application/octet-stream')
+            if status == 409:
+                offset = body['received']
+                continue
+            if status != 200:
+                raise RuntimeError('chunk failed: %s %s' % (status, body))
+            self.sent_bytes += len(chunk)
+            offset += len(chunk)
+        return body
+
+def run(base_url: str, files: List[bytes], clients: int, send_hash: bool, label: str) -> Dict[str, Any]:
+    user_id, token = register(base_url)
+    queue = list(enumerate(files))
+    lock = threading.Lock()
+    totals = {'files': 0, 'logical_bytes': 0, 'sent_bytes': 0, 'deduplicated': 0, 'errors': 0}
+
+    def worker() -> None:
+        uploader = Uploader(base_url, user_id, token)
+        while True:
+            with lock:
+                if not queue:
+                    break
+                index, data = queue.pop()
+            try:
+                result = uploader.upload(data, '%s-%d.bin' % (label, index), send_hash)
+            except (OSError, RuntimeError, ValueError) as exc:
+                print('upload error: %s' % exc, file=sys.stderr)
+                with lock:
+                    totals['errors'] += 1
+                continue
+            with lock:
+                totals['files'] += 1
+                totals['logical_bytes'] += len(data)
+                totals['deduplicated'] += 1 if result.get('deduplicated') else 0
+        with lock:
+            totals['sent_bytes'] += uploader.sent_bytes
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=worker) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    totals['seconds'] = round(elapsed, 3)
+    totals['files_per_second'] = round(totals['files'] / elapsed, 1)
+    totals['logical_mb_per_second'] = round(totals['logical_bytes'] / elapsed / 1e6, 2)
+    return totals
+
+def stored_bytes(database_url: Optional[str]) -> Optional[int]:
+    if not database_url:
+        return None
+    import psycopg2
+    conn = psycopg2.connect(database_url)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT COALESCE(SUM(size), 0) FROM attachment_blobs")
+            return int(cur.fetchone()[0])
+    finally:
+        conn.close()
+
+def print_report(results: Dict[str, Dict[str, Any]], unique_bytes: int) -> None:
+    print('%-14s %6s %7s %8s %10s %12s %12s %6s' % (
+        'mode', 'files', 'errors', 'files/s', 'MB/s', 'logical MB', 'sent MB', 'dedup'))
+    for mode, result in results.items():
+        print('%-14s %6d %7d %8.1f %10.2f %12.1f %12.1f %6d' % (
+            mode, result['files'], result['errors'], result['files_per_second'], result['logical_mb_per_second'],
+            result['logical_bytes'] / 1e6, result['sent_bytes'] / 1e6, result['deduplicated']))
+    logical = sum(result['logical_bytes'] for result in results.values())
+    print('corpus %.1f MB unique; %.1f MB uploaded in total' % (unique_bytes / 1e6, logical / 1e6))
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Benchmark attachment uploads and dedup')
+    parser.add_argument('--base-url', help='running local_server; default starts one in-process')
+    parser.add_argument('--start-server', action='store_true', help='start local_server in-process (needs DATABASE_URL)')
+    parser.add_argument('--database-url', default=os.environ.get('DATABASE_URL'))
+    parser.add_argument('--unique', type=int, default=20, help='distinct files in the corpus')
+    parser.add_argument('--uploads', type=int, default=200, help='uploads per mode, drawn from the corpus')
+    parser.add_argument('--size-kb', type=int, default=256, help='typical file size')
+    parser.add_argument('--clients', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='write the report here')
+    args = parser.parse_args()
+
+    base_url = args.base_url
+    if base_url is None or args.start_server:
+        if not args.database_url:
+            parser.error('--base-url, or DATABASE_URL / --database-url with --start-server')
+        import local_server
+        os.environ['DATABASE_URL'] = args.database_url
+        os.environ.setdefault('METRICS_LOG_REQUESTS', '0')
+        _, base_url = local_server.start_server()
+
+    rng = random.Random(args.seed)
+    results = {}
+    # A fresh corpus per mode, so the second run cannot reuse the first one's blobs
+    for mode, send_hash in (('declared-hash', True), ('no-hash', False)):
+        corpus = make_corpus(args.unique, args.size_kb, rng)
+        before = stored_bytes(args.database_url)
+        results[mode] = run(base_url, draw(corpus, args.uploads, rng), args.clients, send_hash, mode)
+        after = stored_bytes(args.database_url)
+        if before is not None:
+            results[mode]['stored_bytes'] = after - before
+            results[mode]['savings'] = round(1 - results[mode]['stored_bytes'] / max(results[mode]['logical_bytes'], 1), 3)
+        results[mode]['unique_bytes'] = sum(len(data) for data in corpus)
+
+    print_report(results, sum(result['unique_bytes'] for result in results.values()))
+    if args.database_url:
+        for mode, result in results.items():
+            print('%s: stored %.1f MB, %.0f%% saved by dedup' % (mode, result['stored_bytes'] / 1e6, result['savings'] * 100))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0 if all(result['errors'] == 0 for result in results.values()) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
\ No newline at end of file
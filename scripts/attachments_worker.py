@@ -0,0 +1,97 @@
+'''
+Background work for attachments: renders queued thumbnails and removes
+abandoned uploads.
+
+    python scripts/attachments_worker.py [--once] [--batch 8] [--interval 2] [--upload-ttl 86400]
+
+Claims due thumbnail_jobs with FOR UPDATE SKIP LOCKED, so any number of
+workers can run side by side, and commits after each job. Uploads not
+touched for --upload-ttl seconds are deleted along with their staged
+bytes. Rendering needs Pillow; without it the worker only sweeps uploads
+and leaves jobs pending. Uses the same DATABASE_URL, ATTACHMENTS_STORAGE
+and ATTACHMENTS_DIR as the attachments function.
+'''
+import argparse
+import os
+import sys
+import time
+from typing import Any, List
+
+import psycopg2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backend', 'attachments'))
+
+import storage
+import thumbnails
+
+def render_thumbnails(conn: Any, store: storage.Storage, batch: int) -> int:
+    done = 0
+    while done < batch:
+        with conn.cursor() as cur:
+            jobs = thumbnails.claim(cur, 1)
+            if not jobs:
+                conn.rollback()
+                break
+            status = thumbnails.run_job(cur, store, jobs[0])
+        conn.commit()
+        print('thumbnail %s %s' % (jobs[0]['sha256'], status))
+        done += 1
+    return done
+
+def sweep_uploads(conn: Any, store: storage.Storage, ttl: float) -> List[str]:
+    with conn.cursor() as cur:
+        cur.execute("""
+            DELETE FROM attachment_uploads
+            WHERE id IN (
+                SELECT id FROM attachment_uploads
+                WHERE updated_at < CURRENT_TIMESTAMP - make_interval(secs => %s)
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id
+        """, (ttl,))
+        upload_ids = [row[0] for row in cur.fetchall()]
+    conn.commit()
+    for upload_id in upload_ids:
+        store.discard_upload(upload_id)
+    return upload_ids
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Render attachment thumbnails and sweep abandoned uploads')
+    parser.add_argument('--once', action='store_true', help='process what is due and exit')
+    parser.add_argument('--batch', type=int, default=8, help='thumbnails per round')
+    parser.add_argument('--interval', type=float, default=2.0, help='seconds to sleep when idle')
+    parser.add_argument('--upload-ttl', type=float, default=24 * 3600)
+    args = parser.parse_args()
+
+    try:
+        import PIL  # noqa: F401
+        can_render = True
+    except ImportError:
+        print('Pillow is not installed; thumbnails stay pending', file=sys.stderr)
+        can_render = False
+
+    store = storage.get_storage()
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    last_sweep = 0.0
+
+    try:
+        while True:
+            rendered = render_thumbnails(conn, store, args.batch) if can_render else 0
+            idle = rendered < args.batch
+            if (args.once and idle) or time.monotonic() - last_sweep > 60:
+                swept = sweep_uploads(conn, store, args.upload_ttl)
+                if swept:
+                    print('removed %d abandoned uploads' % len(swept))
+                last_sweep = time.monotonic()
+            if idle:
+                if args.once:
+                    break
+                time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        conn.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
\ No newline at end of file
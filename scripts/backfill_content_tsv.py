@@ -0,0 +1,58 @@
+'''
+Fill messages.content_tsv for rows written before full-text search.
+
+    python scripts/backfill_content_tsv.py [--batch 5000] [--pause 0.05]
+
+V0008 adds the column without rewriting the table and a trigger keeps it
+filled for new and edited messages; this walks the older rows by id in
+batches of --batch ids, each in its own short transaction, so writers never
+wait on more than one batch. Rows that already have a value are skipped,
+so it can be stopped and run again. Uses DATABASE_URL.
+'''
+import argparse
+import os
+import sys
+import time
+
+import psycopg2
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Backfill messages.content_tsv in batches')
+    parser.add_argument('--batch', type=int, default=5000, help='ids per transaction')
+    parser.add_argument('--pause', type=float, default=0.05, help='seconds to sleep between batches')
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    after_id = 0
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT MIN(id), MAX(id) FROM messages WHERE content_tsv IS NULL")
+            low, high = cur.fetchone()
+        conn.commit()
+        if low is None:
+            print('nothing to backfill')
+            return 0
+
+        filled = 0
+        after_id = low - 1
+        while after_id < high:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    UPDATE messages
+                    SET content_tsv = to_tsvector('russian', content)
+                    WHERE id > %s AND id <= %s AND content_tsv IS NULL
+                """, (after_id, after_id + args.batch))
+                filled += cur.rowcount
+            conn.commit()
+            after_id += args.batch
+            if args.pause:
+                time.sleep(args.pause)
+        print('backfilled %d messages up to id %d' % (filled, high))
+    except KeyboardInterrupt:
+        print('stopped after id %d; run again to continue' % after_id)
+    finally:
+        conn.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
\ No newline at end of file
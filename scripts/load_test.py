@@ -0,0 +1,1539 @@
+'''
+Replay chat traffic against the local server and report latency per endpoint.
+
+    python scripts/load_test.py --start-server --users 60 --clients 24 --duration 30 [--json out.json]
+    python scripts/load_test.py --base-url http://127.0.0.1:8000 --baseline out.json --max-regression 0.25
+
+Seeds --users accounts (a private chat with each neighbour plus a few
+groups), then runs --clients threads for --duration seconds. Each client
+plays one user with its own keep-alive connection and picks actions from
+the scenario's weights: polling the chat list with If-None-Match, polling
+open chats with since_id, short long-polls, sends, batched sends, presence
+heartbeats and group creation. The contention scenario instead puts every
+user in one group and only sends. The report has count, errors, responses
+limited by admission control (429/503), throughput and p50/p95/p99/max of
+the admitted requests per endpoint. With --baseline, exits non-zero when an
+endpoint's p95 grew by more than --max-regression (and --min-delta-ms).
+--start-server runs local_server in-process against DATABASE_URL.
+
+    python scripts/load_test.py --start-server --bench history [--sizes 1000,1000000] [--requests 200]
+
+--bench runs a scale benchmark instead: the data is bulk-loaded straight
+into DATABASE_URL and one kind of request is timed at each of --sizes, so
+latency can be read against the size of the data. Run the server against
+it with RATE_LIMIT_ENABLED=0; --start-server does that.
+
+  history  polls of one chat (empty, 50 new, the client's overlap window,
+           first page) as its history grows to each size
+  waiters  size clients parked in long-polls while a few others send into
+           their chats: send latency, time until the waiter wakes, and the
+           database connections in use
+  partitions
+           messages grows to size rows spread over the last year: send
+           latency and sends/s, and the recent page read through the
+           function next to the same read over every partition
+  chat_list
+           the chat list of a user with size private chats, next to the
+           per-chat lookups it used to make; round trips are counted by
+           the function's own metrics (needs --start-server)
+  pool     chat list and chat page requests from size concurrent clients,
+           through the functions with their connection pool and with it
+           turned off (needs --start-server)
+  groups   creating a group of size members, next to the per-member inserts
+           it used to make, and re-opening an existing private chat
+  user_search
+           user search by prefix, with a typo and repeated, as the users
+           table grows to size synthetic accounts
+  search   full-text message search across a user's chats and within one,
+           for common and rare words, as messages grows to size rows
+  presence size users each send a heartbeat, again as if 30 s later and
+           again at once from a second tab; heartbeats/s against what size
+           users need, rows written to users and user_presence, presence
+           lookups and the expiry sweep (needs --start-server)
+  conditional
+           an idle client polling the chat list of size chats and a chat
+           page, with and without If-None-Match: latency, round trips,
+           database time and body bytes of 200s and 304s (needs
+           --start-server)
+  mark_read
+           every member of a group of size members marks its new messages
+           read at once: mark-reads/s, latency and rows written, next to
+           the per-message read_by updates it used to make (needs
+           --start-server)
+  export   one chat grows to size messages and is exported chunk by chunk
+           through the messages function in this process: chunks, time,
+           rows/s and peak RSS, which must stay under EXPORT_MAX_RSS_MB
+           however long the history (needs --start-server)
+  render   the chat list of a user with size chats built by the chats
+           function in Python and with render=db: handler CPU time, wall
+           time and peak traced allocations, the handler called in this
+           process (needs --start-server)
+'''
+import argparse
+import contextlib
+import http.client
+import io
+import json
+import os
+import random
+import resource
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from datetime import timedelta
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlencode, urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+SCENARIOS = {
+    'chat': {
+        'chats.list': 30,
+        'messages.poll': 30,
+        'messages.wait': 4,
+        'messages.send': 15,
+        'messages.batch': 4,
+        'messages.read': 6,
+        'users.heartbeat': 8,
+        'chats.create_group': 3
+    },
+    'burst': {
+        'chats.list': 10,
+        'messages.poll': 20,
+        'messages.send': 50,
+        'messages.batch': 20
+    },
+    # Many tabs per user hammering the read paths; run with --users well
+    # below --clients. Sends and mark-read should keep succeeding while
+    # polls are rate limited (429) or shed (503).
+    'storm': {
+        'chats.list': 35,
+        'messages.poll': 45,
+        'messages.send': 12,
+        'messages.read': 8
+    },
+    # Every client sends into one group chat holding all --users, e.g.
+    # --users 200 --clients 200: concurrent senders in a single busy chat.
+    'contention': {
+        'messages.send': 1
+    }
+}
+SHARED_CHAT_SCENARIOS = ('contention',)
+GROUP_SIZE = 5
+BATCH_SIZE = 5
+WAIT_TIMEOUT = 1
+LIMITED_STATUSES = (429, 503)
+# ChatWindow polls from this far behind the newest message it has
+OVERLAP_MS = 30000
+WAITER_SENDERS = 10
+WAITER_TIMEOUT = 20
+PARTITION_CHATS = 100
+PARTITION_SPAN_DAYS = 365
+PARTITION_LOAD_CHUNK = 1000000
+# Membership rows one size of the groups benchmark may create at most
+GROUP_MEMBER_ROWS = 200000
+# Synthetic accounts are named <first>_<last><n>
+SEARCH_FIRST_NAMES = ['alex', 'maria', 'ivan', 'olga', 'dmitry', 'anna', 'sergey', 'elena', 'pavel', 'irina',
+                      'nikita', 'daria', 'artem', 'sofia', 'maxim', 'polina', 'egor', 'vera', 'roman', 'alisa']
+SEARCH_LAST_NAMES = ['petrov', 'smirnova', 'kuznetsov', 'popova', 'volkov', 'sokolova', 'lebedev', 'kozlova',
+                     'novikov', 'morozova', 'orlov', 'pavlova', 'belov', 'vinogradova', 'bogdanov', 'zaitseva',
+                     'fedorov', 'mikhailova', 'tarasov', 'belyaeva']
+# The chat list before it was one query: two correlated subqueries per chat,
+# then a users lookup for every private chat
+OLD_CHATS_LIST = """
+    SELECT DISTINCT c.id, c.type, c.name, c.avatar_url, c.owner_id, c.updated_at,
+           (SELECT content FROM messages WHERE chat_id = c.id ORDER BY created_at DESC LIMIT 1) as last_message,
+           (SELECT created_at FROM messages WHERE chat_id = c.id ORDER BY created_at DESC LIMIT 1) as last_message_time
+    FROM chats c
+    INNER JOIN chat_members cm ON c.id = cm.chat_id
+    WHERE cm.user_id = %s
+    ORDER BY c.updated_at DESC
+"""
+OLD_CHATS_OTHER_USER = """
+    SELECT u.id, u.username, u.nickname, u.avatar_url
+    FROM users u
+    INNER JOIN chat_members cm ON u.id = cm.user_id
+    WHERE cm.chat_id = %s AND u.id != %s
+    LIMIT 1
+"""
+
+class Client:
+    '''
+    One simulated user (or browser tab) with its own keep-alive connection.
+    '''
+    def __init__(self, base_url: str, user_id: int, chat_ids: List[int], peers: List[int], rng: random.Random,
+                 token: Optional[str] = None) -> None:
+        self.base = urlsplit(base_url)
+        self.user_id = user_id
+        self.token = token
+        self.chat_ids = chat_ids
+        self.peers = peers
+        self.rng = rng
+        self.connection: Optional[http.client.HTTPConnection] = None
+        self.chats_etag: Optional[str] = None
+        self.last_seen: Dict[int, int] = {}
+        self.cursor: Optional[int] = None
+        self.lsn: Optional[str] = None
+
+    def request(self, method: str, function: str, params: Optional[Dict[str, Any]] = None,
+                body: Any = None, headers: Optional[Dict[str, str]] = None) -> Tuple[int, Dict[str, str], Any]:
+        path = '/' + function + ('?' + urlencode(params) if params else '')
+        data = json.dumps(body) if body is not None else None
+        headers = dict({'Content-Type': 'application/json'}, **(headers or {}))
+        if self.token:
+            headers['Authorization'] = 'Bearer ' + self.token
+        if method == 'GET' and self.lsn:
+            headers['X-Min-Lsn'] = self.lsn
+        for attempt in range(2):
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection(self.base.hostname, self.base.port, timeout=30)
+            try:
+                self.connection.request(method, path, body=data, headers=headers)
+                response = self.connection.getresponse()
+                raw = response.read()
+                break
+            except (http.client.HTTPException, ConnectionError):
+                self.connection.close()
+                self.connection = None
+                if attempt:
+                    raise
+        payload = json.loads(raw) if raw and response.getheader('Content-Type', '').startswith('application/json') else None
+        response_headers = {k.lower(): v for k, v in response.getheaders()}
+        # Read your own writes when the server routes reads to replicas
+        if 'x-lsn' in response_headers:
+            self.lsn = response_headers['x-lsn']
+        return response.status, response_headers, payload
+
+    def close(self) -> None:
+        if self.connection is not None:
+            self.connection.close()
+
+    def run(self, action: str) -> int:
+        return getattr(self, 'do_' + action.replace('.', '_'))()
+
+    def do_chats_list(self) -> int:
+        headers = {'If-None-Match': self.chats_etag} if self.chats_etag else None
+        status, response_headers, _ = self.request('GET', 'chats', {'user_id': self.user_id}, headers=headers)
+        if status == 200:
+            self.chats_etag = response_headers.get('etag')
+        return status
+
+    def do_messages_poll(self) -> int:
+        chat_id = self.rng.choice(self.chat_ids)
+        params = {'chat_id': chat_id, 'user_id': self.user_id, 'limit': 50}
+        if chat_id in self.last_seen:
+            params['since_id'] = self.last_seen[chat_id]
+        status, _, payload = self.request('GET', 'messages', params)
+        if status == 200 and payload and payload['messages']:
+            self.last_seen[chat_id] = max(message['id'] for message in payload['messages'])
+        return status
+
+    def do_messages_wait(self) -> int:
+        params = {'user_id': self.user_id, 'wait': 1, 'timeout': WAIT_TIMEOUT}
+        if self.cursor is not None:
+            params['cursor'] = self.cursor
+        status, _, payload = self.request('GET', 'messages', params)
+        if status == 200 and payload:
+            self.cursor = payload['cursor']
+        return status
+
+    def _message(self, chat_id: int) -> Dict[str, Any]:
+        return {
+            'chat_id': chat_id,
+            'sender_id': self.user_id,
+            'content': 'load %s' % uuid.uuid4().hex[:12],
+            'client_message_id': uuid.uuid4().hex
+        }
+
+    def do_messages_send(self) -> int:
+        status, _, _ = self.request('POST', 'messages', body=self._message(self.rng.choice(self.chat_ids)))
+        return status
+
+    def do_messages_batch(self) -> int:
+        messages = [self._message(self.rng.choice(self.chat_ids)) for _ in range(BATCH_SIZE)]
+        status, _, _ = self.request('POST', 'messages', body={'messages': messages})
+        return status
+
+    def do_messages_read(self) -> int:
+        chat_id = self.rng.choice(self.chat_ids)
+        if chat_id not in self.last_seen:
+            return self.do_messages_poll()
+        body = {'chat_id': chat_id, 'user_id': self.user_id, 'up_to_id': self.last_seen[chat_id]}
+        status, _, _ = self.request('PUT', 'messages', body=body)
+        return status
+
+    def do_users_heartbeat(self) -> int:
+        status, _, _ = self.request('POST', 'users', body={'action': 'heartbeat', 'user_id': self.user_id})
+        return status
+
+    def do_chats_create_group(self) -> int:
+        members = self.rng.sample(self.peers, min(GROUP_SIZE - 1, len(self.peers)))
+        body = {'type': 'group', 'creator_id': self.user_id, 'name': 'load %s' % uuid.uuid4().hex[:6], 'member_ids': members}
+        status, _, payload = self.request('POST', 'chats', body=body)
+        if status == 200 and payload:
+            self.chat_ids.append(payload['chat_id'])
+        return status
+
+def register(admin: Client, username: str) -> Tuple[int, str]:
+    '''
+    A new account's id and session token.
+    '''
+    status, _, payload = admin.request('POST', 'auth', body={
+        'action': 'register',
+        'username': username,
+        'password': 'loadtest1'
+    })
+    if status != 200:
+        raise RuntimeError('register failed: %d %r' % (status, payload))
+    return payload['user']['id'], payload['token']
+
+def seed(base_url: str, users: int, groups: int, rng: random.Random,
+         shared_chat: bool = False) -> Tuple[Dict[int, List[int]], Dict[int, str]]:
+    '''
+    Register users and their chats; returns the chat ids and the session
+    token of every user. With shared_chat, everyone is only in one group
+    with all the users.
+    '''
+    run = uuid.uuid4().hex[:6]
+    admin = Client(base_url, 0, [], [], rng)
+    user_ids = []
+    tokens: Dict[int, str] = {}
+    for index in range(users):
+        user_id, token = register(admin, 'load_%s_%d' % (run, index))
+        user_ids.append(user_id)
+        tokens[user_id] = token
+
+    chats: Dict[int, List[int]] = {user_id: [] for user_id in user_ids}
+    def create(creator: int, members: List[int], chat_type: str) -> None:
+        body = {'type': chat_type, 'creator_id': creator, 'member_ids': members}
+        if chat_type == 'group':
+            body['name'] = 'seed group'
+        admin.token = tokens[creator]
+        status, _, payload = admin.request('POST', 'chats', body=body)
+        if status != 200:
+            raise RuntimeError('chat creation failed: %d %r' % (status, payload))
+        for user_id in [creator] + members:
+            chats[user_id].append(payload['chat_id'])
+
+    if shared_chat:
+        create(user_ids[0], user_ids[1:], 'group')
+        admin.close()
+        return chats, tokens
+
+    for index, user_id in enumerate(user_ids):
+        create(user_id, [user_ids[(index + 1) % len(user_ids)]], 'private')
+    for _ in range(groups):
+        members = rng.sample(user_ids, min(GROUP_SIZE, len(user_ids)))
+        create(members[0], members[1:], 'group')
+    admin.close()
+    return chats, tokens
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(q * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+def summarize(samples: Dict[str, List[float]], errors: Dict[str, int], limited: Dict[str, int],
+              elapsed: float) -> Dict[str, Dict[str, Any]]:
+    report = {}
+    for endpoint in sorted(set(samples) | set(errors) | set(limited)):
+        values = sorted(samples.get(endpoint, []))
+        report[endpoint] = {
+            'count': len(values),
+            'errors': errors.get(endpoint, 0),
+            'limited': limited.get(endpoint, 0),
+            'rps': round(len(values) / elapsed, 1),
+            'p50_ms': round(percentile(values, 0.5), 2),
+            'p95_ms': round(percentile(values, 0.95), 2),
+            'p99_ms': round(percentile(values, 0.99), 2),
+            'max_ms': round(values[-1], 2) if values else 0.0
+        }
+    return report
+
+def run_load(base_url: str, chats: Dict[int, List[int]], tokens: Dict[int, str], clients: int, duration: float,
+             weights: Dict[str, int], rng_seed: int) -> Dict[str, Any]:
+    actions, action_weights = zip(*weights.items())
+    user_ids = sorted(chats)
+    samples: Dict[str, List[float]] = {action: [] for action in actions}
+    errors: Dict[str, int] = {}
+    limited: Dict[str, int] = {}
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def worker(index: int) -> None:
+        rng = random.Random(rng_seed + index)
+        user_id = user_ids[index % len(user_ids)]
+        peers = [peer for peer in user_ids if peer != user_id]
+        client = Client(base_url, user_id, list(chats[user_id]), peers, rng, tokens[user_id])
+        local_samples: Dict[str, List[float]] = {action: [] for action in actions}
+        local_errors: Dict[str, int] = {}
+        local_limited: Dict[str, int] = {}
+        try:
+            while time.monotonic() < deadline:
+                action = rng.choices(actions, action_weights)[0]
+                start = time.perf_counter()
+                try:
+                    status = client.run(action)
+                except Exception:
+                    status = 0
+                ms = (time.perf_counter() - start) * 1000
+                if status in LIMITED_STATUSES:
+                    local_limited[action] = local_limited.get(action, 0) + 1
+                elif status == 0 or status >= 400:
+                    local_errors[action] = local_errors.get(action, 0) + 1
+                else:
+                    local_samples[action].append(ms)
+        finally:
+            client.close()
+            with lock:
+                for action, values in local_samples.items():
+                    samples[action].extend(values)
+                for action, count in local_errors.items():
+                    errors[action] = errors.get(action, 0) + count
+                for action, count in local_limited.items():
+                    limited[action] = limited.get(action, 0) + count
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=worker, args=(index,)) for index in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    report = summarize(samples, errors, limited, elapsed)
+    total = sum(len(values) for values in samples.values())
+    return {'elapsed_s': round(elapsed, 2), 'clients': clients, 'total_rps': round(total / elapsed, 1), 'endpoints': report}
+
+def print_report(result: Dict[str, Any]) -> None:
+    print('%-20s %8s %7s %8s %8s %9s %9s %9s %9s' % (
+        'endpoint', 'count', 'errors', 'limited', 'rps', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+    for endpoint, row in result['endpoints'].items():
+        print('%-20s %8d %7d %8d %8.1f %9.2f %9.2f %9.2f %9.2f' % (
+            endpoint, row['count'], row['errors'], row.get('limited', 0), row['rps'],
+            row['p50_ms'], row['p95_ms'], row['p99_ms'], row['max_ms']))
+    print('\n%d clients, %.1fs, %.1f req/s' % (result['clients'], result['elapsed_s'], result['total_rps']))
+
+def compare(result: Dict[str, Any], baseline: Dict[str, Any], max_regression: float, min_delta_ms: float) -> List[str]:
+    '''
+    Endpoints whose p95 regressed beyond both the relative and absolute slack,
+    or that started failing.
+    '''
+    problems = []
+    for endpoint, row in result['endpoints'].items():
+        before = baseline['endpoints'].get(endpoint)
+        if before is None:
+            continue
+        limit = max(before['p95_ms'] * (1 + max_regression), before['p95_ms'] + min_delta_ms)
+        if row['p95_ms'] > limit:
+            problems.append('%s p95 %.2f ms > %.2f ms (baseline %.2f ms)' % (endpoint, row['p95_ms'], limit, before['p95_ms']))
+        if row['errors'] and not before['errors']:
+            problems.append('%s: %d errors (baseline none)' % (endpoint, row['errors']))
+    return problems
+
+class Bench:
+    '''
+    State shared by the steps of one scale benchmark: the server, a direct
+    database connection for bulk loading and a prefix for what it creates.
+    '''
+    def __init__(self, base_url: str, database_url: str, requests: int, rng: random.Random) -> None:
+        import psycopg2
+        self.base_url = base_url
+        self.requests = requests
+        self.rng = rng
+        self.run = uuid.uuid4().hex[:6]
+        self.conn = psycopg2.connect(database_url)
+        self.conn.autocommit = True
+        self.admin = Client(base_url, 0, [], [], rng)
+        self.registered = 0
+        self.handlers: Dict[Tuple[str, ...], Any] = {}
+
+    def client(self) -> Client:
+        '''
+        A freshly registered user, signed in.
+        '''
+        self.registered += 1
+        user_id, token = register(self.admin, 'bench_%s_%d' % (self.run, self.registered))
+        return Client(self.base_url, user_id, [], [], self.rng, token)
+
+    def create_chat(self, creator: Client, member_ids: List[int], chat_type: str = 'private') -> int:
+        body = {'type': chat_type, 'creator_id': creator.user_id, 'member_ids': member_ids}
+        if chat_type == 'group':
+            body['name'] = 'bench %s' % self.run
+        status, _, payload = creator.request('POST', 'chats', body=body)
+        if status != 200:
+            raise RuntimeError('chat creation failed: %d %r' % (status, payload))
+        creator.chat_ids.append(payload['chat_id'])
+        return payload['chat_id']
+
+    def execute(self, sql: str, args: Any = None) -> List[Tuple[Any, ...]]:
+        with self.conn.cursor() as cur:
+            cur.execute(sql, args)
+            return cur.fetchall() if cur.description else []
+
+    def add_messages(self, chat_id: int, sender_ids: List[int], count: int, start: Any, step_ms: int) -> int:
+        '''
+        Insert count messages into chat_id, one every step_ms from start
+        on, and bump the chat like a send would. Returns the newest id.
+        '''
+        if count > 0:
+            self.execute("""
+                INSERT INTO messages (chat_id, sender_id, content, created_at)
+                SELECT %s, (%s::int[])[1 + i %% %s], 'bench message ' || i,
+                       %s + (i * %s) * INTERVAL '1 millisecond'
+                FROM generate_series(0, %s - 1) AS i
+            """, (chat_id, sender_ids, len(sender_ids), start, step_ms, count))
+        newest = self.execute("""
+            UPDATE chats c
+            SET last_message_id = m.id, last_message_at = m.created_at, last_message_preview = m.content
+            FROM (SELECT id, created_at, content FROM messages WHERE chat_id = %s ORDER BY id DESC LIMIT 1) m
+            WHERE c.id = %s
+            RETURNING m.id
+        """, (chat_id, chat_id))
+        self.execute("ANALYZE messages")
+        return newest[0][0]
+
+    def group_chat(self, member_ids: List[int]) -> int:
+        '''
+        A group chat created straight in the database, for setups too big
+        to go through the chats function.
+        '''
+        chat_id = self.execute(
+            "INSERT INTO chats (type, name, owner_id) VALUES ('group', %s, %s) RETURNING id",
+            ('bench %s' % self.run, member_ids[0])
+        )[0][0]
+        self.execute(
+            "INSERT INTO chat_members (chat_id, user_id) SELECT %s, unnest(%s::int[])",
+            (chat_id, member_ids)
+        )
+        return chat_id
+
+    def users(self, count: int) -> List[int]:
+        '''
+        count accounts created straight in the database; they cannot log in.
+        '''
+        self.registered += count
+        return [row[0] for row in self.execute("""
+            INSERT INTO users (username, password_hash, nickname)
+            SELECT 'bench_' || %s || '_u' || i, '!', 'Bench ' || i
+            FROM generate_series(%s, %s) AS i
+            RETURNING id
+        """, (self.run, self.registered - count, self.registered - 1))]
+
+    def function(self, name: str, **env: str) -> Any:
+        '''
+        A copy of a function's handler loaded into this process, with env
+        applied while it is imported (that is when its modules read their
+        settings). It is called directly, so the tokens it is given must
+        come from an in-process server (--start-server).
+        '''
+        import local_server
+        key = (name,) + tuple(sorted(env.items()))
+        if key not in self.handlers:
+            previous = {variable: os.environ.get(variable) for variable in env}
+            os.environ.update(env)
+            try:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    self.handlers[key] = local_server.load_function(name)
+            finally:
+                for variable, value in previous.items():
+                    if value is None:
+                        del os.environ[variable]
+                    else:
+                        os.environ[variable] = value
+        return self.handlers[key]
+
+    def invoke(self, handler: Any, name: str, client: Client, params: Dict[str, Any],
+               headers: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+        '''
+        The response of handler to a GET from client.
+        '''
+        import local_server
+        event = {
+            'httpMethod': 'GET',
+            'headers': dict(headers or {}, Authorization='Bearer %s' % client.token),
+            'queryStringParameters': {key: str(value) for key, value in params.items()},
+            'body': ''
+        }
+        return handler(event, local_server.Context(name))
+
+    def tokens(self, user_ids: List[int]) -> Dict[int, str]:
+        '''
+        Session tokens for accounts made with users(), issued by the session
+        module of a copy of the users function.
+        '''
+        handler = self.function('users')
+        issue = getattr(handler, '__wrapped__', handler).__globals__['session'].issue
+        return {user_id: issue(user_id)[0] for user_id in user_ids}
+
+    def request_log(self, name: str, client: Client, params: Dict[str, Any],
+                    headers: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+        '''
+        The log line the function's metrics write for one GET: status,
+        round trips (queries), database time and body size.
+        '''
+        handler = self.function(name, METRICS_LOG_REQUESTS='1')
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            self.invoke(handler, name, client, params, headers)
+        for line in reversed(out.getvalue().splitlines()):
+            record = json.loads(line) if line.startswith('{') else {}
+            if record.get('metric') == 'request':
+                return record
+        raise RuntimeError('%s logged no request line' % name)
+
+    def round_trips(self, name: str, client: Client, params: Dict[str, Any]) -> Optional[int]:
+        '''
+        Statements one GET runs, or None if the call does not succeed.
+        '''
+        record = self.request_log(name, client, params)
+        return record['queries'] if record['status'] == 200 else None
+
+    def private_chats(self, client: Client, count: int) -> List[int]:
+        '''
+        count private chats of client with new accounts, created straight in
+        the database, each with one message from the other member.
+        '''
+        peers = self.users(count)
+        chat_ids = [row[0] for row in self.execute("""
+            INSERT INTO chats (type, owner_id, private_key)
+            SELECT 'private', %s, LEAST(%s, peer) || ':' || GREATEST(%s, peer)
+            FROM unnest(%s::int[]) AS peer
+            RETURNING id
+        """, (client.user_id, client.user_id, client.user_id, peers))]
+        self.execute("""
+            INSERT INTO chat_members (chat_id, user_id)
+            SELECT chat_id, unnest(ARRAY[%s, peer])
+            FROM unnest(%s::int[], %s::int[]) AS p(chat_id, peer)
+        """, (client.user_id, chat_ids, peers))
+        self.execute("""
+            INSERT INTO messages (chat_id, sender_id, content)
+            SELECT chat_id, peer, 'hello from ' || peer
+            FROM unnest(%s::int[], %s::int[]) AS p(chat_id, peer)
+        """, (chat_ids, peers))
+        self.execute("""
+            UPDATE chats c
+            SET last_message_id = m.id, last_message_at = m.created_at, last_message_preview = m.content
+            FROM messages m
+            WHERE m.chat_id = c.id AND c.id = ANY(%s)
+        """, (chat_ids,))
+        self.execute("ANALYZE chats")
+        self.execute("ANALYZE chat_members")
+        return chat_ids
+
+    def connections(self) -> int:
+        '''
+        Database connections open right now, not counting this one.
+        '''
+        return self.execute(
+            "SELECT COUNT(*) - 1 FROM pg_stat_activity WHERE datname = current_database()"
+        )[0][0]
+
+    def row(self, size: int, label: str, latencies: List[float], errors: int, **notes: Any) -> Dict[str, Any]:
+        latencies = sorted(latencies)
+        return dict({
+            'size': size,
+            'label': label,
+            'count': len(latencies),
+            'errors': errors,
+            'p50_ms': round(percentile(latencies, 0.5), 2),
+            'p99_ms': round(percentile(latencies, 0.99), 2)
+        }, **notes)
+
+    def measure(self, size: int, label: str, call: Any, count: Optional[int] = None) -> Dict[str, Any]:
+        '''
+        Time count calls of call(), which returns an HTTP status.
+        '''
+        latencies: List[float] = []
+        errors = 0
+        for _ in range(count or self.requests):
+            started = time.perf_counter()
+            status = call()
+            if status == 0 or status >= 400:
+                errors += 1
+            else:
+                latencies.append((time.perf_counter() - started) * 1000)
+        return self.row(size, label, latencies, errors)
+
+    def close(self) -> None:
+        self.admin.close()
+        self.conn.close()
+
+def bench_history(bench: Bench, sizes: List[int]) -> List[Dict[str, Any]]:
+    '''
+    One chat whose history grows to each size. Polls should not get slower
+    as it grows: they are keyset reads on (chat_id, id).
+    '''
+    reader, sender = bench.client(), bench.client()
+    chat_id = bench.create_chat(reader, [sender.user_id])
+    step_ms = 100
+    start = bench.execute("SELECT LOCALTIMESTAMP - %s * INTERVAL '1 millisecond'", (max(sizes) * step_ms,))[0][0]
+    rows: List[Dict[str, Any]] = []
+    loaded = 0
+    for size in sorted(sizes):
+        newest = bench.add_messages(chat_id, [reader.user_id, sender.user_id], size - loaded,
+                                    start + timedelta(milliseconds=loaded * step_ms), step_ms)
+        loaded = size
+        overlap = bench.execute(
+            "SELECT MAX(id) FROM messages WHERE chat_id = %s AND created_at <= %s",
+            (chat_id, start + timedelta(milliseconds=(size - 1) * step_ms - OVERLAP_MS))
+        )[0][0] or 0
+
+        def poll(since_id: Optional[int]) -> Any:
+            params = {'chat_id': chat_id, 'limit': 50}
+            if since_id is not None:
+                params['since_id'] = since_id
+            return lambda: reader.request('GET', 'messages', params)[0]
+
+        rows.append(bench.measure(size, 'poll empty', poll(newest)))
+        rows.append(bench.measure(size, 'poll 50 new', poll(newest - 50)))
+        rows.append(bench.measure(size, 'poll overlap window', poll(overlap)))
+        rows.append(bench.measure(size, 'first page', poll(None)))
+    reader.close()
+    sender.close()
+    return rows
+
+def bench_waiters(bench: Bench, sizes: List[int]) -> List[Dict[str, Any]]:
+    '''
+    Idle clients each hold a long-poll open and re-poll when it returns;
+    WAITER_SENDERS active clients send --requests messages, each into the
+    chat of a random waiter. The waiters share one listener connection, so
+    the database connections in use should not grow with their number.
+    '''
+    # Two threads per waiter (client and server side) in this process
+    threading.stack_size(256 * 1024)
+    senders = [bench.client() for _ in range(WAITER_SENDERS)]
+    waiters: List[Client] = []
+    rows: List[Dict[str, Any]] = []
+    for size in sorted(sizes):
+        while len(waiters) < size:
+            waiter = bench.client()
+            waiter.chat_ids.append(bench.group_chat([senders[len(waiters) % WAITER_SENDERS].user_id, waiter.user_id]))
+            waiters.append(waiter)
+
+        stop = threading.Event()
+        lock = threading.Lock()
+        parked = [0]
+        woken: Dict[int, float] = {}
+        wait_errors = [0]
+
+        def wait_loop(client: Client) -> None:
+            client.cursor = None
+            counted = False
+            while not stop.is_set():
+                params = {'wait': 1, 'timeout': WAITER_TIMEOUT}
+                if client.cursor is not None:
+                    params['cursor'] = client.cursor
+                    if not counted:
+                        counted = True
+                        with lock:
+                            parked[0] += 1
+                try:
+                    status, _, payload = client.request('GET', 'messages', params)
+                except (OSError, http.client.HTTPException, ValueError):
+                    if not stop.is_set():
+                        with lock:
+                            wait_errors[0] += 1
+                    continue
+                now = time.perf_counter()
+                if status != 200:
+                    with lock:
+                        wait_errors[0] += 1
+                    time.sleep(1)
+                    continue
+                with lock:
+                    for update in payload['updates']:
+                        woken.setdefault(update['message_id'], now)
+                client.cursor = payload['cursor']
+
+        threads = [threading.Thread(target=wait_loop, args=(waiter,), daemon=True) for waiter in waiters[:size]]
+        for thread in threads:
+            thread.start()
+        deadline = time.monotonic() + 60
+        while parked[0] < size and time.monotonic() < deadline:
+            time.sleep(0.2)
+        time.sleep(1)
+        connections_parked = bench.connections()
+
+        sent: Dict[int, float] = {}
+        send_latencies: List[float] = []
+        send_errors = [0]
+
+        def send_loop(sender: Client, count: int, rng: random.Random) -> None:
+            mine = [waiter for index, waiter in enumerate(waiters[:size]) if index % WAITER_SENDERS == senders.index(sender)]
+            for _ in range(count):
+                target = rng.choice(mine)
+                body = {'chat_id': target.chat_ids[0], 'sender_id': sender.user_id, 'content': 'wake up'}
+                started = time.perf_counter()
+                status, _, payload = sender.request('POST', 'messages', body=body)
+                with lock:
+                    if status == 200:
+                        sent[payload['message']['id']] = started
+                        send_latencies.append((time.perf_counter() - started) * 1000)
+                    else:
+                        send_errors[0] += 1
+                time.sleep(0.02)
+
+        per_sender = max(1, bench.requests // WAITER_SENDERS)
+        send_threads = [
+            threading.Thread(target=send_loop, args=(sender, per_sender, random.Random(index)))
+            for index, sender in enumerate(senders) if any(index == i % WAITER_SENDERS for i in range(size))
+        ]
+        for thread in send_threads:
+            thread.start()
+        connections_active = bench.connections()
+        for thread in send_threads:
+            thread.join()
+        time.sleep(1)
+
+        stop.set()
+        for waiter in waiters[:size]:
+            if waiter.connection is not None and waiter.connection.sock is not None:
+                waiter.connection.sock.shutdown(socket.SHUT_RDWR)
+        for thread in threads:
+            thread.join(5)
+        for waiter in waiters[:size]:
+            waiter.close()
+            waiter.connection = None
+
+        with lock:
+            delivery = [(woken[message_id] - started) * 1000 for message_id, started in sent.items() if message_id in woken]
+            missed = len(sent) - len(delivery)
+        rows.append(bench.row(size, 'send', send_latencies, send_errors[0]))
+        rows.append(bench.row(size, 'delivery', delivery, wait_errors[0], missed=missed,
+                              db_connections_idle=connections_parked, db_connections_active=connections_active))
+    for sender in senders:
+        sender.close()
+    return rows
+
+def bench_partitions(bench: Bench, sizes: List[int]) -> List[Dict[str, Any]]:
+    '''
+    messages grows to each size, spread over PARTITION_CHATS chats and the
+    last PARTITION_SPAN_DAYS days, while one chat keeps getting new messages.
+    Sends only touch the current month's partition and the recent page is
+    read with a created_at bound that prunes older months; the same page
+    read without the bound shows what it costs to look in every partition.
+    '''
+    reader, sender = bench.client(), bench.client()
+    chat_id = bench.create_chat(reader, [sender.user_id])
+    others = [bench.group_chat([sender.user_id]) for _ in range(PARTITION_CHATS)]
+    bench.add_messages(chat_id, [reader.user_id, sender.user_id], 1000,
+                       bench.execute("SELECT LOCALTIMESTAMP - INTERVAL '1 hour'")[0][0], 1000)
+    page_sql = """
+        SELECT m.id, m.chat_id, m.sender_id, m.content, m.created_at
+        FROM messages m
+        WHERE m.chat_id = %s{bound}
+        ORDER BY m.id DESC
+        LIMIT 50
+    """
+    pruned = page_sql.format(bound=" AND m.created_at >= LOCALTIMESTAMP - INTERVAL '31 days'")
+    unbounded = page_sql.format(bound='')
+
+    def read(sql: str) -> Any:
+        return lambda: 200 if bench.execute(sql, (chat_id,)) else 0
+
+    def send() -> int:
+        body = {'chat_id': chat_id, 'sender_id': sender.user_id, 'content': 'bench %s' % uuid.uuid4().hex[:8]}
+        return sender.request('POST', 'messages', body=body)[0]
+
+    rows: List[Dict[str, Any]] = []
+    loaded = bench.execute("SELECT COUNT(*) FROM messages")[0][0]
+    for size in sorted(sizes):
+        while loaded < size:
+            count = min(PARTITION_LOAD_CHUNK, size - loaded)
+            bench.execute("""
+                INSERT INTO messages (chat_id, sender_id, content, created_at)
+                SELECT (%s::int[])[1 + i %% %s], %s, 'bench message ' || i,
+                       LOCALTIMESTAMP - random() * %s * INTERVAL '1 day'
+                FROM generate_series(0, %s - 1) AS i
+            """, (others, len(others), sender.user_id, PARTITION_SPAN_DAYS, count))
+            loaded += count
+        bench.execute("ANALYZE messages")
+        partitions = bench.execute("""
+            SELECT COUNT(*) FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'messages'::regclass AND c.reltuples > 0
+        """)[0][0]
+
+        started = time.perf_counter()
+        sends = bench.measure(size, 'send', send)
+        sends['per_second'] = round(sends['count'] / (time.perf_counter() - started), 1)
+        sends['partitions_with_rows'] = partitions
+        rows.append(sends)
+        rows.append(bench.measure(size, 'recent page', lambda: reader.request('GET', 'messages', {'chat_id': chat_id, 'limit': 50})[0]))
+        rows.append(bench.measure(size, 'page sql, recent months', read(pruned)))
+        rows.append(bench.measure(size, 'page sql, every partition', read(unbounded)))
+    reader.close()
+    sender.close()
+    return rows
+
+def bench_chat_list(bench: Bench, sizes: List[int]) -> List[Dict[str, Any]]:
+    '''
+    A user with size private chats, each with a message, polls the chat
+    list without an ETag. The list is one query however many chats there
+    are; the old list made one more lookup per private chat, and is timed
+    straight against the database next to it.
+    '''
+    rows: List[Dict[str, Any]] = []
+    for size in sorted(sizes):
+        reader = bench.client()
+        bench.private_chats(reader, size)
+
+        def old_list() -> int:
+            chats = bench.execute(OLD_CHATS_LIST, (reader.user_id,))
+            for chat in chats:
+                if chat[1] == 'private':
+                    bench.execute(OLD_CHATS_OTHER_USER, (chat[0], reader.user_id))
+            return 200 if len(chats) == size else 0
+
+        params = {'user_id': reader.user_id}
+        bench.round_trips('chats', reader, params)
+        row = bench.measure(size, 'list', lambda: reader.request('GET', 'chats', params)[0])
+        row['round_trips'] = bench.round_trips('chats', reader, params)
+        rows.append(row)
+        row = bench.measure(size, 'list, render=db', lambda: reader.request('GET', 'chats', dict(params, render='db'))[0])
+        row['round_trips'] = bench.round_trips('chats', reader, dict(params, render='db'))
+        rows.append(row)
+        row = bench.measure(size, 'old list (sql)', old_list)
+        row['round_trips'] = 1 + size
+        rows.append(row)
+        reader.close()
+    return rows
+
+def bench_pool(bench: Bench, sizes: List[int]) -> List[Dict[str, Any]]:
+    '''
+    size clients make the same requests through two copies of the chats and
+    messages functions: one as deployed and one with DB_POOL_MAX_IDLE=0,
+    which closes every connection on release, so each request connects and
+    prepares its statements again. The copies are called in-process, without
+    HTTP; connects is how many sessions Postgres started meanwhile.
+    '''
+    reader, sender = bench.client(), bench.client()
+    chat_id = bench.create_chat(reader, [sender.user_id])
+    bench.add_messages(chat_id, [reader.user_id, sender.user_id], 100,
+                       bench.execute("SELECT LOCALTIMESTAMP - INTERVAL '1 hour'")[0][0], 1000)
+    requests = [('chats', {'user_id': reader.user_id}), ('messages', {'chat_id': chat_id, 'limit': 50})]
+
+    def sessions() -> int:
+        # Backends report their connect a moment later; let the stats settle
+        time.sleep(1)
+        bench.execute("SELECT pg_stat_clear_snapshot()")
+        return bench.execute("SELECT sessions FROM pg_stat_database WHERE datname = current_database()")[0][0]
+
+    rows: List[Dict[str, Any]] = []
+    for size in sorted(sizes):
+        for mode, env in (('pool', {}), ('no pool', {'DB_POOL_MAX_IDLE': '0'})):
+            for name, params in requests:
+                handler = bench.function(name, METRICS_LOG_REQUESTS='0', **env)
+                bench.invoke(handler, name, reader, params)
+                lock = threading.Lock()
+                latencies: List[float] = []
+                errors = [0]
+
+                def worker(count: int) -> None:
+                    for _ in range(count):
+                        started = time.perf_counter()
+                        status = bench.invoke(handler, name, reader, params)['statusCode']
+                        with lock:
+                            if status == 200:
+                                latencies.append((time.perf_counter() - started) * 1000)
+                            else:
+                                errors[0] += 1
+
+                before = sessions()
+                threads = [threading.Thread(target=worker, args=(max(1, bench.requests // size),)) for _ in range(size)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                rows.append(bench.row(size, '%s %s' % (name, mode), latencies, errors[0], connects=sessions() - before))
+    reader.close()
+    sender.close()
+    return rows
+
+def bench_groups(bench: Bench, sizes: List[int]) -> List[Dict[str, Any]]:
+    '''
+    Groups of size members created through the chats function, which adds
+    every member with one statement; the old one INSERT per member is timed
+    against the database next to it, in one transaction as the function ran
+    it. Fewer than --requests groups are created of the larger sizes, at
+    most GROUP_MEMBER_ROWS members in all.
+    '''
+    creator, peer = bench.client(), bench.client()
+    bench.create_chat(creator, [peer.user_id])
+    rows: List[Dict[str, Any]] = []
+    for size in sorted(sizes):
+        members = bench.users(size - 1)
+        count = max(5, min(bench.requests, GROUP_MEMBER_ROWS // size))
+
+        def create() -> int:
+            body = {'type': 'group', 'creator_id': creator.user_id, 'name': 'bench %s' % bench.run, 'member_ids': members}
+            return creator.request('POST', 'chats', body=body)[0]
+
+        def old_create() -> int:
+            with bench.conn.cursor() as cur:
+                cur.execute("BEGIN")
+                cur.execute(
+                    "INSERT INTO chats (type, name, owner_id) VALUES ('group', %s, %s) RETURNING id",
+                    ('bench %s' % bench.run, creator.user_id)
+                )
+                chat_id = cur.fetchone()[0]
+                for member_id in [creator.user_id] + members:
+                    cur.execute("INSERT INTO chat_members (chat_id, user_id) VALUES (%s, %s)", (chat_id, member_id))
+                cur.execute("COMMIT")
+            return 200
+
+        rows.append(bench.measure(size, 'create group', create, count))
+        rows.append(bench.measure(size, 'old per-member inserts (sql)', old_create, count))
+    private = {'type': 'private', 'creator_id': creator.user_id, 'member_ids': [peer.user_id]}
+    rows.append(bench.measure(2, 'open existing private', lambda: creator.request('POST', 'chats', body=private)[0]))
+    creator.close()
+    peer.close()
+    return rows
+
+def bench_user_search(bench: Bench, sizes: List[int]) -> List[Dict[str, Any]]:
+    '''
+    The users table grows to each size with accounts named after
+    SEARCH_FIRST_NAMES and SEARCH_LAST_NAMES, and --requests searches are
+    made of each kind: a name prefix, a full name with two letters swapped
+    (only the trigram similarity finds those) and one query repeated, which
+    the function answers from its short-lived result cache. Prefix and typo
+    queries differ from call to call so that the cache does not serve them.
+    '''
+    searcher = bench.client()
+    pairs = [(first, last) for first in SEARCH_FIRST_NAMES for last in SEARCH_LAST_NAMES]
+    rows: List[Dict[str, Any]] = []
+    loaded = bench.execute("SELECT COUNT(*) FROM users")[0][0]
+    for size in sorted(sizes):
+        if loaded < size:
+            bench.execute("""
+                INSERT INTO users (username, password_hash, nickname)
+                SELECT first || '_' || last || i, '!', initcap(first) || ' ' || initcap(last)
+                FROM generate_series(%s, %s - 1) AS i,
+                     LATERAL (SELECT (%s::text[])[1 + i %% %s] AS first,
+                                     (%s::text[])[1 + (i / %s) %% %s] AS last) AS n
+            """, (loaded, size, SEARCH_FIRST_NAMES, len(SEARCH_FIRST_NAMES),
+                  SEARCH_LAST_NAMES, len(SEARCH_FIRST_NAMES), len(SEARCH_LAST_NAMES)))
+            loaded = size
+            bench.execute("ANALYZE users")
+
+        bench.rng.shuffle(pairs)
+        prefixes = iter(['%s_%s' % (first, last[:2]) for first, last in pairs] * (bench.requests // len(pairs) + 1))
+        typos = iter(['%s_%s%s%s' % (first, last[:2], last[3], last[2] + last[4:]) for first, last in pairs]
+                     * (bench.requests // len(pairs) + 1))
+
+        def search(queries: Any) -> Any:
+            return lambda: searcher.request('GET', 'users', {'q': next(queries), 'limit': 10})[0]
+
+        rows.append(bench.measure(size, 'prefix', search(prefixes)))
+        rows.append(bench.measure(size, 'typo', search(typos)))
+        rows.append(bench.measure(size, 'repeated (cached)', search(iter(lambda: 'maria_po', None))))
+    searcher.close()
+    return rows
+
+# Messages of the search benchmark are SEARCH_WORDS_PER_MESSAGE words from
+# SEARCH_WORDS; one in SEARCH_RARE_EVERY also has SEARCH_RARE_WORD
+SEARCH_WORDS = ['привет', 'завтра', 'встреча', 'работа', 'проект', 'отчёт', 'звонок', 'вечером', 'утром', 'срочно',
+                'документы', 'договор', 'клиент', 'письмо', 'задача', 'сроки', 'обед', 'кофе', 'погода', 'дорога',
+                'машина', 'поезд', 'билеты', 'отпуск', 'море', 'фотографии', 'день', 'рождения', 'подарок', 'торт',
+                'фильм', 'книга', 'музыка', 'концерт', 'футбол', 'матч', 'команда', 'тренировка', 'врач', 'аптека']
+SEARCH_WORDS_PER_MESSAGE = 6
+SEARCH_RARE_WORD = 'комета'
+SEARCH_RARE_EVERY = 10000
+SEARCH_CHATS = 100
+
+def bench_search(bench: Bench, sizes: List[int]) -> List[Dict[str, Any]]:
+    '''
+    messages grows to each size, spread over SEARCH_CHATS chats of which
+    the searcher is in half, so the membership filter matters as much as
+    the text. Every word of SEARCH_WORDS is in about one message in seven;
+    SEARCH_RARE_WORD is in one in SEARCH_RARE_EVERY.
+    '''
+    searcher, sender = bench.client(), bench.client()
+    chat_ids = [bench.group_chat([sender.user_id] + ([searcher.user_id] if index % 2 == 0 else []))
+                for index in range(SEARCH_CHATS)]
+    rows: List[Dict[str, Any]] = []
+    loaded = 0
+    for size in sorted(sizes):
+        while loaded < size:
+            count = min(PARTITION_LOAD_CHUNK, size - loaded)
+            # w > i - i ties the word subquery to the row, so that it is not
+            # run once and its words shared by every message
+            bench.execute("""
+                INSERT INTO messages (chat_id, sender_id, content, created_at)
+                SELECT (%(chats)s::int[])[1 + i %% %(chat_count)s], %(sender)s,
+                       (SELECT string_agg((%(words)s::text[])[1 + floor(random() * %(word_count)s)::int], ' ')
+                        FROM generate_series(1, %(per_message)s) AS w
+                        WHERE w > i - i)
+                       || CASE WHEN i %% %(rare_every)s = 0 THEN ' ' || %(rare)s ELSE '' END,
+                       LOCALTIMESTAMP - random() * INTERVAL '365 days'
+                FROM generate_series(%(start)s, %(stop)s - 1) AS i
+            """, {
+                'chats': chat_ids, 'chat_count': len(chat_ids), 'sender': sender.user_id, 'words': SEARCH_WORDS,
+                'word_count': len(SEARCH_WORDS), 'per_message': SEARCH_WORDS_PER_MESSAGE,
+                'rare_every': SEARCH_RARE_EVERY, 'rare': SEARCH_RARE_WORD, 'start': loaded, 'stop': loaded + count
+            })
+            loaded += count
+        bench.execute("ANALYZE messages")
+
+        def search(query: str, chat_id: Optional[int] = None) -> Any:
+            params = {'q': query, 'limit': 20}
+            if chat_id is not None:
+                params['chat_id'] = chat_id
+            return lambda: searcher.request('GET', 'messages', params)[0]
+
+        rows.append(bench.measure(size, 'common word', search(SEARCH_WORDS[2])))
+        rows.append(bench.measure(size, 'two common words', search('%s %s' % (SEARCH_WORDS[1], SEARCH_WORDS[2]))))
+        rows.append(bench.measure(size, 'rare word', search(SEARCH_RARE_WORD)))
+        rows.append(bench.measure(size, 'common word, one chat', search(SEARCH_WORDS[2], chat_ids[0])))
+    searcher.close()
+    sender.close()
+    return rows
+
+# The browser sends a heartbeat every 30 s (HEARTBEAT_INTERVAL in ChatInterface.tsx)
+PRESENCE_HEARTBEAT_INTERVAL = 30
+PRESENCE_CLIENTS = 16
+PRESENCE_TTL = 90
+PRESENCE_LOOKUP_IDS = 50
+
+def bench_presence(bench: Bench, sizes: List[int]) -> List[Dict[str, Any]]:
+    '''
+    size users send heartbeats from PRESENCE_CLIENTS connections as fast as
+    the server takes them, three times: first (a new user_presence row),
+    after their rows were aged as if PRESENCE_HEARTBEAT_INTERVAL had passed
+    (an update) and straight away again, like a second tab (no write).
+    needed_per_second is what size users send in steady state. The users
+    table should see no writes at all. Then presence is looked up for
+    PRESENCE_LOOKUP_IDS users at a time, and half the rows are expired and
+    removed by the same DELETE the periodic sweep runs (with the default
+    PRESENCE_TTL).
+    '''
+    user_ids: List[int] = []
+    tokens: Dict[int, str] = {}
+    clients = [Client(bench.base_url, 0, [], [], bench.rng) for _ in range(PRESENCE_CLIENTS)]
+    lookup = bench.client()
+
+    def xid() -> int:
+        return bench.execute("SELECT txid_current() % 4294967296")[0][0]
+
+    def written(table: str, since: int) -> int:
+        # Rows inserted or updated by transactions after since
+        return bench.execute("SELECT COUNT(*) FROM %s WHERE xmin::text::bigint > %%s" % table, (since,))[0][0]
+
+    def heartbeats(size: int, label: str) -> Dict[str, Any]:
+        lock = threading.Lock()
+        latencies: List[float] = []
+        errors = [0]
+        pending = iter(user_ids[:size])
+
+        def worker(client: Client) -> None:
+            while True:
+                with lock:
+                    user_id = next(pending, None)
+                if user_id is None:
+                    return
+                body = {'action': 'heartbeat', 'user_id': user_id}
+                started = time.perf_counter()
+                status, _, _ = client.request('POST', 'users', body=body, headers={'Authorization': 'Bearer ' + tokens[user_id]})
+                with lock:
+                    if status == 200:
+                        latencies.append((time.perf_counter() - started) * 1000)
+                    else:
+                        errors[0] += 1
+
+        since = xid()
+        started = time.perf_counter()
+        threads = [threading.Thread(target=worker, args=(client,)) for client in clients]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        return bench.row(
+            size, label, latencies, errors[0],
+            per_second=round(len(latencies) / elapsed, 1),
+            needed_per_second=round(size / PRESENCE_HEARTBEAT_INTERVAL, 1),
+            users_writes=written('users', since),
+            presence_writes=written('user_presence', since)
+        )
+
+    rows: List[Dict[str, Any]] = []
+    for size in sorted(sizes):
+        if len(user_ids) < size:
+            added = bench.users(size - len(user_ids))
+            tokens.update(bench.tokens(added))
+            user_ids.extend(added)
+        bench.execute("DELETE FROM user_presence WHERE user_id = ANY(%s)", (user_ids[:size],))
+        rows.append(heartbeats(size, 'heartbeat, first'))
+        bench.execute(
+            "UPDATE user_presence SET last_seen_at = last_seen_at - make_interval(secs => %s) WHERE user_id = ANY(%s)",
+            (PRESENCE_HEARTBEAT_INTERVAL, user_ids[:size])
+        )
+        rows.append(heartbeats(size, 'heartbeat, 30 s later'))
+        rows.append(heartbeats(size, 'heartbeat, second tab'))
+
+        def presence_lookup() -> int:
+            ids = ','.join(str(user_id) for user_id in bench.rng.sample(user_ids[:size], min(size, PRESENCE_LOOKUP_IDS)))
+            return lookup.request('GET', 'users', {'presence_ids': ids})[0]
+
+        rows.append(bench.measure(size, 'presence lookup', presence_lookup))
+
+        bench.execute(
+            "UPDATE user_presence SET last_seen_at = last_seen_at - INTERVAL '1 day' WHERE user_id = ANY(%s)",
+            (user_ids[:size:2],)
+        )
+        started = time.perf_counter()
+        removed = bench.execute(
+            "WITH removed AS (DELETE FROM user_presence WHERE last_seen_at < CURRENT_TIMESTAMP - make_interval(secs => %s) "
+            "RETURNING 1) SELECT COUNT(*) FROM removed", (PRESENCE_TTL,)
+        )[0][0]
+        rows.append(bench.row(size, 'expiry sweep (sql)', [(time.perf_counter() - started) * 1000], 0, removed=removed))
+    for client in clients:
+        client.close()
+    lookup.close()
+    return rows
+
+MARK_READ_CLIENTS = 16
+MARK_READ_ROUNDS = 3
+MARK_READ_NEW_MESSAGES = 20
+
+def bench_mark_read(bench: Bench, sizes: List[int]) -> List[Dict[str, Any]]:
+    '''
+    A group of size members gets MARK_READ_NEW_MESSAGES new messages and
+    then every member marks it read from MARK_READ_CLIENTS concurrent
+    clients, MARK_READ_ROUNDS times: mark-reads/s, latency and the rows
+    written to chat_members and messages. The per-message read_by appends
+    it used to make are timed against the database for --requests members
+    next to it.
+    '''
+    user_ids: List[int] = []
+    tokens: Dict[int, str] = {}
+    clients = [Client(bench.base_url, 0, [], [], bench.rng) for _ in range(MARK_READ_CLIENTS)]
+
+    def xid() -> int:
+        return bench.execute("SELECT txid_current() % 4294967296")[0][0]
+
+    def written(table: str, since: int) -> int:
+        # Rows inserted or updated by transactions after since
+        return bench.execute("SELECT COUNT(*) FROM %s WHERE xmin::text::bigint > %%s" % table, (since,))[0][0]
+
+    rows: List[Dict[str, Any]] = []
+    for size in sorted(sizes):
+        if len(user_ids) < size:
+            added = bench.users(size - len(user_ids))
+            tokens.update(bench.tokens(added))
+            user_ids.extend(added)
+        members = user_ids[:size]
+        chat_id = bench.group_chat(members)
+        for round_number in range(MARK_READ_ROUNDS):
+            start = bench.execute("SELECT LOCALTIMESTAMP")[0][0]
+            newest = bench.add_messages(chat_id, members[:GROUP_SIZE], MARK_READ_NEW_MESSAGES, start, 1)
+            lock = threading.Lock()
+            latencies: List[float] = []
+            errors = [0]
+            pending = iter(members)
+
+            def worker(client: Client) -> None:
+                while True:
+                    with lock:
+                        user_id = next(pending, None)
+                    if user_id is None:
+                        return
+                    body = {'chat_id': chat_id, 'user_id': user_id, 'up_to_id': newest}
+                    started = time.perf_counter()
+                    status, _, _ = client.request(
+                        'PUT', 'messages', body=body, headers={'Authorization': 'Bearer ' + tokens[user_id]}
+                    )
+                    with lock:
+                        if status == 200:
+                            latencies.append((time.perf_counter() - started) * 1000)
+                        else:
+                            errors[0] += 1
+
+            since = xid()
+            started = time.perf_counter()
+            threads = [threading.Thread(target=worker, args=(client,)) for client in clients]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - started
+            rows.append(bench.row(
+                size, 'mark read, round %d' % (round_number + 1), latencies, errors[0],
+                per_second=round(len(latencies) / elapsed, 1),
+                member_writes=written('chat_members', since),
+                message_writes=written('messages', since)
+            ))
+
+        unread = [row[0] for row in bench.execute(
+            "SELECT id FROM messages WHERE chat_id = %s ORDER BY id DESC LIMIT %s", (chat_id, MARK_READ_NEW_MESSAGES)
+        )]
+        readers = iter(members[:bench.requests])
+
+        def old_mark_read() -> int:
+            user_id = next(readers)
+            with bench.conn.cursor() as cur:
+                for message_id in unread:
+                    cur.execute(
+                        "UPDATE messages SET read_by = array_append(read_by, %s) WHERE id = %s AND NOT (%s = ANY(read_by))",
+                        (user_id, message_id, user_id)
+                    )
+            return 200
+
+        since = xid()
+        started = time.perf_counter()
+        row = bench.measure(size, 'old read_by appends (sql)', old_mark_read, min(size, bench.requests))
+        row['per_second'] = round(row['count'] / (time.perf_counter() - started), 1)
+        row['message_updates'] = row['count'] * len(unread)
+        row['message_writes'] = written('messages', since)
+        rows.append(row)
+    for client in clients:
+        client.close()
+    return rows
+
+# Peak RSS of this process (server, function and client included) that
+# an export of any size must stay under
+EXPORT_MAX_RSS_MB = 256
+
+def bench_export(bench: Bench, sizes: List[int]) -> List[Dict[str, Any]]:
+    '''
+    One chat whose history grows to each size, loaded PARTITION_LOAD_CHUNK
+    rows at a time, is exported in full through a copy of the messages
+    function called in this process, following X-Next-After-Id from chunk
+    to chunk and dropping each body once counted. Memory is meant to be
+    bounded by EXPORT_CHUNK_BYTES, not the history: the run fails when the
+    process's peak RSS passes EXPORT_MAX_RSS_MB.
+    '''
+    handler = bench.function('messages')
+    reader, sender = bench.client(), bench.client()
+    chat_id = bench.create_chat(reader, [sender.user_id])
+    step_ms = 1
+    start = bench.execute("SELECT LOCALTIMESTAMP - %s * INTERVAL '1 millisecond'", (max(sizes) * step_ms,))[0][0]
+    rows: List[Dict[str, Any]] = []
+    loaded = 0
+    for size in sorted(sizes):
+        while loaded < size:
+            count = min(PARTITION_LOAD_CHUNK, size - loaded)
+            bench.add_messages(chat_id, [reader.user_id, sender.user_id], count,
+                               start + timedelta(milliseconds=loaded * step_ms), step_ms)
+            loaded += count
+
+        chunks = 0
+        exported = 0
+        after_id = 0
+        started = time.perf_counter()
+        while after_id is not None:
+            response = bench.invoke(handler, 'messages', reader, {'chat_id': chat_id, 'export': 1, 'after_id': after_id})
+            if response['statusCode'] != 200:
+                raise RuntimeError('export failed: %d %s' % (response['statusCode'], response['body'][:200]))
+            chunks += 1
+            exported += response['body'].count('\n')
+            next_after_id = response['headers'].get('X-Next-After-Id')
+            after_id = int(next_after_id) if next_after_id else None
+        elapsed = time.perf_counter() - started
+        if exported != size:
+            raise RuntimeError('export returned %d of %d messages' % (exported, size))
+
+        # ru_maxrss is in KiB on Linux and bytes on macOS
+        peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+        rows.append(bench.row(
+            size, 'full export', [elapsed * 1000], 0,
+            chunks=chunks,
+            rows_per_second=round(exported / elapsed),
+            peak_rss_mb=round(peak_rss_mb, 1)
+        ))
+        if peak_rss_mb > EXPORT_MAX_RSS_MB:
+            raise RuntimeError('export of %d messages peaked at %.1f MB RSS, over %d MB' % (
+                size, peak_rss_mb, EXPORT_MAX_RSS_MB))
+    reader.close()
+    sender.close()
+    return rows
+
+# Calls per measure of the render bench; CPU time and allocations are
+# averaged, in separate passes since tracing slows the handler down
+RENDER_SAMPLES = 5
+
+def bench_render(bench: Bench, sizes: List[int]) -> List[Dict[str, Any]]:
+    '''
+    A user with size private chats fetches the chat list from a copy of the
+    chats function called in this process, once with the rows turned into
+    JSON in Python and once with render=db, where Postgres builds the body.
+    After a warm-up call, RENDER_SAMPLES calls are timed for handler CPU
+    (time.thread_time, so the database's own CPU is not included) and wall
+    time, and RENDER_SAMPLES more under tracemalloc for peak allocations.
+    Both bodies must hold the same chats.
+    '''
+    handler = bench.function('chats')
+    rows: List[Dict[str, Any]] = []
+    for size in sorted(sizes):
+        reader = bench.client()
+        bench.private_chats(reader, size)
+        bodies = {}
+        for label, params in (('list, python', {'user_id': reader.user_id}),
+                              ('list, render=db', {'user_id': reader.user_id, 'render': 'db'})):
+            bodies[label] = bench.invoke(handler, 'chats', reader, params)['body']
+            latencies: List[float] = []
+            cpu_ms: List[float] = []
+            errors = 0
+            for _ in range(RENDER_SAMPLES):
+                started, cpu_started = time.perf_counter(), time.thread_time()
+                status = bench.invoke(handler, 'chats', reader, params)['statusCode']
+                cpu_ms.append((time.thread_time() - cpu_started) * 1000)
+                latencies.append((time.perf_counter() - started) * 1000)
+                errors += status != 200
+            peaks: List[float] = []
+            for _ in range(RENDER_SAMPLES):
+                tracemalloc.start()
+                bench.invoke(handler, 'chats', reader, params)
+                peaks.append(tracemalloc.get_traced_memory()[1] / (1024 * 1024))
+                tracemalloc.stop()
+            rows.append(bench.row(
+                size, label, latencies, errors,
+                cpu_ms=round(sum(cpu_ms) / len(cpu_ms), 1),
+                peak_alloc_mb=round(sum(peaks) / len(peaks), 1),
+                body_bytes=len(bodies[label])
+            ))
+        if json.loads(bodies['list, python']) != json.loads(bodies['list, render=db']):
+            raise RuntimeError('render=db returned a different chat list for %d chats' % size)
+        reader.close()
+    return rows
+
+# In-process calls per measure whose logged database time is averaged
+CONDITIONAL_SAMPLES = 20
+
+def bench_conditional(bench: Bench, sizes: List[int]) -> List[Dict[str, Any]]:
+    '''
+    A client with size chats polls its chat list and the page of one chat
+    while nothing changes, once without If-None-Match (a full 200 every
+    time, as before ETags) and once sending the ETag it got (a 304 after
+    the version lookup). Latency is timed over HTTP; round trips, database
+    time and body bytes come from the functions' own request logs, the
+    database time as the median of CONDITIONAL_SAMPLES calls.
+    '''
+    rows: List[Dict[str, Any]] = []
+    for size in sorted(sizes):
+        reader = bench.client()
+        chat_ids = bench.private_chats(reader, size)
+        bench.add_messages(chat_ids[0], [reader.user_id], 50,
+                           bench.execute("SELECT LOCALTIMESTAMP - INTERVAL '1 hour'")[0][0], 1000)
+        for name, params in (('chats', {'user_id': reader.user_id}), ('messages', {'chat_id': chat_ids[0], 'limit': 50})):
+            status, response_headers, _ = reader.request('GET', name, params)
+            etag = response_headers.get('etag')
+            if status != 200 or not etag:
+                raise RuntimeError('%s answered %d without an ETag' % (name, status))
+            for label, headers in (('full', None), ('idle, 304', {'If-None-Match': etag})):
+                row = bench.measure(size, '%s %s' % (name, label), lambda: reader.request('GET', name, params, headers=headers)[0])
+                logged = [bench.request_log(name, reader, params, headers) for _ in range(CONDITIONAL_SAMPLES)]
+                row['status'] = logged[-1]['status']
+                row['queries'] = logged[-1]['queries']
+                row['db_ms'] = sorted(record['db_ms'] for record in logged)[len(logged) // 2]
+                row['body_bytes'] = logged[-1]['body_bytes']
+                rows.append(row)
+        reader.close()
+    return rows
+
+BENCHMARKS = {
+    'history': (bench_history, [1000, 10000, 100000, 1000000]),
+    'waiters': (bench_waiters, [100, 1000, 3000]),
+    'partitions': (bench_partitions, [1000000, 10000000, 100000000]),
+    'chat_list': (bench_chat_list, [10, 100, 1000]),
+    'pool': (bench_pool, [1, 4, 16]),
+    'groups': (bench_groups, [10, 1000, 10000]),
+    'user_search': (bench_user_search, [10000, 100000, 1000000]),
+    'search': (bench_search, [1000000, 10000000, 30000000]),
+    'presence': (bench_presence, [1000, 10000, 100000]),
+    'conditional': (bench_conditional, [10, 100, 1000]),
+    'mark_read': (bench_mark_read, [10, 100, 500]),
+    'export': (bench_export, [1000000, 5000000]),
+    'render': (bench_render, [1000, 10000])
+}
+
+def run_bench(base_url: str, database_url: str, name: str, sizes: Optional[List[int]], requests: int,
+              rng_seed: int) -> Dict[str, Any]:
+    bench_fn, default_sizes = BENCHMARKS[name]
+    bench = Bench(base_url, database_url, requests, random.Random(rng_seed))
+    try:
+        started = time.monotonic()
+        rows = bench_fn(bench, sizes or default_sizes)
+    finally:
+        bench.close()
+    return {'bench': name, 'elapsed_s': round(time.monotonic() - started, 2), 'rows': rows}
+
+def print_bench(result: Dict[str, Any]) -> None:
+    print('%-10s %-28s %7s %7s %9s %9s  %s' % ('size', 'measure', 'count', 'errors', 'p50 ms', 'p99 ms', 'notes'))
+    for row in result['rows']:
+        notes = ' '.join('%s=%s' % (key, value) for key, value in row.items()
+                         if key not in ('size', 'label', 'count', 'errors', 'p50_ms', 'p99_ms'))
+        print('%-10d %-28s %7d %7d %9.2f %9.2f  %s' % (
+            row['size'], row['label'], row['count'], row['errors'], row['p50_ms'], row['p99_ms'], notes))
+    print('\n%s: %.1fs' % (result['bench'], result['elapsed_s']))
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Load test the chat backend')
+    parser.add_argument('--base-url', help='running local_server; default starts one in-process')
+    parser.add_argument('--start-server', action='store_true', help='start local_server in-process (needs DATABASE_URL)')
+    parser.add_argument('--database-url', default=os.environ.get('DATABASE_URL'))
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS), default='chat')
+    parser.add_argument('--users', type=int, default=60)
+    parser.add_argument('--groups', type=int, default=10)
+    parser.add_argument('--clients', type=int, default=24)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='write the report here')
+    parser.add_argument('--baseline', help='report from an earlier run to compare against')
+    parser.add_argument('--max-regression', type=float, default=0.25, help='allowed relative p95 growth')
+    parser.add_argument('--min-delta-ms', type=float, default=2.0, help='ignore p95 growth below this')
+    parser.add_argument('--bench', choices=sorted(BENCHMARKS), help='run a scale benchmark instead (needs DATABASE_URL)')
+    parser.add_argument('--sizes', help='comma-separated data sizes for --bench')
+    parser.add_argument('--requests', type=int, default=200, help='timed requests per measure and size')
+    args = parser.parse_args()
+
+    base_url = args.base_url
+    if base_url is None or args.start_server:
+        if not args.database_url:
+            parser.error('--base-url, or DATABASE_URL / --database-url with --start-server')
+        import local_server
+        os.environ['DATABASE_URL'] = args.database_url
+        os.environ.setdefault('METRICS_LOG_REQUESTS', '0')
+        if args.bench:
+            # One user repeats one request; per-user limits would only measure the 429s
+            os.environ.setdefault('RATE_LIMIT_ENABLED', '0')
+            # Benchmarks register thousands of users; the KDF cost is not what they measure
+            os.environ.setdefault('PASSWORD_PBKDF2_ITERATIONS', '1000')
+        _, base_url = local_server.start_server()
+
+    if args.bench:
+        if not args.database_url:
+            parser.error('--bench loads its data through DATABASE_URL / --database-url')
+        sizes = [int(size) for size in args.sizes.split(',')] if args.sizes else None
+        result = run_bench(base_url, args.database_url, args.bench, sizes, args.requests, args.seed)
+        print_bench(result)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(result, f, indent=2, default=str)
+        return 0 if all(row['errors'] == 0 for row in result['rows']) else 1
+
+    rng = random.Random(args.seed)
+    chats, tokens = seed(base_url, args.users, args.groups, rng, args.scenario in SHARED_CHAT_SCENARIOS)
+    result = run_load(base_url, chats, tokens, args.clients, args.duration, SCENARIOS[args.scenario], args.seed)
+    result['scenario'] = args.scenario
+    print_report(result)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            problems = compare(result, json.load(f), args.max_regression, args.min_delta_ms)
+        for problem in problems:
+            print('REGRESSION ' + problem)
+        if problems:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
\ No newline at end of file
@@ -0,0 +1,248 @@
+'''
+Run every backend function on one local HTTP server.
+
+    DATABASE_URL=postgresql://localhost/pchat python scripts/local_server.py --migrate [--reset] [--port 8000]
+
+Functions are mounted at /<name> and at the path of their production URL
+from backend/func2url.json (so /messages?chat_id=1 and
+/3bdf8938-...?chat_id=1 both reach messages); functions missing from
+func2url.json are only mounted at /<name>. Each function is imported
+with its own directory on sys.path, so its copies of db.py, metrics.py and
+friends stay separate, exactly as when deployed. --migrate applies
+db_migrations/*.sql in order and records them in local_schema_history;
+--reset drops the public schema first. --replica-url routes reads to a
+streaming replica of the database (see DATABASE_REPLICA_URLS in db.py).
+'''
+import argparse
+import base64
+import glob
+import importlib.util
+import json
+import os
+import secrets
+import sys
+import threading
+import traceback
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Tuple
+from urllib.parse import parse_qsl, urlsplit
+
+import psycopg2
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACKEND_DIR = os.path.join(ROOT, 'backend')
+MIGRATIONS_DIR = os.path.join(ROOT, 'db_migrations')
+
+_import_lock = threading.Lock()
+
+class Context:
+    def __init__(self, function_name: str) -> None:
+        self.request_id = uuid.uuid4().hex
+        self.function_name = function_name
+
+def load_function(name: str) -> Callable[[Dict[str, Any], Any], Dict[str, Any]]:
+    '''
+    Import backend/<name>/index.py so that its sibling modules shadow any
+    other function's copies, then forget them again for the next function.
+    '''
+    directory = os.path.join(BACKEND_DIR, name)
+    local_modules = [os.path.splitext(os.path.basename(path))[0] for path in glob.glob(os.path.join(directory, '*.py'))]
+
+    with _import_lock:
+        saved = {module: sys.modules.pop(module) for module in local_modules if module in sys.modules}
+        sys.path.insert(0, directory)
+        try:
+            spec = importlib.util.spec_from_file_location('pchat_%s_index' % name, os.path.join(directory, 'index.py'))
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+        finally:
+            sys.path.remove(directory)
+            for local_module in local_modules:
+                sys.modules.pop(local_module, None)
+            sys.modules.update(saved)
+
+    return module.handler
+
+def load_routes() -> Dict[str, Tuple[str, Callable[..., Dict[str, Any]]]]:
+    # Every function runs in this process, so a key made up here is shared
+    # by all of them; tokens stop verifying when the server restarts
+    os.environ.setdefault('SESSION_SECRETS', secrets.token_urlsafe(32))
+    with open(os.path.join(BACKEND_DIR, 'func2url.json')) as f:
+        func2url = json.load(f)
+
+    routes = {}
+    for name, url in sorted(func2url.items()):
+        handler = load_function(name)
+        routes['/' + name] = (name, handler)
+        routes[urlsplit(url).path.rstrip('/')] = (name, handler)
+
+    # Functions that have not been deployed yet have no URL to mirror
+    for path in sorted(glob.glob(os.path.join(BACKEND_DIR, '*', 'index.py'))):
+        name = os.path.basename(os.path.dirname(path))
+        if name not in func2url:
+            routes['/' + name] = (name, load_function(name))
+    return routes
+
+def migrate(dsn: str, reset: bool = False) -> None:
+    '''
+    Apply pending db_migrations in version order, comparing dotted versions
+    part by part (V0008.1 runs between V0008 and V0009). Files that build
+    indexes CONCURRENTLY run outside a transaction, like Flyway does.
+    '''
+    conn = psycopg2.connect(dsn)
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            if reset:
+                cur.execute('DROP SCHEMA public CASCADE; CREATE SCHEMA public')
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS local_schema_history (
+                    version VARCHAR(50) PRIMARY KEY,
+                    script VARCHAR(255) NOT NULL,
+                    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            cur.execute('SELECT version FROM local_schema_history')
+            applied = {row[0] for row in cur.fetchall()}
+
+            for path in sorted(glob.glob(os.path.join(MIGRATIONS_DIR, 'V*__*.sql')),
+                               key=lambda p: [int(part) for part in os.path.basename(p)[1:].split('__')[0].split('.')]):
+                script = os.path.basename(path)
+                version = script.split('__')[0]
+                if version in applied:
+                    continue
+                with open(path) as f:
+                    sql = f.read()
+
+                if 'CONCURRENTLY' in sql:
+                    cur.execute(sql)
+                else:
+                    cur.execute('BEGIN')
+                    try:
+                        cur.execute(sql)
+                    except psycopg2.Error:
+                        cur.execute('ROLLBACK')
+                        raise
+                    cur.execute('COMMIT')
+                cur.execute('INSERT INTO local_schema_history (version, script) VALUES (%s, %s)', (version, script))
+                print('applied %s' % script, file=sys.stderr)
+    finally:
+        conn.close()
+
+def make_request_handler(routes: Dict[str, Tuple[str, Callable[..., Dict[str, Any]]]], quiet: bool) -> type:
+    class FunctionRequestHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # Headers and body go out in separate writes; with Nagle on, the body
+        # waits for the client's delayed ACK and every response takes ~40 ms
+        disable_nagle_algorithm = True
+
+        def _dispatch(self) -> None:
+            parts = urlsplit(self.path)
+            route = routes.get(parts.path.rstrip('/'))
+            length = int(self.headers.get('Content-Length') or 0)
+            raw = self.rfile.read(length) if length else b''
+            # Like the gateway: text bodies pass through, anything else is base64
+            content_type = (self.headers.get('Content-Type') or 'application/json').split(';')[0].strip()
+            is_base64 = not (content_type.startswith('text/') or content_type.endswith('json'))
+            body = base64.b64encode(raw).decode('ascii') if is_base64 else raw.decode('utf-8')
+
+            if route is None:
+                self._send(404, {'Content-Type': 'application/json'}, json.dumps({'error': 'Unknown function'}))
+                return
+
+            name, handler = route
+            event = {
+                'httpMethod': self.command,
+                'path': parts.path,
+                'headers': dict(self.headers.items()),
+                'queryStringParameters': dict(parse_qsl(parts.query, keep_blank_values=True)),
+                'body': body,
+                'isBase64Encoded': is_base64,
+                'requestContext': {'identity': {'sourceIp': self.client_address[0]}}
+            }
+
+            try:
+                response = handler(event, Context(name))
+            except Exception:
+                traceback.print_exc()
+                self._send(500, {'Content-Type': 'application/json'}, json.dumps({'error': 'Internal error'}))
+                return
+
+            payload = response.get('body') or ''
+            if response.get('isBase64Encoded'):
+                payload = base64.b64decode(payload)
+            self._send(response.get('statusCode', 200), response.get('headers') or {}, payload)
+
+        def _send(self, status: int, headers: Dict[str, str], payload: Any) -> None:
+            data = payload.encode('utf-8') if isinstance(payload, str) else payload
+            self.send_response(status)
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        do_GET = do_POST = do_PUT = do_DELETE = do_OPTIONS = _dispatch
+
+        def log_message(self, format: str, *args: Any) -> None:
+            if not quiet:
+                super().log_message(format, *args)
+
+    return FunctionRequestHandler
+
+class Server(ThreadingHTTPServer):
+    # Load tests open thousands of keep-alive connections at once
+    request_queue_size = 1024
+    daemon_threads = True
+
+    def handle_error(self, request: Any, client_address: Any) -> None:
+        # Clients that hang up mid-response (load tests stop that way) are not errors
+        if isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            return
+        super().handle_error(request, client_address)
+
+def start_server(host: str = '127.0.0.1', port: int = 0, quiet: bool = True) -> Tuple[ThreadingHTTPServer, str]:
+    '''
+    Start the server on a background thread; returns it and its base URL.
+    DATABASE_URL must already be set.
+    '''
+    server = Server((host, port), make_request_handler(load_routes(), quiet))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://%s:%d' % server.server_address[:2]
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Serve all backend functions locally')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--database-url', default=os.environ.get('DATABASE_URL'))
+    parser.add_argument('--replica-url', action='append', help='streaming replica for reads; repeat for more')
+    parser.add_argument('--migrate', action='store_true', help='apply pending db_migrations first')
+    parser.add_argument('--reset', action='store_true', help='drop the public schema before migrating')
+    parser.add_argument('--quiet', action='store_true', help='no access log')
+    args = parser.parse_args()
+
+    if not args.database_url:
+        parser.error('DATABASE_URL or --database-url required')
+    os.environ['DATABASE_URL'] = args.database_url
+    if args.replica_url:
+        os.environ['DATABASE_REPLICA_URLS'] = ','.join(args.replica_url)
+
+    if args.migrate or args.reset:
+        migrate(args.database_url, reset=args.reset)
+
+    routes = load_routes()
+    server = Server((args.host, args.port), make_request_handler(routes, args.quiet))
+    for path, (name, _) in sorted(routes.items(), key=lambda item: item[1][0]):
+        print('http://%s:%d%s -> %s' % (args.host, args.port, path, name), file=sys.stderr)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
\ No newline at end of file
@@ -0,0 +1,186 @@
+'''
+Maintenance for the monthly partitions of messages.
+
+    python scripts/message_archive.py ensure [--months-ahead 3]
+    python scripts/message_archive.py archive --before 2026-01 --dir /var/backups/pchat [--keep-table]
+    python scripts/message_archive.py restore /var/backups/pchat/messages_p2025_11.json
+
+ensure creates upcoming month partitions (run it daily so new rows never
+land in messages_default). archive exports every partition that ends on or
+before the given month to a gzipped CSV with a JSON manifest, then detaches
+and drops it. restore loads an export back and re-attaches it.
+Connects to DATABASE_URL.
+'''
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import re
+import sys
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+import psycopg2
+
+LOCK_TIMEOUT = '5s'
+BOUND_RE = re.compile(r"FROM \((.+?)\) TO \((.+?)\)")
+
+def parse_bound(value: str) -> Optional[str]:
+    return None if value in ('MINVALUE', 'MAXVALUE') else value.strip("'")
+
+def list_partitions(cur: Any) -> List[Dict[str, Any]]:
+    cur.execute("""
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+        FROM pg_inherits i
+        INNER JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'messages'::regclass
+        ORDER BY c.relname
+    """)
+    partitions = []
+    for name, bound in cur.fetchall():
+        match = BOUND_RE.search(bound)
+        if match:
+            partitions.append({'name': name, 'from': parse_bound(match.group(1)), 'to': parse_bound(match.group(2))})
+    return partitions
+
+def stored_columns(cur: Any) -> List[str]:
+    '''
+    Columns that COPY can round-trip; generated ones are rebuilt on load.
+    '''
+    cur.execute("""
+        SELECT column_name
+        FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = 'messages' AND is_generated = 'NEVER'
+        ORDER BY ordinal_position
+    """)
+    return [row[0] for row in cur.fetchall()]
+
+def bounds_sql(partition: Dict[str, Any]) -> str:
+    lower = "'%s'" % partition['from'] if partition['from'] else 'MINVALUE'
+    return "FOR VALUES FROM (%s) TO ('%s')" % (lower, partition['to'])
+
+def ensure(conn: Any, months_ahead: int) -> None:
+    with conn.cursor() as cur:
+        cur.execute("SELECT messages_ensure_partitions(%s)", (months_ahead,))
+        created = cur.fetchone()[0]
+    conn.commit()
+    print('created %d partition(s)' % created)
+
+def export_partition(conn: Any, partition: Dict[str, Any], columns: List[str], directory: str) -> Dict[str, Any]:
+    path = os.path.join(directory, partition['name'] + '.csv.gz')
+    tmp_path = path + '.tmp'
+    column_list = ', '.join(columns)
+
+    with conn.cursor() as cur:
+        with gzip.open(tmp_path, 'wb') as out:
+            cur.copy_expert(
+                'COPY (SELECT %s FROM %s ORDER BY id) TO STDOUT WITH (FORMAT csv, HEADER)' % (column_list, partition['name']),
+                out
+            )
+        cur.execute('SELECT COUNT(*) FROM %s' % partition['name'])
+        rows = cur.fetchone()[0]
+    conn.commit()
+
+    digest = hashlib.sha256()
+    with open(tmp_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+    manifest = dict(partition, file=os.path.basename(path), rows=rows, columns=columns,
+                    sha256=digest.hexdigest(), exported_at=datetime.utcnow().isoformat())
+    with open(os.path.join(directory, partition['name'] + '.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    return manifest
+
+def archive(conn: Any, before: str, directory: str, keep_table: bool) -> None:
+    cutoff = datetime.strptime(before, '%Y-%m')
+    os.makedirs(directory, exist_ok=True)
+
+    with conn.cursor() as cur:
+        partitions = [p for p in list_partitions(cur) if datetime.fromisoformat(p['to']) <= cutoff]
+        columns = stored_columns(cur)
+    conn.commit()
+
+    for partition in partitions:
+        manifest = export_partition(conn, partition, columns, directory)
+
+        # Detaching only touches the catalog; the lock timeout keeps it from
+        # queueing behind long queries and stalling traffic
+        with conn.cursor() as cur:
+            cur.execute("SET LOCAL lock_timeout = %s", (LOCK_TIMEOUT,))
+            cur.execute('ALTER TABLE messages DETACH PARTITION %s' % partition['name'])
+            cur.execute(
+                "DELETE FROM message_client_ids WHERE created_at < %s AND (%s::timestamp IS NULL OR created_at >= %s)",
+                (partition['to'], partition['from'], partition['from'])
+            )
+            if not keep_table:
+                cur.execute('DROP TABLE %s' % partition['name'])
+        conn.commit()
+        print('archived %s: %d rows -> %s' % (partition['name'], manifest['rows'], manifest['file']))
+
+def restore(conn: Any, manifest_path: str) -> None:
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    path = os.path.join(os.path.dirname(manifest_path), manifest['file'])
+    name = manifest['name']
+    column_list = ', '.join(manifest['columns'])
+
+    with conn.cursor() as cur:
+        cur.execute('CREATE TABLE %s (LIKE messages INCLUDING DEFAULTS INCLUDING GENERATED)' % name)
+        with gzip.open(path, 'rb') as data:
+            cur.copy_expert('COPY %s (%s) FROM STDIN WITH (FORMAT csv, HEADER)' % (name, column_list), data)
+        cur.execute("SELECT COUNT(*) FROM %s" % name)
+        rows = cur.fetchone()[0]
+        if rows != manifest['rows']:
+            raise RuntimeError('%s: expected %d rows, loaded %d' % (name, manifest['rows'], rows))
+    conn.commit()
+
+    with conn.cursor() as cur:
+        cur.execute("SET LOCAL lock_timeout = %s", (LOCK_TIMEOUT,))
+        cur.execute('ALTER TABLE messages ATTACH PARTITION %s %s' % (name, bounds_sql(manifest)))
+        cur.execute("""
+            INSERT INTO message_client_ids (sender_id, client_message_id, message_id, created_at)
+            SELECT sender_id, client_message_id, id, created_at
+            FROM %s
+            WHERE client_message_id IS NOT NULL
+            ON CONFLICT DO NOTHING
+        """ % name)
+    conn.commit()
+    print('restored %s: %d rows' % (name, rows))
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Manage monthly partitions of messages')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    ensure_parser = commands.add_parser('ensure', help='create upcoming month partitions')
+    ensure_parser.add_argument('--months-ahead', type=int, default=3)
+
+    archive_parser = commands.add_parser('archive', help='export and drop partitions ending on or before a month')
+    archive_parser.add_argument('--before', required=True, help='YYYY-MM; partitions ending on or before it are archived')
+    archive_parser.add_argument('--dir', required=True)
+    archive_parser.add_argument('--keep-table', action='store_true', help='detach without dropping')
+
+    restore_parser = commands.add_parser('restore', help='load an archived partition and attach it again')
+    restore_parser.add_argument('manifest')
+
+    args = parser.parse_args()
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+
+    try:
+        if args.command == 'ensure':
+            ensure(conn, args.months_ahead)
+        elif args.command == 'archive':
+            archive(conn, args.before, args.dir, args.keep_table)
+        else:
+            restore(conn, args.manifest)
+    finally:
+        conn.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
\ No newline at end of file
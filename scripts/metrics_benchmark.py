@@ -0,0 +1,141 @@
+'''
+What the metrics instrumentation costs per request and per statement.
+
+    DATABASE_URL=postgresql://localhost/pchat python scripts/metrics_benchmark.py [--functions chats,messages] [--requests 200] [--rounds 21] [--max-overhead 0.05] [--json out.json]
+
+METRICS_ENABLED is read when a function is imported, so each function is
+loaded twice into this process, once with it off and once on, and serves
+its request from startup_profile.REQUESTS through both copies in turn:
+--rounds rounds of --requests requests each, the copy that goes first
+alternating, after a warm-up. Request log lines go to /dev/null, as the
+platform would write them to its log. SELECT 1 through each copy's pooled
+cursor, which is instrumented only when metrics are on, is timed the same
+way. Medians of the rounds are compared.
+
+The instrumentation only adds work in the function's own thread, so its
+overhead is the handler CPU time (time.thread_time) it adds, as a fraction
+of the request time without it; the wall-clock difference is printed too,
+but where the database shares the machine it moves by more than that from
+round to round. The exit status is non-zero when a function's overhead
+passes --max-overhead. Expects the users and chat created by run_tests.py
+(ids 1 and 2, chat 1).
+'''
+import argparse
+import contextlib
+import inspect
+import json
+import os
+import secrets
+import statistics
+import sys
+import time
+from typing import Any, Dict, List
+
+from startup_profile import REQUESTS, Context
+
+WARM_UP_REQUESTS = 50
+STATEMENTS = 500
+
+def load(function: str, enabled: bool) -> Any:
+    '''
+    A copy of the function's handler imported with metrics on or off.
+    '''
+    import local_server
+    os.environ['METRICS_ENABLED'] = '1' if enabled else '0'
+    with contextlib.redirect_stdout(open(os.devnull, 'w')):
+        return local_server.load_function(function)
+
+def time_requests(handler: Any, event: Dict[str, Any], count: int) -> Dict[str, float]:
+    started, cpu_started = time.perf_counter(), time.thread_time()
+    for _ in range(count):
+        response = handler(event, Context())
+        if response.get('statusCode', 200) >= 400:
+            raise RuntimeError('answered %s: %s' % (response.get('statusCode'), response.get('body')))
+    return {
+        'request_us': (time.perf_counter() - started) / count * 1e6,
+        'request_cpu_us': (time.thread_time() - cpu_started) / count * 1e6
+    }
+
+def time_statements(handler: Any, count: int) -> float:
+    db = inspect.unwrap(handler).__globals__['db']
+    conn = db.acquire()
+    try:
+        with conn.cursor() as cur:
+            started = time.perf_counter()
+            for _ in range(count):
+                cur.execute('SELECT 1')
+                cur.fetchone()
+            elapsed = time.perf_counter() - started
+        conn.rollback()
+    finally:
+        db.release(conn)
+    return elapsed / count * 1e6
+
+def measure(function: str, requests: int, rounds: int) -> Dict[str, Any]:
+    handlers = {enabled: load(function, enabled) for enabled in (False, True)}
+    token, _ = inspect.unwrap(handlers[True]).__globals__['session'].issue(1)
+    event = dict(REQUESTS[function], headers={'Authorization': 'Bearer ' + token})
+
+    samples: Dict[bool, List[Dict[str, float]]] = {False: [], True: []}
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for handler in handlers.values():
+            time_requests(handler, event, WARM_UP_REQUESTS)
+        for index in range(rounds):
+            # Alternate which goes first, so drift does not favour either
+            for enabled in ((False, True) if index % 2 == 0 else (True, False)):
+                sample = time_requests(handlers[enabled], event, requests)
+                sample['statement_us'] = time_statements(handlers[enabled], STATEMENTS)
+                samples[enabled].append(sample)
+
+    def median(enabled: bool, key: str) -> float:
+        return round(statistics.median(sample[key] for sample in samples[enabled]), 2)
+
+    result = {
+        'function': function,
+        'request_us_off': median(False, 'request_us'),
+        'request_us_on': median(True, 'request_us'),
+        'request_cpu_us_off': median(False, 'request_cpu_us'),
+        'request_cpu_us_on': median(True, 'request_cpu_us'),
+        'statement_us_off': median(False, 'statement_us'),
+        'statement_us_on': median(True, 'statement_us')
+    }
+    result['wall_overhead'] = round(result['request_us_on'] / result['request_us_off'] - 1, 4)
+    result['overhead'] = round((result['request_cpu_us_on'] - result['request_cpu_us_off']) / result['request_us_off'], 4)
+    return result
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Benchmark the overhead of the metrics instrumentation')
+    parser.add_argument('--functions', default='chats,messages', help='comma-separated, from: %s' % ', '.join(REQUESTS))
+    parser.add_argument('--requests', type=int, default=200, help='requests per copy and round')
+    parser.add_argument('--rounds', type=int, default=21)
+    parser.add_argument('--max-overhead', type=float, default=0.05, help='fail above this fraction of request time')
+    parser.add_argument('--json', help='write the report here')
+    args = parser.parse_args()
+
+    if 'DATABASE_URL' not in os.environ:
+        parser.error('DATABASE_URL is required')
+    os.environ.setdefault('SESSION_SECRETS', secrets.token_urlsafe(32))
+    os.environ['METRICS_LOG_REQUESTS'] = '1'
+    os.environ['RATE_LIMIT_ENABLED'] = '0'
+
+    results = [measure(function.strip(), args.requests, args.rounds)
+               for function in args.functions.split(',') if function.strip()]
+
+    print('%-10s %18s %18s %9s %9s %18s' % (
+        'function', 'request us off/on', 'handler CPU us', 'overhead', 'wall', 'SELECT 1 us off/on'))
+    for result in results:
+        print('%-10s %18s %18s %8.1f%% %8.1f%% %18s' % (
+            result['function'],
+            '%.1f / %.1f' % (result['request_us_off'], result['request_us_on']),
+            '%.1f / %.1f' % (result['request_cpu_us_off'], result['request_cpu_us_on']),
+            result['overhead'] * 100, result['wall_overhead'] * 100,
+            '%.2f / %.2f' % (result['statement_us_off'], result['statement_us_on'])
+        ))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0 if all(result['overhead'] <= args.max_overhead for result in results) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
\ No newline at end of file
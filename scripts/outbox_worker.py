@@ -0,0 +1,46 @@
+'''
+Apply queued message side effects from message_outbox.
+
+    python scripts/outbox_worker.py [--once] [--batch 500] [--interval 0.5]
+
+The messages function already drains after each send when no other drain
+is running; this worker covers the sends it skipped or failed on, and
+carries the whole load if the function runs with OUTBOX_INLINE_DRAIN=0.
+Batches are claimed with FOR UPDATE SKIP LOCKED, so several workers can
+run side by side. Uses DATABASE_URL.
+'''
+import argparse
+import os
+import sys
+import time
+
+import psycopg2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backend', 'messages'))
+
+import outbox
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Drain the message outbox')
+    parser.add_argument('--once', action='store_true', help='drain what is queued and exit')
+    parser.add_argument('--batch', type=int, default=outbox.BATCH_SIZE)
+    parser.add_argument('--interval', type=float, default=0.5, help='seconds to sleep when the outbox is empty')
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        while True:
+            applied = outbox.drain(conn, args.batch)
+            if applied:
+                print('applied %d outbox events' % applied)
+            if args.once:
+                break
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        conn.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
\ No newline at end of file
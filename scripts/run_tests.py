@@ -0,0 +1,146 @@
+'''
+Run every backend/*/tests.json against the local server.
+
+    DATABASE_URL=postgresql://localhost/pchat python scripts/run_tests.py [--reset] [--base-url URL]
+
+Without --base-url the server from local_server.py is started in-process
+on a free port. Functions run in FUNCTION_ORDER (later suites rely on the
+users and chats created by earlier ones) after FIXTURES register two users,
+so the ids 1 and 2 used throughout tests.json exist on a fresh database.
+Requests carry the session token of fixture user 1, or of the user id in
+a test's "sessionUser" ("sessionUser": null sends none).
+In expectedBody, "array", "object", "string", "number" and "boolean" match
+by type; any other value must be equal. bodyMatcher "partial" ignores keys
+that are not listed. Exits non-zero if any test fails.
+'''
+import argparse
+import json
+import os
+import sys
+import time
+import urllib.error
+import urllib.request
+from typing import Any, Dict, List, Optional, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import local_server
+
+FUNCTION_ORDER = ['auth', 'users', 'profile', 'chats', 'messages', 'attachments']
+FIXTURES = [
+    ('auth', 'POST', '', {'action': 'register', 'username': 'fixture_alice', 'password': 'fixture123'}),
+    ('auth', 'POST', '', {'action': 'register', 'username': 'fixture_bob', 'password': 'fixture123'}),
+]
+TYPE_MATCHERS = {
+    'array': list,
+    'object': dict,
+    'string': str,
+    'number': (int, float),
+    'boolean': bool
+}
+
+def request(base_url: str, function: str, method: str, path: str = '', body: Any = None,
+            headers: Optional[Dict[str, str]] = None) -> Tuple[int, Any]:
+    data = json.dumps(body).encode() if body is not None else None
+    req = urllib.request.Request(
+        base_url + '/' + function + (path.lstrip('/') if path.startswith('/?') else path),
+        data=data,
+        method=method,
+        headers=dict({'Content-Type': 'application/json'}, **(headers or {}))
+    )
+    try:
+        with urllib.request.urlopen(req) as response:
+            status, raw = response.status, response.read()
+    except urllib.error.HTTPError as error:
+        status, raw = error.code, error.read()
+    try:
+        return status, json.loads(raw) if raw else None
+    except ValueError:
+        return status, raw.decode('utf-8', 'replace')
+
+def matches(expected: Any, actual: Any, partial: bool) -> Optional[str]:
+    '''
+    None if actual satisfies expected, otherwise a description of the mismatch.
+    '''
+    if isinstance(expected, str) and expected in TYPE_MATCHERS:
+        kind = TYPE_MATCHERS[expected]
+        if isinstance(actual, kind) and not (expected == 'number' and isinstance(actual, bool)):
+            return None
+        return 'expected %s, got %r' % (expected, actual)
+    if isinstance(expected, dict):
+        if not isinstance(actual, dict):
+            return 'expected object, got %r' % (actual,)
+        if not partial and set(expected) != set(actual):
+            return 'keys %s != %s' % (sorted(expected), sorted(actual))
+        for key, value in expected.items():
+            if key not in actual:
+                return 'missing key %r' % key
+            problem = matches(value, actual[key], partial)
+            if problem:
+                return '%s: %s' % (key, problem)
+        return None
+    return None if expected == actual else 'expected %r, got %r' % (expected, actual)
+
+def run_suite(base_url: str, function: str, tokens: Dict[int, str]) -> List[Dict[str, Any]]:
+    with open(os.path.join(local_server.BACKEND_DIR, function, 'tests.json')) as f:
+        tests = json.load(f)['tests']
+
+    results = []
+    for test in tests:
+        session_user = test.get('sessionUser', 1)
+        headers = {'Authorization': 'Bearer ' + tokens[session_user]} if session_user in tokens else None
+        start = time.perf_counter()
+        status, body = request(base_url, function, test['method'], test.get('path', ''), test.get('body'), headers)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+
+        problem = None
+        if status != test['expectedStatus']:
+            problem = 'status %d, expected %d: %r' % (status, test['expectedStatus'], body)
+        elif 'expectedBody' in test:
+            problem = matches(test['expectedBody'], body, test.get('bodyMatcher') == 'partial')
+
+        results.append({'function': function, 'name': test['name'], 'ok': problem is None,
+                        'problem': problem, 'ms': round(elapsed_ms, 1)})
+    return results
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Run backend tests.json suites')
+    parser.add_argument('--base-url', help='use a running local_server instead of starting one')
+    parser.add_argument('--database-url', default=os.environ.get('DATABASE_URL'))
+    parser.add_argument('--reset', action='store_true', help='drop the public schema and migrate from scratch')
+    parser.add_argument('--only', action='append', help='run only these functions')
+    args = parser.parse_args()
+
+    base_url = args.base_url
+    if base_url is None:
+        if not args.database_url:
+            parser.error('DATABASE_URL or --database-url required')
+        os.environ['DATABASE_URL'] = args.database_url
+        local_server.migrate(args.database_url, reset=args.reset)
+        _, base_url = local_server.start_server()
+
+    tokens = {}
+    for function, method, path, body in FIXTURES:
+        status, payload = request(base_url, function, method, path, body)
+        if status != 200:
+            # Already registered by an earlier run on this database
+            status, payload = request(base_url, function, method, path, dict(body, action='login'))
+        if status == 200 and payload.get('token'):
+            tokens[payload['user']['id']] = payload['token']
+
+    results = []
+    for function in FUNCTION_ORDER:
+        if args.only and function not in args.only:
+            continue
+        results.extend(run_suite(base_url, function, tokens))
+
+    for result in results:
+        line = '%-4s %-9s %-55s %7.1f ms' % ('ok' if result['ok'] else 'FAIL', result['function'], result['name'], result['ms'])
+        print(line if result['ok'] else line + '\n     ' + result['problem'])
+
+    failed = sum(1 for result in results if not result['ok'])
+    print('\n%d passed, %d failed' % (len(results) - failed, failed))
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
\ No newline at end of file
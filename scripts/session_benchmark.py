@@ -0,0 +1,249 @@
+'''
+Measure what session tokens cost per request and how fast logins go.
+
+    DATABASE_URL=postgresql://localhost/pchat python scripts/session_benchmark.py [--iterations 600000] [--clients 8] [--json out.json]
+
+Runs three parts:
+
+  verify   session.verify() per call, with an empty deny-list and with
+           --revoked entries in it, next to one primary-key lookup over a
+           warm connection (the least a session-table check would cost).
+  kdf      one PBKDF2 hash at --iterations, then --hashes hashes from
+           --clients threads through the PASSWORD_HASH_WORKERS pool, and
+           verify() latency measured while that runs.
+  login    registers --users accounts over HTTP and logs them in --logins
+           times from --clients threads; logins/s and latency percentiles.
+
+--base-url points the login part at a running local_server; by default one
+is started in-process. The KDF cost and pool size are read when the auth
+modules are imported, so --iterations and --workers apply to both.
+'''
+import argparse
+import http.client
+import json
+import os
+import secrets
+import statistics
+import sys
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+from urllib.parse import urlsplit
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, SCRIPTS_DIR)
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] if ordered else 0.0
+
+def time_calls(fn: Any, count: int) -> float:
+    '''
+    Microseconds per call of fn().
+    '''
+    started = time.perf_counter()
+    for _ in range(count):
+        fn()
+    return (time.perf_counter() - started) / count * 1e6
+
+def bench_verify(session: Any, database_url: str, verifications: int, revoked: int, lookups: int) -> Dict[str, Any]:
+    import psycopg2
+
+    token, current = session.issue(1)
+    session.deny_list.refresh(force=True)
+    result = {'token_bytes': len(token)}
+    result['verify_us'] = round(time_calls(lambda: session.verify(token), verifications), 2)
+
+    now = int(time.time())
+    for index in range(revoked):
+        session.deny_list.add(100000 + index, uuid.uuid4().hex[:16], now if index % 10 == 0 else None, now + 3600)
+    result['revoked_entries'] = revoked
+    result['verify_with_revocations_us'] = round(time_calls(lambda: session.verify(token), verifications), 2)
+
+    conn = psycopg2.connect(database_url)
+    try:
+        with conn.cursor() as cur:
+            def lookup() -> None:
+                cur.execute("SELECT id FROM users WHERE id = %s", (current.user_id,))
+                cur.fetchone()
+            lookup()
+            result['db_lookup_us'] = round(time_calls(lookup, lookups), 2)
+        conn.rollback()
+    finally:
+        conn.close()
+    return result
+
+def bench_kdf(session: Any, passwords: Any, hashes: int, clients: int) -> Dict[str, Any]:
+    started = time.perf_counter()
+    passwords.hash_password('benchmark1')
+    result = {
+        'iterations': passwords.ITERATIONS,
+        'workers': passwords.WORKERS,
+        'hash_ms': round((time.perf_counter() - started) * 1000, 1)
+    }
+
+    remaining = [hashes]
+    lock = threading.Lock()
+    done = threading.Event()
+
+    def worker() -> None:
+        while True:
+            with lock:
+                if remaining[0] == 0:
+                    return
+                remaining[0] -= 1
+            passwords.hash_password('benchmark1')
+
+    # verify() latency while the pool is busy shows whether hashing stalls other requests
+    token, _ = session.issue(1)
+    verify_samples: List[float] = []
+
+    def prober() -> None:
+        while not done.is_set():
+            probe_started = time.perf_counter()
+            session.verify(token)
+            verify_samples.append((time.perf_counter() - probe_started) * 1e6)
+            time.sleep(0.001)
+
+    probe = threading.Thread(target=prober)
+    probe.start()
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    done.set()
+    probe.join()
+
+    result['hashes_per_second'] = round(hashes / elapsed, 1)
+    result['verify_under_load_p50_us'] = round(percentile(verify_samples, 0.5), 1)
+    result['verify_under_load_p99_us'] = round(percentile(verify_samples, 0.99), 1)
+    return result
+
+class AuthClient:
+    def __init__(self, base_url: str) -> None:
+        parts = urlsplit(base_url)
+        self.conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=60)
+        self.path = parts.path.rstrip('/') + '/auth'
+
+    def call(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        self.conn.request('POST', self.path, body=json.dumps(body), headers={'Content-Type': 'application/json'})
+        response = self.conn.getresponse()
+        payload = json.loads(response.read() or b'{}')
+        if response.status != 200:
+            raise RuntimeError('%s failed: %s %s' % (body['action'], response.status, payload))
+        return payload
+
+def bench_login(base_url: str, users: int, logins: int, clients: int) -> Dict[str, Any]:
+    prefix = 'bench_%s_' % uuid.uuid4().hex[:6]
+    usernames = ['%s%d' % (prefix, index) for index in range(users)]
+    client = AuthClient(base_url)
+    for username in usernames:
+        client.call({'action': 'register', 'username': username, 'password': 'benchmark1'})
+
+    queue = [usernames[index % users] for index in range(logins)]
+    lock = threading.Lock()
+    latencies: List[float] = []
+    errors = [0]
+
+    def worker() -> None:
+        worker_client = AuthClient(base_url)
+        while True:
+            with lock:
+                if not queue:
+                    return
+                username = queue.pop()
+            started = time.perf_counter()
+            try:
+                payload = worker_client.call({'action': 'login', 'username': username, 'password': 'benchmark1'})
+                if not payload.get('token'):
+                    raise RuntimeError('login returned no token')
+            except (OSError, RuntimeError, ValueError) as exc:
+                print('login error: %s' % exc, file=sys.stderr)
+                with lock:
+                    errors[0] += 1
+                continue
+            with lock:
+                latencies.append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    return {
+        'logins': len(latencies),
+        'errors': errors[0],
+        'clients': clients,
+        'logins_per_second': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.5), 1),
+        'p95_ms': round(percentile(latencies, 0.95), 1),
+        'mean_ms': round(statistics.mean(latencies), 1) if latencies else None
+    }
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Benchmark session verification and login throughput')
+    parser.add_argument('--database-url', default=os.environ.get('DATABASE_URL'))
+    parser.add_argument('--base-url', help='running local_server for the login part; default starts one in-process')
+    parser.add_argument('--iterations', type=int, help='PBKDF2 iterations (PASSWORD_PBKDF2_ITERATIONS)')
+    parser.add_argument('--workers', type=int, help='hash pool size (PASSWORD_HASH_WORKERS)')
+    parser.add_argument('--verifications', type=int, default=100000)
+    parser.add_argument('--revoked', type=int, default=10000, help='deny-list entries for the second verify run')
+    parser.add_argument('--lookups', type=int, default=2000, help='database lookups to compare against')
+    parser.add_argument('--hashes', type=int, default=64)
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--logins', type=int, default=200)
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--json', help='write the report here')
+    args = parser.parse_args()
+
+    if not args.database_url:
+        parser.error('DATABASE_URL or --database-url required')
+    os.environ['DATABASE_URL'] = args.database_url
+    os.environ.setdefault('METRICS_LOG_REQUESTS', '0')
+    os.environ.setdefault('SESSION_SECRETS', secrets.token_urlsafe(32))
+    if args.iterations:
+        os.environ['PASSWORD_PBKDF2_ITERATIONS'] = str(args.iterations)
+    if args.workers:
+        os.environ['PASSWORD_HASH_WORKERS'] = str(args.workers)
+
+    sys.path.insert(0, os.path.join(os.path.dirname(SCRIPTS_DIR), 'backend', 'auth'))
+    import passwords
+    import session
+
+    base_url: Optional[str] = args.base_url
+    if base_url is None:
+        import local_server
+        _, base_url = local_server.start_server()
+
+    results = {
+        'verify': bench_verify(session, args.database_url, args.verifications, args.revoked, args.lookups),
+        'kdf': bench_kdf(session, passwords, args.hashes, args.clients),
+        'login': bench_login(base_url, args.users, args.logins, args.clients)
+    }
+
+    verify = results['verify']
+    print('token %d bytes; verify %.2f us (%.2f us with %d revoked entries); primary-key lookup %.2f us (%.0fx)' % (
+        verify['token_bytes'], verify['verify_us'], verify['verify_with_revocations_us'], verify['revoked_entries'],
+        verify['db_lookup_us'], verify['db_lookup_us'] / max(verify['verify_us'], 0.01)))
+    kdf = results['kdf']
+    print('pbkdf2 %d iterations: %.1f ms per hash; %.1f hashes/s on %d workers; verify under load p50 %.1f us, p99 %.1f us' % (
+        kdf['iterations'], kdf['hash_ms'], kdf['hashes_per_second'], kdf['workers'],
+        kdf['verify_under_load_p50_us'], kdf['verify_under_load_p99_us']))
+    login = results['login']
+    print('login: %d ok, %d errors from %d clients; %.1f logins/s, p50 %.1f ms, p95 %.1f ms' % (
+        login['logins'], login['errors'], login['clients'], login['logins_per_second'], login['p50_ms'], login['p95_ms']))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0 if login['errors'] == 0 else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
\ No newline at end of file
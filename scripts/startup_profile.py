@@ -0,0 +1,201 @@
+'''
+Cold-start and query planning profile of the backend functions.
+
+    DATABASE_URL=postgresql://localhost/pchat python scripts/startup_profile.py [--functions chats,messages] [--repeat 30] [--json out.json]
+
+Every measurement runs in a fresh interpreter started with -X importtime,
+which imports backend/<name>/index.py the way the platform does and then
+serves the function's representative request from REQUESTS repeatedly.
+Per function it reports the import time (including db.warm_up(), which
+connects and prepares the registered statements), the modules that took
+longest to import, the first and second request with DB_WARM_UP on and
+off, and the steady-state request time with DB_PREPARE_STATEMENTS on and
+off. For each statement the requests ran through db.statement() it then
+compares the planning time of the plain SQL with EXECUTE of the prepared
+statement (median of EXPLAIN ANALYZE runs; writes are rolled back).
+Expects the users and chat created by run_tests.py (ids 1 and 2, chat 1).
+'''
+import argparse
+import importlib.util
+import inspect
+import json
+import os
+import secrets
+import statistics
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACKEND_DIR = os.path.join(ROOT, 'backend')
+IMPORT_MARKER = '-- importing index.py'
+
+REQUESTS = {
+    'auth': {'httpMethod': 'POST', 'body': json.dumps({'action': 'login', 'username': 'fixture_alice', 'password': 'fixture123'})},
+    'users': {'httpMethod': 'GET', 'queryStringParameters': {'q': 'fixture'}},
+    'profile': {'httpMethod': 'PUT', 'body': json.dumps({'user_id': 1, 'theme': 'light'})},
+    'chats': {'httpMethod': 'GET', 'queryStringParameters': {'user_id': '1'}},
+    'messages': {'httpMethod': 'GET', 'queryStringParameters': {'chat_id': '1', 'user_id': '1'}}
+}
+
+class Context:
+    request_id = 'startup-profile'
+
+def planning_ms(cur: Any, sql: str, params: Any) -> float:
+    cur.execute('EXPLAIN (ANALYZE, FORMAT JSON) ' + sql, params)
+    plan = cur.fetchone()[0][0]
+    cur.connection.rollback()
+    return plan['Planning Time']
+
+def child(function: str, repeat: int) -> Dict[str, Any]:
+    '''
+    Runs inside the fresh interpreter: import, serve, measure planning.
+    '''
+    directory = os.path.join(BACKEND_DIR, function)
+    sys.path.insert(0, directory)
+    # Everything -X importtime reports after this line is the function's
+    print(IMPORT_MARKER, file=sys.stderr, flush=True)
+    start = time.perf_counter()
+    spec = importlib.util.spec_from_file_location('index', os.path.join(directory, 'index.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    import_ms = (time.perf_counter() - start) * 1000
+
+    handler_globals = inspect.unwrap(module.handler).__globals__
+    db = handler_globals['db']
+    # Requests act as user 1, signed with the key run_child() made up
+    token, _ = handler_globals['session'].issue(1)
+    executed: Dict[str, Any] = {}
+    execute = db.Statement.execute
+
+    def recording_execute(statement: Any, cur: Any, params: Any = None) -> None:
+        executed.setdefault(statement.name, (statement, params))
+        execute(statement, cur, params)
+
+    db.Statement.execute = recording_execute
+
+    timings = []
+    for _ in range(repeat + 2):
+        event = dict(REQUESTS[function], headers={'Authorization': 'Bearer ' + token})
+        start = time.perf_counter()
+        response = module.handler(event, Context())
+        timings.append((time.perf_counter() - start) * 1000)
+        if response.get('statusCode', 200) >= 400:
+            raise RuntimeError('%s answered %s: %s' % (function, response.get('statusCode'), response.get('body')))
+
+    statements = []
+    if db.PREPARE_STATEMENTS:
+        import psycopg2
+        conn = psycopg2.connect(os.environ['DATABASE_URL'])
+        try:
+            with conn.cursor() as cur:
+                for name, (statement, params) in sorted(executed.items()):
+                    plain = [planning_ms(cur, statement.sql, params) for _ in range(repeat)]
+                    cur.execute(statement.prepare_sql)
+                    prepared = [planning_ms(cur, statement.execute_sql, params) for _ in range(repeat)]
+                    statements.append({
+                        'statement': name,
+                        'plain_planning_ms': round(statistics.median(plain), 3),
+                        'prepared_planning_ms': round(statistics.median(prepared), 3)
+                    })
+        finally:
+            conn.close()
+
+    return {
+        'import_ms': round(import_ms, 2),
+        'first_ms': round(timings[0], 2),
+        'second_ms': round(timings[1], 2),
+        'steady_ms': round(statistics.median(timings[2:]), 2) if repeat else None,
+        'statements': statements
+    }
+
+def top_imports(importtime: str, limit: int) -> List[Dict[str, Any]]:
+    '''
+    Top-level modules imported by index.py, by cumulative time.
+    '''
+    modules = []
+    for line in importtime.split(IMPORT_MARKER, 1)[-1].splitlines():
+        if not line.startswith('import time:') or '|' not in line or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if name.startswith('  '):
+            continue
+        modules.append({'module': name.strip(), 'ms': round(int(cumulative) / 1000, 2)})
+    return sorted(modules, key=lambda module: -module['ms'])[:limit]
+
+def run_child(function: str, repeat: int, env: Dict[str, str]) -> Dict[str, Any]:
+    completed = subprocess.run(
+        [sys.executable, '-X', 'importtime', os.path.abspath(__file__), '--child', function, '--repeat', str(repeat)],
+        env=dict(dict(os.environ, SESSION_SECRETS=os.environ.get('SESSION_SECRETS') or secrets.token_urlsafe(32)),
+                 METRICS_LOG_REQUESTS='0', RATE_LIMIT_ENABLED='0', **env),
+        capture_output=True, text=True
+    )
+    if completed.returncode != 0:
+        raise RuntimeError('%s failed:\n%s' % (function, completed.stderr[-2000:]))
+    result = json.loads(completed.stdout.strip().splitlines()[-1])
+    result['top_imports'] = top_imports(completed.stderr, 5)
+    return result
+
+def profile(function: str, repeat: int) -> Dict[str, Any]:
+    warm = run_child(function, repeat, {'DB_WARM_UP': '1', 'DB_PREPARE_STATEMENTS': '1'})
+    cold = run_child(function, repeat, {'DB_WARM_UP': '0', 'DB_PREPARE_STATEMENTS': '1'})
+    unprepared = run_child(function, repeat, {'DB_WARM_UP': '1', 'DB_PREPARE_STATEMENTS': '0'})
+    return {
+        'function': function,
+        'import_ms': warm['import_ms'],
+        'import_ms_without_warm_up': cold['import_ms'],
+        'top_imports': warm['top_imports'],
+        'first_ms': warm['first_ms'],
+        'second_ms': warm['second_ms'],
+        'first_ms_without_warm_up': cold['first_ms'],
+        'second_ms_without_warm_up': cold['second_ms'],
+        'steady_ms': warm['steady_ms'],
+        'steady_ms_unprepared': unprepared['steady_ms'],
+        'statements': warm['statements']
+    }
+
+def print_report(results: List[Dict[str, Any]]) -> None:
+    print('%-10s %10s %18s %22s %18s' % ('function', 'import ms', 'first/second ms', 'no warm-up first/2nd', 'steady / unprep.'))
+    for result in results:
+        print('%-10s %10.1f %18s %22s %18s' % (
+            result['function'], result['import_ms'],
+            '%.1f / %.1f' % (result['first_ms'], result['second_ms']),
+            '%.1f / %.1f' % (result['first_ms_without_warm_up'], result['second_ms_without_warm_up']),
+            '%.2f / %.2f' % (result['steady_ms'], result['steady_ms_unprepared'])
+        ))
+    print()
+    print('slowest imports (cumulative ms)')
+    for result in results:
+        print('  %-10s %s' % (result['function'], ', '.join('%s %.1f' % (m['module'], m['ms']) for m in result['top_imports'])))
+    print()
+    print('%-40s %14s %14s' % ('statement', 'plan ms plain', 'plan ms prep.'))
+    for result in results:
+        for statement in result['statements']:
+            print('%-40s %14.3f %14.3f' % (statement['statement'], statement['plain_planning_ms'], statement['prepared_planning_ms']))
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Profile cold starts and statement planning of the backend functions')
+    parser.add_argument('--functions', default=','.join(REQUESTS), help='comma-separated, from: %s' % ', '.join(REQUESTS))
+    parser.add_argument('--repeat', type=int, default=30)
+    parser.add_argument('--json', help='write the report here')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(child(args.child, args.repeat)))
+        return 0
+
+    if 'DATABASE_URL' not in os.environ:
+        parser.error('DATABASE_URL is required')
+
+    results = [profile(function.strip(), args.repeat) for function in args.functions.split(',') if function.strip()]
+    print_report(results)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
\ No newline at end of file
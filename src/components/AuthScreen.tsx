@@ -4,6 +4,7 @@ import { Input } from './ui/input';
 import { Card } from './ui/card';
 import { useToast } from '../hooks/use-toast';
 import Icon from './ui/icon';
+import { setSessionToken } from '../lib/session';
 
 const AUTH_URL = 'https://functions.poehali.dev/c216886e-b8d8-40b8-b32d-8877b8726184';
 
@@ -41,6 +42,7 @@ export default function AuthScreen({ onLogin }: AuthScreenProps) {
           title: mode === 'register' ? 'Аккаунт создан!' : 'Вход выполнен!',
           description: `Добро пожаловать, ${data.user.nickname}!`
         });
+        setSessionToken(data.token);
         onLogin(data.user);
       } else {
         toast({
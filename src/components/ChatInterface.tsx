@@ -5,9 +5,22 @@ import SettingsPanel from './SettingsPanel';
 import CreateChatDialog from './CreateChatDialog';
 import CreateGroupDialog from './CreateGroupDialog';
 import Icon from './ui/icon';
+import { readHeaders } from '../lib/readYourWrites';
+import { authHeaders } from '../lib/session';
 import { Button } from './ui/button';
 
+const AUTH_URL = 'https://functions.poehali.dev/c216886e-b8d8-40b8-b32d-8877b8726184';
 const CHATS_URL = 'https://functions.poehali.dev/6075572c-e69b-46dc-98d5-1a475f97548f';
+const MESSAGES_URL = 'https://functions.poehali.dev/3bdf8938-1c66-4db5-ae96-1bd2801d0c42';
+const USERS_URL = 'https://functions.poehali.dev/e788aa75-8a17-452b-bc37-40eb09790295';
+const RETRY_DELAY = 3000;
+const HEARTBEAT_INTERVAL = 30000;
+
+// Rate-limited (429) and shed (503) responses say when to come back
+const retryAfterMs = (response: Response) => {
+  const seconds = Number(response.headers.get('Retry-After'));
+  return Number.isFinite(seconds) && seconds > 0 ? seconds * 1000 : RETRY_DELAY;
+};
 
 interface User {
   id: number;
@@ -32,6 +45,7 @@ export interface Chat {
   owner_id?: number;
   last_message?: string;
   last_message_time?: string;
+  unread_count?: number;
   other_user?: {
     id: number;
     username: string;
@@ -47,16 +61,91 @@ export default function ChatInterface({ user, onLogout, theme, setTheme }: ChatI
   const [showCreateChat, setShowCreateChat] = useState(false);
   const [showCreateGroup, setShowCreateGroup] = useState(false);
   const [loading, setLoading] = useState(true);
+  const [updatedChats, setUpdatedChats] = useState<Record<number, number>>({});
 
   useEffect(() => {
+    let active = true;
+    let cursor: number | null = null;
+
+    const waitForUpdates = async () => {
+      while (active) {
+        try {
+          const query = cursor === null ? '' : `&cursor=${cursor}`;
+          const response = await fetch(`${MESSAGES_URL}?user_id=${user.id}&wait=1${query}`, {
+            headers: authHeaders()
+          });
+          const data = await response.json();
+          if (!active) return;
+          if (response.status === 429 || response.status === 503) {
+            await new Promise((resolve) => setTimeout(resolve, retryAfterMs(response)));
+            continue;
+          }
+          if (!response.ok) throw new Error(data.error);
+
+          const changed = data.chats_changed || data.updates.length > 0;
+          cursor = data.cursor;
+          if (data.updates.length > 0) {
+            setUpdatedChats((prev) => {
+              const next = { ...prev };
+              for (const update of data.updates) {
+                next[update.chat_id] = Math.max(next[update.chat_id] || 0, update.message_id);
+              }
+              return next;
+            });
+          }
+          if (changed) loadChats();
+        } catch (error) {
+          console.error('Failed to wait for updates:', error);
+          await new Promise((resolve) => setTimeout(resolve, RETRY_DELAY));
+        }
+      }
+    };
+
     loadChats();
-    const interval = setInterval(loadChats, 3000);
-    return () => clearInterval(interval);
+    waitForUpdates();
+    return () => {
+      active = false;
+    };
   }, [user.id]);
 
+  useEffect(() => {
+    const sendHeartbeat = () => {
+      if (document.visibilityState === 'hidden') return;
+      fetch(USERS_URL, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json', ...authHeaders() },
+        body: JSON.stringify({ action: 'heartbeat', user_id: user.id })
+      }).catch((error) => console.error('Failed to send heartbeat:', error));
+    };
+
+    sendHeartbeat();
+    const interval = setInterval(sendHeartbeat, HEARTBEAT_INTERVAL);
+    document.addEventListener('visibilitychange', sendHeartbeat);
+    return () => {
+      clearInterval(interval);
+      document.removeEventListener('visibilitychange', sendHeartbeat);
+    };
+  }, [user.id]);
+
+  const handleLogout = () => {
+    fetch(USERS_URL, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json', ...authHeaders() },
+      body: JSON.stringify({ action: 'offline', user_id: user.id })
+    }).catch((error) => console.error('Failed to go offline:', error));
+    fetch(AUTH_URL, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json', ...authHeaders() },
+      body: JSON.stringify({ action: 'logout' })
+    }).catch((error) => console.error('Failed to end session:', error));
+    onLogout();
+  };
+
   const loadChats = async () => {
     try {
-      const response = await fetch(`${CHATS_URL}?user_id=${user.id}`);
+      const response = await fetch(`${CHATS_URL}?user_id=${user.id}`, {
+        headers: { ...readHeaders(), ...authHeaders() }
+      });
       const data = await response.json();
       if (data.chats) {
         setChats(data.chats);
@@ -128,6 +217,7 @@ export default function ChatInterface({ user, onLogout, theme, setTheme }: ChatI
           <ChatWindow
             chat={selectedChat}
             user={user}
+            lastUpdateId={updatedChats[selectedChat.id] || 0}
             onBack={() => setSelectedChat(null)}
           />
         ) : (
@@ -146,7 +236,7 @@ export default function ChatInterface({ user, onLogout, theme, setTheme }: ChatI
           theme={theme}
           setTheme={setTheme}
           onClose={() => setShowSettings(false)}
-          onLogout={onLogout}
+          onLogout={handleLogout}
         />
       )}
 
@@ -84,9 +84,16 @@ export default function ChatList({ chats, selectedChat, onSelectChat, currentUse
                     {formatTime(chat.last_message_time)}
                   </span>
                 </div>
-                <p className="text-sm text-muted-foreground truncate">
-                  {chat.last_message || 'Нет сообщений'}
-                </p>
+                <div className="flex items-center justify-between gap-2">
+                  <p className="text-sm text-muted-foreground truncate">
+                    {chat.last_message || 'Нет сообщений'}
+                  </p>
+                  {!isSelected && !!chat.unread_count && (
+                    <span className="min-w-5 h-5 px-1.5 rounded-full bg-primary text-primary-foreground text-xs font-semibold flex items-center justify-center">
+                      {chat.unread_count > 99 ? '99+' : chat.unread_count}
+                    </span>
+                  )}
+                </div>
               </div>
             </button>
           );
@@ -5,8 +5,15 @@ import { Avatar, AvatarFallback } from './ui/avatar';
 import { ScrollArea } from './ui/scroll-area';
 import Icon from './ui/icon';
 import { Chat } from './ChatInterface';
+import { readHeaders, rememberWrite } from '../lib/readYourWrites';
+import { authHeaders } from '../lib/session';
 
 const MESSAGES_URL = 'https://functions.poehali.dev/3bdf8938-1c66-4db5-ae96-1bd2801d0c42';
+const USERS_URL = 'https://functions.poehali.dev/e788aa75-8a17-452b-bc37-40eb09790295';
+const PRESENCE_REFRESH = 60000;
+// Message ids are taken before commit, so a message can become visible
+// after a newer one. Polls start this far back and drop what they already have.
+const POLL_OVERLAP_MS = 30000;
 
 interface User {
   id: number;
@@ -22,7 +29,6 @@ interface Message {
   content: string;
   message_type: string;
   is_system: boolean;
-  read_by: number[];
   created_at: string;
   sender: {
     username: string;
@@ -34,33 +40,153 @@ interface Message {
 interface ChatWindowProps {
   chat: Chat;
   user: User;
+  lastUpdateId: number;
   onBack: () => void;
 }
 
-export default function ChatWindow({ chat, user, onBack }: ChatWindowProps) {
+export default function ChatWindow({ chat, user, lastUpdateId, onBack }: ChatWindowProps) {
   const [messages, setMessages] = useState<Message[]>([]);
   const [newMessage, setNewMessage] = useState('');
   const [loading, setLoading] = useState(false);
+  const [hasOlder, setHasOlder] = useState(false);
+  const [readUpTo, setReadUpTo] = useState(0);
+  const [otherOnline, setOtherOnline] = useState(false);
   const scrollRef = useRef<HTMLDivElement>(null);
+  const messagesRef = useRef<Message[]>([]);
+  const lastIdRef = useRef<number | null>(null);
+  const chatIdRef = useRef(chat.id);
+  const pendingIdRef = useRef<string | null>(null);
 
   useEffect(() => {
+    chatIdRef.current = chat.id;
+    updateMessages([]);
+    setHasOlder(false);
+    setReadUpTo(0);
+    lastIdRef.current = null;
     loadMessages();
-    const interval = setInterval(loadMessages, 2000);
-    return () => clearInterval(interval);
   }, [chat.id]);
 
+  useEffect(() => {
+    if (lastIdRef.current !== null && lastUpdateId > lastIdRef.current) {
+      loadMessages();
+    }
+  }, [lastUpdateId]);
+
+  useEffect(() => {
+    const otherUserId = chat.type === 'private' ? chat.other_user?.id : undefined;
+    setOtherOnline(false);
+    if (!otherUserId) return;
+
+    let active = true;
+    const loadPresence = async () => {
+      try {
+        const response = await fetch(`${USERS_URL}?presence_ids=${otherUserId}`, {
+          headers: authHeaders()
+        });
+        const data = await response.json();
+        if (active && data.presence) {
+          setOtherOnline(Boolean(data.presence[otherUserId]?.online));
+        }
+      } catch (error) {
+        console.error('Failed to load presence:', error);
+      }
+    };
+
+    loadPresence();
+    const interval = setInterval(loadPresence, PRESENCE_REFRESH);
+    return () => {
+      active = false;
+      clearInterval(interval);
+    };
+  }, [chat.id, chat.other_user?.id]);
+
   useEffect(() => {
     if (scrollRef.current) {
       scrollRef.current.scrollTop = scrollRef.current.scrollHeight;
     }
   }, [messages]);
 
-  const loadMessages = async () => {
+  // Every change goes through the ref too, so a poll started right after
+  // an update already sees it
+  const updateMessages = (next: Message[]) => {
+    messagesRef.current = next;
+    setMessages(next);
+  };
+
+  const mergeMessages = (incoming: Message[]) => {
+    const seen = new Set(messagesRef.current.map((message) => message.id));
+    const fresh = incoming.filter((message) => !seen.has(message.id));
+    if (fresh.length > 0) {
+      updateMessages([...messagesRef.current, ...fresh].sort((a, b) => a.id - b.id));
+    }
+  };
+
+  // The newest loaded message at least POLL_OVERLAP_MS older than the
+  // newest one; anything committed late since then has a higher id
+  const overlapSinceId = () => {
+    const loaded = messagesRef.current;
+    if (loaded.length === 0) return lastIdRef.current;
+    const newest = Date.parse(loaded[loaded.length - 1].created_at);
+    for (let i = loaded.length - 1; i >= 0; i--) {
+      if (newest - Date.parse(loaded[i].created_at) >= POLL_OVERLAP_MS) return loaded[i].id;
+    }
+    return loaded[0].id - 1;
+  };
+
+  const loadMessages = async (afterId?: number) => {
+    try {
+      const newestId = lastIdRef.current;
+      const sinceId = afterId ?? (newestId === null ? null : overlapSinceId());
+      const query = sinceId === null ? '' : `&since_id=${sinceId}`;
+      const response = await fetch(`${MESSAGES_URL}?chat_id=${chat.id}&user_id=${user.id}${query}`, {
+        headers: { ...readHeaders(), ...authHeaders() }
+      });
+      const data = await response.json();
+      if (!data.messages || chatIdRef.current !== chat.id || lastIdRef.current !== newestId) return;
+
+      setReadUpTo(data.read_up_to || 0);
+      const pageLastId = data.messages.length > 0 ? data.messages[data.messages.length - 1].id : null;
+      if (pageLastId !== null && pageLastId > (lastIdRef.current ?? 0)) {
+        lastIdRef.current = pageLastId;
+        markRead(pageLastId);
+      }
+
+      if (newestId === null) {
+        if (lastIdRef.current === null) lastIdRef.current = 0;
+        updateMessages(data.messages);
+        setHasOlder(data.has_more);
+      } else if (data.messages.length > 0) {
+        mergeMessages(data.messages);
+        if (data.has_more) loadMessages(pageLastId as number);
+      }
+    } catch (error) {
+      console.error('Failed to load messages:', error);
+    }
+  };
+
+  const markRead = async (upToId: number) => {
     try {
-      const response = await fetch(`${MESSAGES_URL}?chat_id=${chat.id}`);
+      const response = await fetch(MESSAGES_URL, {
+        method: 'PUT',
+        headers: { 'Content-Type': 'application/json', ...authHeaders() },
+        body: JSON.stringify({ chat_id: chat.id, user_id: user.id, up_to_id: upToId })
+      });
+      rememberWrite(response);
+    } catch (error) {
+      console.error('Failed to mark messages as read:', error);
+    }
+  };
+
+  const loadOlderMessages = async () => {
+    if (messages.length === 0) return;
+    try {
+      const response = await fetch(`${MESSAGES_URL}?chat_id=${chat.id}&before_id=${messages[0].id}`, {
+        headers: { ...readHeaders(), ...authHeaders() }
+      });
       const data = await response.json();
       if (data.messages) {
-        setMessages(data.messages);
+        mergeMessages(data.messages);
+        setHasOlder(data.has_more);
       }
     } catch (error) {
       console.error('Failed to load messages:', error);
@@ -72,18 +198,24 @@ export default function ChatWindow({ chat, user, onBack }: ChatWindowProps) {
     if (!newMessage.trim() || loading) return;
 
     setLoading(true);
+    // Retrying the same draft reuses its id, so the server stores it only once
+    const clientMessageId = pendingIdRef.current ?? crypto.randomUUID();
+    pendingIdRef.current = clientMessageId;
     try {
       const response = await fetch(MESSAGES_URL, {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
+        headers: { 'Content-Type': 'application/json', ...authHeaders() },
         body: JSON.stringify({
           chat_id: chat.id,
           sender_id: user.id,
-          content: newMessage.trim()
+          content: newMessage.trim(),
+          client_message_id: clientMessageId
         })
       });
 
       if (response.ok) {
+        rememberWrite(response);
+        pendingIdRef.current = null;
         setNewMessage('');
         loadMessages();
       }
@@ -137,11 +269,21 @@ export default function ChatWindow({ chat, user, onBack }: ChatWindowProps) {
           {chat.type === 'group' && (
             <p className="text-xs text-muted-foreground">Группа</p>
           )}
+          {chat.type === 'private' && otherOnline && (
+            <p className="text-xs text-primary">в сети</p>
+          )}
         </div>
       </div>
 
       <ScrollArea className="flex-1 p-4" ref={scrollRef}>
         <div className="space-y-4">
+          {hasOlder && (
+            <div className="flex justify-center">
+              <Button size="sm" variant="ghost" onClick={loadOlderMessages}>
+                Загрузить ранние сообщения
+              </Button>
+            </div>
+          )}
           {messages.map((message) => {
             const isOwn = message.sender_id === user.id;
             
@@ -173,7 +315,7 @@ export default function ChatWindow({ chat, user, onBack }: ChatWindowProps) {
                     </span>
                     {isOwn && chat.type === 'private' && (
                       <div className="flex">
-                        {message.read_by.length > 1 ? (
+                        {message.id <= readUpTo ? (
                           <Icon name="CheckCheck" size={14} className="text-primary" />
                         ) : (
                           <Icon name="Check" size={14} className="text-muted-foreground" />
@@ -203,7 +345,10 @@ export default function ChatWindow({ chat, user, onBack }: ChatWindowProps) {
             type="text"
             placeholder="Сообщение..."
             value={newMessage}
-            onChange={(e) => setNewMessage(e.target.value)}
+            onChange={(e) => {
+              pendingIdRef.current = null;
+              setNewMessage(e.target.value);
+            }}
             className="glass-dark flex-1"
             disabled={loading}
           />
@@ -1,14 +1,24 @@
-import { useState } from 'react';
+import { useEffect, useState } from 'react';
 import { Dialog, DialogContent, DialogHeader, DialogTitle } from './ui/dialog';
 import { Button } from './ui/button';
 import { Input } from './ui/input';
 import { Label } from './ui/label';
 import { useToast } from '../hooks/use-toast';
 import Icon from './ui/icon';
+import { rememberWrite } from '../lib/readYourWrites';
+import { authHeaders } from '../lib/session';
 
 const CHATS_URL = 'https://functions.poehali.dev/6075572c-e69b-46dc-98d5-1a475f97548f';
 const USERS_URL = 'https://functions.poehali.dev/e788aa75-8a17-452b-bc37-40eb09790295';
 
+const SEARCH_DEBOUNCE = 300;
+
+interface FoundUser {
+  id: number;
+  username: string;
+  nickname: string;
+}
+
 interface CreateChatDialogProps {
   open: boolean;
   onClose: () => void;
@@ -19,14 +29,44 @@ interface CreateChatDialogProps {
 export default function CreateChatDialog({ open, onClose, userId, onChatCreated }: CreateChatDialogProps) {
   const [username, setUsername] = useState('');
   const [loading, setLoading] = useState(false);
+  const [suggestions, setSuggestions] = useState<FoundUser[]>([]);
   const { toast } = useToast();
 
+  useEffect(() => {
+    const query = username.trim();
+    if (!query) {
+      setSuggestions([]);
+      return;
+    }
+
+    const controller = new AbortController();
+    const timeout = setTimeout(async () => {
+      try {
+        const response = await fetch(`${USERS_URL}?q=${encodeURIComponent(query)}&limit=5`, {
+          headers: authHeaders(),
+          signal: controller.signal
+        });
+        const data = await response.json();
+        setSuggestions((data.users || []).filter((found: FoundUser) => found.id !== userId));
+      } catch (error) {
+        if (!controller.signal.aborted) setSuggestions([]);
+      }
+    }, SEARCH_DEBOUNCE);
+
+    return () => {
+      clearTimeout(timeout);
+      controller.abort();
+    };
+  }, [username, userId]);
+
   const handleCreate = async () => {
     if (!username.trim()) return;
 
     setLoading(true);
     try {
-      const usersResponse = await fetch(`${USERS_URL}?username=${username}`);
+      const usersResponse = await fetch(`${USERS_URL}?username=${encodeURIComponent(username.trim())}`, {
+        headers: authHeaders()
+      });
       const usersData = await usersResponse.json();
       
       if (!usersData.user) {
@@ -41,7 +81,7 @@ export default function CreateChatDialog({ open, onClose, userId, onChatCreated
 
       const response = await fetch(CHATS_URL, {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
+        headers: { 'Content-Type': 'application/json', ...authHeaders() },
         body: JSON.stringify({
           type: 'private',
           creator_id: userId,
@@ -52,8 +92,9 @@ export default function CreateChatDialog({ open, onClose, userId, onChatCreated
       const data = await response.json();
 
       if (response.ok && data.success) {
+        rememberWrite(response);
         toast({
-          title: 'Чат создан!',
+          title: data.created ? 'Чат создан!' : 'Чат уже существует',
           description: `Вы можете начать общение с ${username}`
         });
         onChatCreated();
@@ -94,6 +135,21 @@ export default function CreateChatDialog({ open, onClose, userId, onChatCreated
               onKeyDown={(e) => e.key === 'Enter' && handleCreate()}
               className="glass-dark"
             />
+            {suggestions.length > 0 && (
+              <div className="glass-dark rounded-md divide-y divide-border/50">
+                {suggestions.map((found) => (
+                  <button
+                    key={found.id}
+                    type="button"
+                    onClick={() => setUsername(found.username)}
+                    className="w-full px-3 py-2 text-left hover:bg-primary/10 transition-colors"
+                  >
+                    <span className="font-medium">{found.nickname || found.username}</span>
+                    <span className="text-sm text-muted-foreground ml-2">@{found.username}</span>
+                  </button>
+                ))}
+              </div>
+            )}
           </div>
           <Button
             onClick={handleCreate}
@@ -5,6 +5,8 @@ import { Input } from './ui/input';
 import { Label } from './ui/label';
 import { useToast } from '../hooks/use-toast';
 import Icon from './ui/icon';
+import { rememberWrite } from '../lib/readYourWrites';
+import { authHeaders } from '../lib/session';
 
 const CHATS_URL = 'https://functions.poehali.dev/6075572c-e69b-46dc-98d5-1a475f97548f';
 
@@ -27,7 +29,7 @@ export default function CreateGroupDialog({ open, onClose, userId, onGroupCreate
     try {
       const response = await fetch(CHATS_URL, {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
+        headers: { 'Content-Type': 'application/json', ...authHeaders() },
         body: JSON.stringify({
           type: 'group',
           name: groupName.trim(),
@@ -39,6 +41,7 @@ export default function CreateGroupDialog({ open, onClose, userId, onGroupCreate
       const data = await response.json();
 
       if (response.ok && data.success) {
+        rememberWrite(response);
         toast({
           title: 'Группа создана!',
           description: `Группа "${groupName}" успешно создана`
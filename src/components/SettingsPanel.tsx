@@ -8,6 +8,8 @@ import { Separator } from './ui/separator';
 import { Switch } from './ui/switch';
 import { useToast } from '../hooks/use-toast';
 import Icon from './ui/icon';
+import { rememberWrite } from '../lib/readYourWrites';
+import { authHeaders } from '../lib/session';
 
 const PROFILE_URL = 'https://functions.poehali.dev/191c020a-f4a3-421d-80c7-4ca282695299';
 
@@ -38,13 +40,14 @@ export default function SettingsPanel({ user, theme, setTheme, onClose, onLogout
     try {
       const response = await fetch(PROFILE_URL, {
         method: 'PUT',
-        headers: { 'Content-Type': 'application/json' },
+        headers: { 'Content-Type': 'application/json', ...authHeaders() },
         body: JSON.stringify({ user_id: user.id, ...updates })
       });
 
       const data = await response.json();
 
       if (response.ok && data.success) {
+        rememberWrite(response);
         toast({
           title: 'Сохранено!',
           description: 'Настройки обновлены'
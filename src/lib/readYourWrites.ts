@@ -0,0 +1,18 @@
+// Writes answer with X-Lsn, the primary's WAL position after the commit.
+// Reads send the newest one back as X-Min-Lsn so the backend only serves
+// them from a replica that has replayed it, falling back to the primary.
+let lastLsn: string | null = null;
+
+const lsnKey = (lsn: string) =>
+  lsn.split('/').map((part) => part.toUpperCase().padStart(8, '0')).join('');
+
+export function rememberWrite(response: Response) {
+  const lsn = response.headers.get('X-Lsn');
+  if (lsn && (lastLsn === null || lsnKey(lsn) > lsnKey(lastLsn))) {
+    lastLsn = lsn;
+  }
+}
+
+export function readHeaders(): Record<string, string> {
+  return lastLsn === null ? {} : { 'X-Min-Lsn': lastLsn };
+}
@@ -0,0 +1,23 @@
+// Login and register return a signed session token. Requests send it as
+// Authorization: Bearer, and the backend checks it against the user ids
+// they carry. It is kept in localStorage next to the saved user.
+const TOKEN_KEY = 'pchat_token';
+
+let token: string | null = localStorage.getItem(TOKEN_KEY);
+
+export function setSessionToken(value: string | null) {
+  token = value;
+  if (value === null) {
+    localStorage.removeItem(TOKEN_KEY);
+  } else {
+    localStorage.setItem(TOKEN_KEY, value);
+  }
+}
+
+export function hasSessionToken(): boolean {
+  return token !== null;
+}
+
+export function authHeaders(): Record<string, string> {
+  return token === null ? {} : { Authorization: `Bearer ${token}` };
+}
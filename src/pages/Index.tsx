@@ -1,6 +1,7 @@
 import { useState, useEffect } from 'react';
 import AuthScreen from '../components/AuthScreen';
 import ChatInterface from '../components/ChatInterface';
+import { hasSessionToken, setSessionToken } from '../lib/session';
 
 interface User {
   id: number;
@@ -16,7 +17,10 @@ export default function Index() {
 
   useEffect(() => {
     const savedUser = localStorage.getItem('pchat_user');
-    if (savedUser) {
+    // Users saved before session tokens existed have to log in again
+    if (savedUser && !hasSessionToken()) {
+      localStorage.removeItem('pchat_user');
+    } else if (savedUser) {
       const userData = JSON.parse(savedUser);
       setUser(userData);
       if (userData.theme) {
@@ -46,6 +50,7 @@ export default function Index() {
 
   const handleLogout = () => {
     setUser(null);
+    setSessionToken(null);
     localStorage.removeItem('pchat_user');
   };
 